@@ -0,0 +1,178 @@
+"""
+Generate synthetic Patient and AllergyIntolerance NDJSON files shaped like ``data/*.ndjson``.
+
+``--lines`` lines are written in total, one patient for ``--allergies-per-patient``
+allergies on average, each allergy referencing a patient of the same file. A
+fraction ``--malformed-rate`` of the lines is malformed, half of them with an empty
+value (``"gender":,``, ``"recordedDate":}``) as in the sample, which the reader
+repairs into a null the validation may reject, half truncated, which the reader
+rejects. A fraction ``--duplicate-ratio`` of the lines repeats a line written
+before, as when a resource comes back in another export. The same ``--seed``
+always gives the same files.
+
+Usage (from the repository root):
+    python3 benchmarks/fhir_generator.py --lines 1000000 --out /tmp/fhir --malformed-rate 0.01 --duplicate-ratio 0.1
+"""
+import argparse
+import json
+import os
+import random
+import uuid
+from collections import deque
+from typing import Dict, NamedTuple
+
+PATIENT_FILE = "Patient.ndjson"
+ALLERGY_FILE = "AllergyIntolerance.ndjson"
+
+FAMILIES = ("Wintheiser", "Conroy", "Lindgren", "Flatley", "Gibson", "Nolan", "Kreiger", "Mayert", "Yundt", "Bruen")
+GIVEN = {
+    "female": ("Aleta", "Lynelle", "Maria", "Ione", "Keisha"),
+    "male": ("Mohammad", "Granville", "Reed", "Trey", "Sherwood", "Emory", "Francesco", "Jamar"),
+}
+PREFIXES = {"female": ("Mrs.", "Ms."), "male": ("Mr.",)}
+CITIES = (
+    ("Everett", "02149"), ("Hingham", "02043"), ("Hanover", None), ("Boston", "02131"), ("Pittsfield", None),
+    ("Melrose", None), ("Woburn", None), ("Raynham", None), ("Boston", "02110"),
+)
+STREETS = ("Kertzmann Heights", "Hilll Wall", "Yundt Walk", "Hilpert View", "Carter Passage", "Effertz Common")
+CODES = (
+    ("232347008", "Dander (animal) allergy", "pet allergy"),
+    ("232350006", "House dust mite allergy", "environment"),
+    ("300913006", "Shellfish allergy", "food"),
+    ("418689008", "Allergy to grass pollen", "environment"),
+    ("419263009", "Allergy to tree pollen", "environment"),
+    ("419474003", "Allergy to mould", "environment"),
+    ("424213003", "Allergy to bee venom", "environment"),
+    ("425525006", "Allergy to dairy product", "food"),
+    ("91934008", "Allergy to nut", "food"),
+    ("91935009", "Allergy to peanuts", "food"),
+)
+# Lines kept to be repeated as duplicates, per file
+RECENT_LINES = 10000
+
+
+class GeneratedFiles(NamedTuple):
+    patient_path: str
+    allergy_path: str
+    patient_lines: int
+    allergy_lines: int
+    malformed: int
+    duplicates: int
+
+
+class FhirGenerator:
+    def __init__(self, allergies_per_patient: float = 3.8, malformed_rate: float = 0.0,
+                 duplicate_ratio: float = 0.0, seed: int = 0) -> None:
+        self.allergies_per_patient = allergies_per_patient
+        self.malformed_rate = malformed_rate
+        self.duplicate_ratio = duplicate_ratio
+        self.random = random.Random(seed)
+        self.malformed = 0
+        self.duplicates = 0
+
+    def _uuid(self) -> str:
+        return str(uuid.UUID(int=self.random.getrandbits(128), version=4))
+
+    def _date(self, first_year: int, last_year: int) -> str:
+        return f"{self.random.randint(first_year, last_year)}-{self.random.randint(1, 12):02d}-{self.random.randint(1, 28):02d}"
+
+    def patient(self) -> dict:
+        rng = self.random
+        gender = rng.choice(("female", "male"))
+        given = rng.choice(GIVEN[gender])
+        name = {"use": "official", "family": rng.choice(FAMILIES), "given": [given]}
+        if rng.random() < 0.8:
+            name["prefix"] = [rng.choice(PREFIXES[gender])]
+        city, postal_code = rng.choice(CITIES)
+        address = {"line": [f"{rng.randint(1, 1999)} {rng.choice(STREETS)}"], "city": city, "state": "Massachusetts"}
+        if postal_code:
+            address["postalCode"] = postal_code
+        address["country"] = "US"
+        return {
+            "resourceType": "Patient",
+            "id": self._uuid(),
+            "name": [name],
+            "telecom": [{"system": "phone", "value": f"555-{rng.randint(100, 999)}-{rng.randint(1000, 9999)}", "use": "home"}],
+            "gender": gender,
+            "birthDate": self._date(1930, 2020),
+            "address": [address],
+        }
+
+    def allergy(self, patient_id: str) -> dict:
+        code, display, category = self.random.choice(CODES)
+        return {
+            "resourceType": "AllergyIntolerance",
+            "id": self._uuid(),
+            "type": "allergy",
+            "category": [category],
+            "criticality": "low",
+            "code": {"coding": [{"system": "http://snomed.info/sct", "code": code, "display": display}], "text": display},
+            "patient": {"reference": f"Patient/{patient_id}"},
+            "recordedDate": f"{self._date(1940, 2023)}T17:48:38-04:00",
+        }
+
+    def _malformed(self, line: str, empty_key: str) -> str:
+        self.malformed += 1
+        if self.random.random() < 0.5:
+            return line[:self.random.randint(1, len(line) - 1)]
+        # The value of the key is left empty, the reader writes null instead
+        start = line.index(f'"{empty_key}":') + len(empty_key) + 3
+        end = line.find(',"', start)
+        return line[:start] + (line[len(line) - 1:] if end == -1 else line[end:])
+
+    def _line(self, document: dict, recent: deque, empty_key: str) -> str:
+        if recent and self.random.random() < self.duplicate_ratio:
+            self.duplicates += 1
+            return self.random.choice(recent)
+        line = json.dumps(document, separators=(",", ":"))
+        recent.append(line)
+        if self.random.random() < self.malformed_rate:
+            return self._malformed(line, empty_key)
+        return line
+
+    def write(self, out_dir: str, lines: int) -> GeneratedFiles:
+        """
+        Write ``lines`` lines in total to the Patient and AllergyIntolerance files of ``out_dir``.
+        """
+        os.makedirs(out_dir, exist_ok=True)
+        patient_path = os.path.join(out_dir, PATIENT_FILE)
+        allergy_path = os.path.join(out_dir, ALLERGY_FILE)
+        counts: Dict[str, int] = {"patients": 0, "allergies": 0}
+        recent_patients: deque = deque(maxlen=RECENT_LINES)
+        recent_allergies: deque = deque(maxlen=RECENT_LINES)
+        whole, fraction = divmod(self.allergies_per_patient, 1)
+        with open(patient_path, "w") as patients, open(allergy_path, "w") as allergies:
+            while counts["patients"] + counts["allergies"] < lines:
+                patient = self.patient()
+                patients.write(self._line(patient, recent_patients, "gender") + "\n")
+                counts["patients"] += 1
+                for _ in range(int(whole) + (self.random.random() < fraction)):
+                    if counts["patients"] + counts["allergies"] >= lines:
+                        break
+                    allergies.write(self._line(self.allergy(patient["id"]), recent_allergies, "recordedDate") + "\n")
+                    counts["allergies"] += 1
+        return GeneratedFiles(
+            patient_path, allergy_path, counts["patients"], counts["allergies"], self.malformed, self.duplicates
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, default=10000, help="Lines to write in total")
+    parser.add_argument("--out", default="generated", help="Directory receiving the NDJSON files")
+    parser.add_argument("--allergies-per-patient", type=float, default=3.8)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--duplicate-ratio", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    generator = FhirGenerator(args.allergies_per_patient, args.malformed_rate, args.duplicate_ratio, args.seed)
+    files = generator.write(args.out, args.lines)
+    print(
+        f"Wrote {files.patient_lines} patients to {files.patient_path} and {files.allergy_lines} allergies to "
+        f"{files.allergy_path}, {files.malformed} malformed and {files.duplicates} duplicate lines"
+    )
+
+
+if __name__ == "__main__":
+    main()
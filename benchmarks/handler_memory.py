@@ -0,0 +1,109 @@
+"""
+Report the handler peak memory as a function of the unacked backlog size.
+
+For every backlog size, a ``bench_handler_allergies`` raw table is filled with
+copies of the sample allergies, then read in a fresh process either the way the
+handler used to (``fetchall`` of every unacked row) or batch by batch with keyset
+pagination. Rows are validated with ``RawAllergy`` as the handler does. The peak
+resident memory of each process is reported.
+
+Usage (from the repository root, with the raw database reachable):
+    PYTHONPATH=src python3 benchmarks/handler_memory.py --backlogs 10000 100000 500000
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+
+import psycopg2.extras
+
+from ingestion.copy_buffer import CopyBuffer
+from models.raw_allergy import RawAllergy
+from processing.raw_fetcher import iter_unacked_batches
+from reader import connect_raw_db
+from repository.raw_schema import create_raw_table
+
+TABLE = "bench_handler_allergies"
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+STRATEGIES = ("fetchall", "keyset")
+
+
+def seed(backlog: int) -> None:
+    with open(os.path.join(DATA_DIR, "AllergyIntolerance.ndjson")) as f:
+        lines = [line.strip().replace('":,"', '":null,"').replace('":}', '":null}') for line in f if line.strip()]
+    conn = connect_raw_db()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {TABLE};")
+            create_raw_table(cur, TABLE)
+            buffer = CopyBuffer(cur, TABLE)
+            for i in range(backlog):
+                buffer.add(lines[i % len(lines)])
+            buffer.flush()
+            cur.execute(f"ANALYZE {TABLE};")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def validate(rows) -> None:
+    for row in rows:
+        try:
+            RawAllergy(**row['data'])
+        except Exception:
+            pass
+
+
+def read_backlog(strategy: str, batch_size: int) -> None:
+    conn = connect_raw_db()
+    conn.autocommit = True
+    try:
+        if strategy == "fetchall":
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+                cur.execute(f"SELECT id, data, ack, created_at FROM {TABLE} WHERE ack = false ORDER BY id ASC;")
+                rows = cur.fetchall()
+                for offset in range(0, len(rows), batch_size):
+                    validate(rows[offset:offset + batch_size])
+        else:
+            for rows in iter_unacked_batches(conn, TABLE, batch_size):
+                validate(rows)
+    finally:
+        conn.close()
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backlogs", type=int, nargs="+", default=[10_000, 100_000, 500_000])
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--child", choices=STRATEGIES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        read_backlog(args.child, args.batch_size)
+        return
+
+    print(f"{'backlog':>10} " + " ".join(f"{strategy + ' MB':>14}" for strategy in STRATEGIES))
+    try:
+        for backlog in args.backlogs:
+            seed(backlog)
+            peaks = []
+            for strategy in STRATEGIES:
+                # A fresh process per measure, so the peak is not inherited from the previous one
+                output = subprocess.run(
+                    [sys.executable, __file__, "--child", strategy, "--batch-size", str(args.batch_size)],
+                    check=True, capture_output=True, text=True
+                ).stdout
+                peaks.append(float(output.strip().splitlines()[-1]))
+            print(f"{backlog:>10} " + " ".join(f"{peak:>14.1f}" for peak in peaks))
+    finally:
+        conn = connect_raw_db()
+        with conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {TABLE};")
+        conn.commit()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Compare the handler execution modes when the database round trips are the bottleneck.
+
+Two entities of ``--batches`` batches each are run through ``BatchPipeline`` one
+after the other ("pipeline" mode), then through ``AsyncBatchPipeline`` side by side
+("asyncio" mode). The database calls are simulated by sleeping ``--fetch-ms``,
+``--select-ms``, ``--write-ms`` and ``--ack-ms`` milliseconds, the transform by
+``--transform-ms`` milliseconds, so the wall time of both modes can be compared
+without any database.
+
+Usage (from the repository root):
+    PYTHONPATH=src python3 benchmarks/handler_modes.py --batches 50 --write-ms 40
+"""
+import argparse
+import asyncio
+import time
+
+from processing.async_pipeline import AsyncBatchPipeline
+from processing.pipeline import BatchPipeline
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batches", type=int, default=50)
+    parser.add_argument("--fetch-ms", type=float, default=20)
+    parser.add_argument("--select-ms", type=float, default=10)
+    parser.add_argument("--transform-ms", type=float, default=10)
+    parser.add_argument("--write-ms", type=float, default=40)
+    parser.add_argument("--ack-ms", type=float, default=15)
+    parser.add_argument("--depth", type=int, default=2)
+    args = parser.parse_args()
+
+    def wait(ms):
+        time.sleep(ms / 1000)
+
+    def batches():
+        for i in range(args.batches):
+            wait(args.fetch_ms)
+            yield [{'id': i, 'data': {}}]
+
+    def select(rows):
+        wait(args.select_ms)
+        return rows, []
+
+    def transform(rows):
+        wait(args.transform_ms)
+        return args.transform_ms / 1000, rows
+
+    def write(rows):
+        wait(args.write_ms)
+        return [row['id'] for row in rows]
+
+    def ack(ids):
+        wait(args.ack_ms)
+
+    def pipelines(pipeline_class):
+        return [pipeline_class(transform, write, ack, depth=args.depth, select=select) for _ in range(2)]
+
+    start = time.perf_counter()
+    for pipeline in pipelines(BatchPipeline):
+        pipeline.run(batches())
+    sequential = time.perf_counter() - start
+
+    async def run_side_by_side(async_pipelines):
+        await asyncio.gather(*(pipeline.run_async(batches()) for pipeline in async_pipelines))
+
+    start = time.perf_counter()
+    asyncio.run(run_side_by_side(pipelines(AsyncBatchPipeline)))
+    concurrent = time.perf_counter() - start
+
+    total = 2 * args.batches
+    print(f"{'mode':<10} {'wall s':>8} {'batches/s':>10}")
+    print(f"{'pipeline':<10} {sequential:>8.2f} {total / sequential:>10.1f}")
+    print(f"{'asyncio':<10} {concurrent:>8.2f} {total / concurrent:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Report how long importing the handler takes, and which packages the time goes to.
+
+``import handler`` is run ``--runs`` times in a fresh interpreter with
+``python -X importtime``, with the settings of ``.env``. The median import time is
+reported, then the packages taking the most time on the median run, nested
+modules counted in their top-level package. Importing the handler opens no
+database connection, so no database is needed.
+
+Usage (from the repository root):
+    PYTHONPATH=src python3 benchmarks/handler_startup.py --runs 5 --top 10
+"""
+import argparse
+import os
+import subprocess
+import sys
+from typing import Dict, Tuple
+
+SRC_DIR = os.path.join(os.path.dirname(__file__), "..", "src")
+
+
+def import_times() -> Tuple[float, Dict[str, float]]:
+    """
+    :return: Seconds to import the handler, and seconds spent in every top-level package.
+    """
+    env = {**os.environ, "PYTHONPATH": os.path.abspath(SRC_DIR)}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import handler"],
+        env=env, capture_output=True, text=True, check=True
+    )
+    total = 0.0
+    packages: Dict[str, float] = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        name = module.strip()
+        if name == "handler":
+            total = int(cumulative_us) / 1e6
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0.0) + int(self_us) / 1e6
+    return total, packages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    runs = sorted((import_times() for _ in range(args.runs)), key=lambda run: run[0])
+    median, packages = runs[len(runs) // 2]
+    print(f"import handler: median {median:.3f}s, min {runs[0][0]:.3f}s, max {runs[-1][0]:.3f}s over {args.runs} runs")
+    print(f"{'package':<24} {'seconds':>8} {'share':>6}")
+    for package, seconds in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"{package:<24} {seconds:>8.3f} {seconds / median:>6.0%}")
+
+
+if __name__ == "__main__":
+    main()
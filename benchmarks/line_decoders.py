@@ -0,0 +1,73 @@
+"""
+Micro-benchmark of the reader decoding stage, without any database.
+
+Reports the lines per second of every installed JSON backend on the sample
+files replicated ``--copies`` times. The chained ``str.replace`` repair used by
+the reader is also compared with a single-pass regular expression producing
+the same output.
+
+Usage (from the repository root):
+    PYTHONPATH=src python3 benchmarks/line_decoders.py --copies 500
+"""
+import argparse
+import os
+import re
+import time
+
+from ingestion.decoding import JSON_BACKENDS, LineDecoder
+from reader import SOURCES
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+
+_ALLERGY_EMPTY_VALUE = re.compile(r'":,"(:})?|":}')
+
+
+def _allergy_replacement(match) -> str:
+    if match.group(0) == '":}':
+        return '":null}'
+    return '":null,":null}' if match.group(1) else '":null,"'
+
+
+def single_pass_allergy_repair(line: str) -> str:
+    return _ALLERGY_EMPTY_VALUE.sub(_allergy_replacement, line)
+
+
+def single_pass_patient_repair(line: str) -> str:
+    return line.replace(":,", ":null,")
+
+
+SINGLE_PASS_REPAIRS = {
+    "patients": single_pass_patient_repair,
+    "allergies": single_pass_allergy_repair,
+}
+
+
+def run(decoder: LineDecoder, lines) -> tuple:
+    decoded = 0
+    start = time.perf_counter()
+    for line in lines:
+        try:
+            decoder.decode(line)
+            decoded += 1
+        except ValueError:
+            pass
+    return decoded, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--copies", type=int, default=500, help="How many times the sample files are replicated")
+    args = parser.parse_args()
+
+    for path, table, _, repair in SOURCES:
+        with open(os.path.join(DATA_DIR, os.path.basename(path)), "r") as f:
+            lines = [line.strip() for line in f if line.strip()] * args.copies
+        assert all(repair(line) == SINGLE_PASS_REPAIRS[table](line) for line in lines)
+        for repair_name, repair_fn in (("replace", repair), ("single-pass", SINGLE_PASS_REPAIRS[table])):
+            for backend in JSON_BACKENDS:
+                decoded, elapsed = run(LineDecoder(repair_fn, backend), lines)
+                print(f"{table:<10} {repair_name:<12} {backend:<7} {decoded:>9} lines {elapsed:>8.3f}s {len(lines) / elapsed:>12.0f} lines/s")
+
+
+if __name__ == "__main__":
+    main()
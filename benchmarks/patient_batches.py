@@ -0,0 +1,103 @@
+"""
+Measure the patient batch write latency as a function of the batch size.
+
+For every batch size, that many synthetic patients (copies of the sample patients
+with new ids) are prepared, then written twice with ``PatientProcessor.write_patients``
+inside a transaction that is rolled back: once as new rows, then again once they
+all exist, so every row goes through the conflict handling. With ``--legacy`` the
+existence queries of the previous deduplication, one OR of ANDs per table, are
+timed as well on the existing rows, up to ``--legacy-max`` patients.
+
+Usage (from the repository root, with the refined database reachable):
+    PYTHONPATH=src python3 benchmarks/patient_batches.py --sizes 1000 5000 10000 50000 --legacy
+"""
+import argparse
+import json
+import os
+import time
+import uuid
+
+from sqlalchemy import and_, or_
+
+from models.raw_patient import RawPatient
+from models.tables.patient_refined_tables import Address, PatientName, Telecom
+from processing.refining_patients import (
+    ADDRESS_COLUMNS, PATIENT_NAME_COLUMNS, TELECOM_COLUMNS, PatientProcessor, PreparedPatients
+)
+from repository.refined_db import sessionmaker as refined_sessionmaker
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+
+
+def synthetic_patients(size: int) -> PreparedPatients:
+    samples = []
+    with open(os.path.join(DATA_DIR, "Patient.ndjson")) as f:
+        for line in f:
+            try:
+                samples.append(RawPatient(**json.loads(line)).model_dump())
+            except Exception:
+                continue
+    patients = [
+        RawPatient(**{**samples[i % len(samples)], "id": str(uuid.uuid4())})
+        for i in range(size)
+    ]
+    return PatientProcessor.prepare_patients(patients)
+
+
+def legacy_existence_queries(session, prepared: PreparedPatients) -> None:
+    """
+    The existence queries of the deduplication replaced by the unique indexes.
+    """
+    name_filters = [
+        and_(*(getattr(PatientName, column) == value for column, value in zip(PATIENT_NAME_COLUMNS, n)))
+        for n in prepared.names
+    ]
+    address_filters = [
+        and_(*(getattr(Address, column) == value for column, value in zip(ADDRESS_COLUMNS, a)))
+        for a in prepared.addresses
+    ]
+    telecom_filters = [
+        and_(*(getattr(Telecom, column) == value for column, value in zip(TELECOM_COLUMNS, t)))
+        for t in prepared.telecoms
+    ]
+    session.query(PatientName.id).filter(or_(*name_filters)).all()
+    session.query(Address.id).filter(or_(*address_filters)).all()
+    session.query(Telecom.id).filter(or_(*telecom_filters)).all()
+
+
+def timed(function, *args) -> float:
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 10000, 25000, 50000])
+    parser.add_argument("--legacy", action="store_true", help="Time the previous OR-of-AND existence queries too")
+    parser.add_argument("--legacy-max", type=int, default=10000)
+    args = parser.parse_args()
+
+    columns = ["new", "existing"] + (["legacy lookup"] if args.legacy else [])
+    print(f"{'batch':>8} " + " ".join(f"{column + ' ms/1k':>20}" for column in columns))
+    for size in args.sizes:
+        prepared = synthetic_patients(size)
+        session = refined_sessionmaker.session()
+        try:
+            timings = [
+                timed(PatientProcessor.write_patients, session, prepared),
+                timed(PatientProcessor.write_patients, session, prepared),
+            ]
+            if args.legacy:
+                timings.append(timed(legacy_existence_queries, session, prepared) if size <= args.legacy_max else None)
+        finally:
+            session.rollback()
+            session.close()
+        print(f"{size:>8} " + " ".join(
+            f"{'-':>20}" if seconds is None else f"{seconds * 1000 / (size / 1000):>20.1f}"
+            for seconds in timings
+        ))
+
+
+if __name__ == "__main__":
+    main()
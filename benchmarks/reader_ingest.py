@@ -0,0 +1,65 @@
+"""
+Compare the reader ingestion modes against the raw database.
+
+The sample NDJSON files are replicated ``--copies`` times into a temporary file,
+then loaded with every reader mode. Each run happens inside a transaction that
+is rolled back, so the raw tables are left untouched.
+
+Usage (from the repository root, with the raw database reachable):
+    PYTHONPATH=src python3 benchmarks/reader_ingest.py --copies 200
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from ingestion.decoding import LineDecoder
+from reader import READER_MODES, SOURCES, connect_raw_db, create_raw_tables, store_file
+from settings import settings
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+
+
+def replicate(path: str, copies: int) -> str:
+    with open(path, "r") as f:
+        content = f.read()
+    if not content.endswith("\n"):
+        content += "\n"
+    fd, replicated = tempfile.mkstemp(suffix=".ndjson")
+    with os.fdopen(fd, "w") as out:
+        for _ in range(copies):
+            out.write(content)
+    return replicated
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--copies", type=int, default=100, help="How many times the sample files are replicated")
+    parser.add_argument("--modes", nargs="+", default=list(READER_MODES), choices=READER_MODES)
+    args = parser.parse_args()
+
+    conn = connect_raw_db()
+    conn.autocommit = False
+    try:
+        with conn.cursor() as cur:
+            create_raw_tables(cur)
+        conn.commit()
+        for path, table, label, repair in SOURCES:
+            decoder = LineDecoder(repair, settings.READER_JSON_BACKEND)
+            replicated = replicate(os.path.join(DATA_DIR, os.path.basename(path)), args.copies)
+            try:
+                for mode in args.modes:
+                    with conn.cursor() as cur:
+                        start = time.perf_counter()
+                        stored, malformed = store_file(cur, replicated, table, label, decoder, mode)
+                        elapsed = time.perf_counter() - start
+                    conn.rollback()
+                    print(f"{table:<10} {mode:<7} {stored:>9} rows {malformed:>7} malformed {elapsed:>8.3f}s {stored / elapsed:>12.0f} rows/s")
+            finally:
+                os.remove(replicated)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
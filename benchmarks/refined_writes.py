@@ -0,0 +1,65 @@
+"""
+Compare the refined write paths, table by table.
+
+``--rows`` synthetic allergies and patients (copies of the sample resources with
+new ids) are prepared, then written with every write path of ``RefinedWriter``
+inside a transaction that is rolled back. The rows per second of every refined
+table are reported for each path. The allergy codes of the sample are upserted
+for good, as the handler does.
+
+Usage (from the repository root, with the refined database reachable):
+    PYTHONPATH=src python3 benchmarks/refined_writes.py --rows 50000
+"""
+import argparse
+import json
+import os
+import uuid
+
+from models.raw_allergy import RawAllergy
+from models.raw_patient import RawPatient
+from processing.code_cache import AllergyCodeCache
+from processing.refined_writer import WRITE_PATHS, RefinedWriter
+from processing.refining_allergy import AllergyProcessor
+from processing.refining_patients import PatientProcessor
+from repository.refined_db import sessionmaker as refined_sessionmaker
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+
+
+def synthetic(path: str, model, rows: int) -> list:
+    samples = []
+    with open(os.path.join(DATA_DIR, path)) as f:
+        for line in f:
+            try:
+                samples.append(model(**json.loads(line)).model_dump())
+            except Exception:
+                continue
+    return [model(**{**samples[i % len(samples)], "id": str(uuid.uuid4())}) for i in range(rows)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--paths", nargs="+", default=list(WRITE_PATHS), choices=WRITE_PATHS)
+    args = parser.parse_args()
+
+    allergies = AllergyProcessor.prepare_allergies(synthetic("AllergyIntolerance.ndjson", RawAllergy, args.rows))
+    patients = PatientProcessor.prepare_patients(synthetic("Patient.ndjson", RawPatient, args.rows))
+    code_cache = AllergyCodeCache()
+
+    for path in args.paths:
+        writer = RefinedWriter(path, page_size=args.page_size)
+        session = refined_sessionmaker.session()
+        try:
+            AllergyProcessor.write_allergies(session, allergies, code_cache, writer)
+            PatientProcessor.write_patients(session, patients, writer=writer)
+        finally:
+            session.rollback()
+            session.close()
+        for line in writer.report():
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+"""
+Time the stages of the pipeline one by one on a synthetic corpus, and write a JSON report.
+
+A corpus of ``--lines`` lines is generated with ``fhir_generator`` (``--malformed-rate``,
+``--duplicate-ratio``, ``--seed``), then every stage of ``--stages`` is timed on its own:
+
+- ``read``: ``reader.read_and_store_data`` loading both files into the raw database.
+  The rows are committed, run it against a scratch database.
+- ``validate``: ``RawPatient``/``RawAllergy`` validation of the decoded lines.
+- ``process_patients``: ``PatientProcessor.process_patients`` by ``--batch-size``
+  patients on the refined database, in a transaction rolled back at the end.
+- ``process_allergies``: ``AllergyProcessor.process_allergies``, the same way.
+
+The stages but ``read`` run ``--repeat`` times and keep their fastest run. With
+``--embedded`` the processing stages run on an in-memory SQLite database instead of
+the refined database (see ``repository.backends``). With ``--no-db`` the stages
+needing a database server are left out. The report, written to
+``--report``, holds the commit, the corpus and, for every stage, the records in and
+out, the seconds and the records per second. Given the report of another commit
+with ``--baseline``, the records per second of both are compared.
+
+Usage (from the repository root, with the databases reachable):
+    PYTHONPATH=src python3 benchmarks/throughput.py --lines 100000 --report throughput.json
+    PYTHONPATH=src python3 benchmarks/throughput.py --no-db --baseline throughput.json
+    PYTHONPATH=src python3 benchmarks/throughput.py --no-db --embedded
+"""
+import argparse
+import json
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from fhir_generator import FhirGenerator
+from ingestion.decoding import LineDecoder, repair_allergy_line, repair_patient_line
+from logs import configure_logging
+from models.raw_allergy import RawAllergy
+from models.tables import RefinedBase
+from models.raw_patient import RawPatient
+from processing.code_cache import AllergyCodeCache
+from processing.refining_allergy import AllergyProcessor
+from processing.refining_patients import PatientProcessor
+from repository.backends import embedded_database
+from repository.database import SessionDatabase
+
+STAGES = ("read", "validate", "process_patients", "process_allergies")
+DB_STAGES = ("read", "process_patients", "process_allergies")
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def decoded(path: str, repair) -> List[dict]:
+    decoder = LineDecoder(repair)
+    documents = []
+    with open(path) as f:
+        for line in f:
+            try:
+                documents.append(decoder.decode(line.strip())[1])
+            except Exception:
+                continue
+    return documents
+
+
+def validated(documents: List[dict], model) -> list:
+    records = []
+    for document in documents:
+        try:
+            records.append(model.model_validate(document))
+        except Exception:
+            continue
+    return records
+
+
+def batches(records: list, size: int):
+    for start in range(0, len(records), size):
+        yield records[start:start + size]
+
+
+def timed(run: Callable[[], Optional[int]], repeat: int) -> Tuple[float, int]:
+    """
+    :return: Seconds of the fastest run, and the records out of the stage.
+    """
+    best, out = float("inf"), 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = run()
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def refined_database(embedded: bool) -> SessionDatabase:
+    if embedded:
+        return embedded_database(RefinedBase)
+    from repository.refined_db import sessionmaker as refined_sessionmaker
+
+    return refined_sessionmaker
+
+
+def process_patients(database: SessionDatabase, records: List[RawPatient], batch_size: int) -> int:
+    session = database.session()
+    refined = 0
+    try:
+        for batch in batches(records, batch_size):
+            _, failures = PatientProcessor.process_patients(session, batch)
+            refined += len(batch) - len(failures["failed_patients"])
+    finally:
+        session.rollback()
+        session.close()
+    return refined
+
+
+def process_allergies(database: SessionDatabase, records: List[RawAllergy], batch_size: int) -> int:
+    session = database.session()
+    # The codes inserted are rolled back, so are their cached ids
+    code_cache = AllergyCodeCache()
+    refined = 0
+    try:
+        for batch in batches(records, batch_size):
+            _, failures = AllergyProcessor.process_allergies(session, batch, code_cache)
+            refined += len(batch) - len(failures["failed_allergy_coding_schema"]) - len(failures["failed_allergy_event_schema"])
+    finally:
+        session.rollback()
+        session.close()
+    return refined
+
+
+def read(patient_path: str, allergy_path: str) -> None:
+    from reader import read_and_store_data
+
+    read_and_store_data(workers=1, sources=[
+        (patient_path, 'patients', 'patient', repair_patient_line),
+        (allergy_path, 'allergies', 'allergy', repair_allergy_line),
+    ])
+
+
+def compare(report: dict, baseline: dict) -> None:
+    print(f"Compared to {baseline.get('commit') or 'the baseline'} ({baseline['corpus']['lines']} lines):")
+    for stage, result in report["stages"].items():
+        previous = baseline["stages"].get(stage)
+        if not previous:
+            continue
+        ratio = result["records_per_second"] / previous["records_per_second"]
+        print(f"{stage:<18} {previous['records_per_second']:>12.0f} -> {result['records_per_second']:>12.0f} records/s ({ratio:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, default=100000)
+    parser.add_argument("--malformed-rate", type=float, default=0.01)
+    parser.add_argument("--duplicate-ratio", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=STAGES)
+    parser.add_argument("--no-db", action="store_true", help="leave out the stages needing a database server")
+    parser.add_argument("--embedded", action="store_true", help="process on an in-memory SQLite database")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--report", help="path of the JSON report to write")
+    parser.add_argument("--baseline", help="JSON report of a previous run to compare with")
+    args = parser.parse_args()
+    db_stages = ("read",) if args.embedded else DB_STAGES
+    stages = [stage for stage in args.stages if not (args.no_db and stage in db_stages)]
+    # The per-file and per-batch lines of the stages would cut through the table
+    configure_logging("WARNING")
+
+    out_dir = tempfile.mkdtemp(prefix="fhir-")
+    try:
+        generator = FhirGenerator(malformed_rate=args.malformed_rate, duplicate_ratio=args.duplicate_ratio, seed=args.seed)
+        files = generator.write(out_dir, args.lines)
+        patients = decoded(files.patient_path, repair_patient_line)
+        allergies = decoded(files.allergy_path, repair_allergy_line)
+        patient_records = validated(patients, RawPatient)
+        allergy_records = validated(allergies, RawAllergy)
+
+        database = refined_database(args.embedded) if {"process_patients", "process_allergies"} & set(stages) else None
+        results: Dict[str, dict] = {}
+        for stage in stages:
+            if stage == "read":
+                records = files.patient_lines + files.allergy_lines
+                seconds, _ = timed(lambda: read(files.patient_path, files.allergy_path), 1)
+                # The lines the reader decodes are stored
+                out = len(patients) + len(allergies)
+            elif stage == "validate":
+                records = len(patients) + len(allergies)
+                seconds, out = timed(
+                    lambda: len(validated(patients, RawPatient)) + len(validated(allergies, RawAllergy)), args.repeat
+                )
+            elif stage == "process_patients":
+                records = len(patient_records)
+                seconds, out = timed(lambda: process_patients(database, patient_records, args.batch_size), args.repeat)
+            else:
+                records = len(allergy_records)
+                seconds, out = timed(lambda: process_allergies(database, allergy_records, args.batch_size), args.repeat)
+            results[stage] = {
+                "records_in": records,
+                "records_out": out,
+                "seconds": round(seconds, 6),
+                "records_per_second": round(records / seconds, 1) if seconds else None,
+            }
+            print(f"{stage:<18} {records:>9} in {out:>9} out {seconds:>9.3f}s {records / seconds:>12.0f} records/s")
+    finally:
+        shutil.rmtree(out_dir)
+
+    report = {
+        "commit": git_commit(),
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "corpus": {
+            "lines": args.lines,
+            "patients": files.patient_lines,
+            "allergies": files.allergy_lines,
+            "malformed": files.malformed,
+            "duplicates": files.duplicates,
+            "malformed_rate": args.malformed_rate,
+            "duplicate_ratio": args.duplicate_ratio,
+            "seed": args.seed,
+        },
+        "batch_size": args.batch_size,
+        "refined_backend": "sqlite" if args.embedded else "postgresql",
+        "repeat": args.repeat,
+        "stages": results,
+    }
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.report}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Report the CPU time the handler spends turning raw records into refined rows.
+
+``--records`` raw rows are made of copies of the sample resources and transformed
+with the handler transforms (``processing.raw_transform``), then with the flow they
+replaced, reproduced below: every raw row also validated as a ``Raw*Row``, the
+allergy coding validated twice, the type hints of the models resolved on every
+validation and the refined models copied into ORM instances. The CPU seconds per
+10k records of both flows are reported. No database is needed.
+
+Usage (from the repository root):
+    PYTHONPATH=src python3 benchmarks/transform_cpu.py --records 50000
+"""
+import argparse
+import json
+import os
+import time
+from datetime import datetime
+from uuid import UUID
+
+from ingestion.decoding import repair_allergy_line, repair_patient_line
+from models import validators
+from models.address import Address as AddressModel
+from models.allergy_code import AllergyCodeSchema
+from models.allergy_event import AllergyEventSchema
+from models.patient import Patient as PatientModel
+from models.patient_name import PatientName as PatientNameModel
+from models.raw_allergy import RawAllergy
+from models.raw_allergy_row import RawAllergyRow
+from models.raw_patient import RawPatient
+from models.raw_patient_row import RawPatientRow
+from models.tables.allergy_refined_tables import AllergyEvents
+from models.tables.patient_refined_tables import Address, Patient, PatientName, Telecom
+from models.telecom import Telecom as TelecomModel
+from processing.raw_transform import transform_allergy_rows, transform_patient_rows
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+
+
+def raw_rows(name: str, repair, records: int) -> list:
+    documents = []
+    with open(os.path.join(DATA_DIR, name)) as f:
+        for line in f:
+            try:
+                documents.append(json.loads(repair(line.strip())))
+            except ValueError:
+                continue
+    return [
+        {'id': i + 1, 'data': documents[i % len(documents)], 'ack': False, 'created_at': datetime.now()}
+        for i in range(records)
+    ]
+
+
+def legacy_allergies(rows: list) -> None:
+    allergies = []
+    for row in rows:
+        try:
+            raw_allergy = RawAllergy(**row['data'])
+            RawAllergyRow(id=row['id'], data=raw_allergy, ack=row['ack'], created_at=row['created_at'])
+            allergies.append(raw_allergy)
+        except Exception:
+            continue
+    for allergy in allergies:
+        try:
+            AllergyCodeSchema(**allergy.code.coding[0].model_dump())
+        except Exception:
+            continue
+    for allergy in allergies:
+        try:
+            AllergyCodeSchema(**allergy.code.coding[0].model_dump())
+            event = AllergyEventSchema(
+                uuid=UUID(allergy.id), patient_uuid=allergy.patient.reference, category=allergy.category,
+                criticality=allergy.criticality, code_id=1, recorded_date=allergy.recordedDate
+            )
+        except Exception:
+            continue
+        AllergyEvents(**event.model_dump(), created_at=datetime.now())
+
+
+def legacy_patients(rows: list) -> None:
+    for row in rows:
+        try:
+            patient = RawPatient(**row['data'])
+            RawPatientRow(id=row['id'], data=patient, ack=row['ack'], created_at=row['created_at'])
+            patient_uuid = UUID(patient.id)
+            names = [
+                PatientNameModel(patient_uuid=patient_uuid, use=n.use, family=n.family, given=n.given, prefix=n.prefix if n.prefix else None)
+                for n in patient.name
+            ]
+            addresses = [
+                AddressModel(patient_uuid=patient_uuid, line=a.line, city=a.city, state=a.state, postal_code=a.postalCode, country=a.country)
+                for a in patient.address
+            ]
+            telecoms = [
+                TelecomModel(patient_uuid=patient_uuid, system=t.system, value=t.value, use=t.use)
+                for t in patient.telecom
+            ]
+            schema = PatientModel(uuid=patient_uuid, birth_date=patient.birthDate, gender=patient.gender)
+        except Exception:
+            continue
+        Patient(uuid=schema.uuid, birth_date=schema.birth_date, gender=schema.gender)
+        for n in names:
+            PatientName(patient_uuid=n.patient_uuid, use=n.use, family=n.family, given=n.given, prefix=n.prefix)
+        for a in addresses:
+            Address(patient_uuid=a.patient_uuid, line=a.full_line_str, city=a.city, state=a.state, postal_code=a.postal_code, country=a.country)
+        for t in telecoms:
+            Telecom(patient_uuid=t.patient_uuid, system=t.system, value=t.value, use=t.use)
+
+
+def cpu_seconds(function, rows: list) -> float:
+    start = time.process_time()
+    function(rows)
+    return time.process_time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=10000)
+    args = parser.parse_args()
+
+    cached_optional_fields = validators.optional_fields
+    print(f"{'entity':<10} {'legacy s/10k':>14} {'transform s/10k':>16} {'speedup':>8}")
+    for entity, name, repair, legacy, transform in (
+        ("allergies", "AllergyIntolerance.ndjson", repair_allergy_line, legacy_allergies, transform_allergy_rows),
+        ("patients", "Patient.ndjson", repair_patient_line, legacy_patients, transform_patient_rows),
+    ):
+        rows = raw_rows(name, repair, args.records)
+        # The validators used to resolve the type hints on every call
+        validators.optional_fields = cached_optional_fields.__wrapped__
+        try:
+            legacy_seconds = cpu_seconds(legacy, rows)
+        finally:
+            validators.optional_fields = cached_optional_fields
+        transform_seconds = cpu_seconds(transform, rows)
+        scale = 10000 / args.records
+        print(
+            f"{entity:<10} {legacy_seconds * scale:>14.3f} {transform_seconds * scale:>16.3f} "
+            f"{legacy_seconds / transform_seconds:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
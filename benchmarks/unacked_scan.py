@@ -0,0 +1,90 @@
+"""
+Show the cost of the handler scan for unacked rows on a synthetic raw table.
+
+A ``bench_allergies`` table shaped like the raw ``allergies`` table is filled
+with ``--rows`` rows spread over a year, of which ``--unacked`` are still to be
+refined. The handler query is explained (ANALYZE, BUFFERS) on the plain table,
+then again once the partial index used by the raw schema is created.
+With ``--partitioned`` the table is range-partitioned by ``created_at`` month.
+The table is dropped at the end unless ``--keep`` is given.
+
+Usage (from the repository root, with the raw database reachable):
+    PYTHONPATH=src python3 benchmarks/unacked_scan.py --rows 10000000 --unacked 5000
+"""
+import argparse
+import time
+from datetime import date
+
+from reader import connect_raw_db
+from repository.raw_schema import create_raw_table, ensure_partitions
+
+TABLE = "bench_allergies"
+QUERY = f"SELECT id, data, ack, created_at FROM {TABLE} WHERE ack = false ORDER BY id ASC"
+
+
+def explain(cur, title: str) -> None:
+    cur.execute(f"EXPLAIN (ANALYZE, BUFFERS) {QUERY};")
+    print(f"--- {title}")
+    for (line,) in cur.fetchall():
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--unacked", type=int, default=5000, help="How many of the newest rows are not acked")
+    parser.add_argument("--partitioned", action="store_true")
+    parser.add_argument("--keep", action="store_true", help="Keep the synthetic table")
+    args = parser.parse_args()
+
+    conn = connect_raw_db()
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {TABLE} CASCADE;")
+            create_raw_table(cur, TABLE, partitioned=args.partitioned)
+            # The index is created by the raw schema, drop it to measure the scan without it
+            cur.execute(f"DROP INDEX IF EXISTS ix_{TABLE}_unacked;")
+            if args.partitioned:
+                for month in range(12):
+                    ensure_partitions(cur, TABLE, date(2024 + month // 12, month % 12 + 1, 1), months_ahead=0)
+
+            start = time.perf_counter()
+            cur.execute(f'''
+                INSERT INTO {TABLE} (data, ack, created_at)
+                SELECT
+                    jsonb_build_object(
+                        'resourceType', 'AllergyIntolerance',
+                        'id', md5(i::text),
+                        'criticality', 'low',
+                        'code', jsonb_build_object('text', repeat('x', 200))
+                    ),
+                    i <= %s - %s,
+                    timestamp '2024-01-01' + (i::float / %s) * interval '365 days'
+                FROM generate_series(1, %s) AS i;
+            ''', [args.rows, args.unacked, args.rows, args.rows])
+            cur.execute(f"VACUUM ANALYZE {TABLE};")
+            print(f"Loaded {args.rows} rows ({args.unacked} unacked) in {time.perf_counter() - start:.1f}s")
+
+            explain(cur, "without partial index")
+            start = time.perf_counter()
+            cur.execute(f"CREATE INDEX ix_{TABLE}_unacked ON {TABLE} (id) WHERE ack = false;")
+            cur.execute(f"ANALYZE {TABLE};")
+            print(f"Partial index created in {time.perf_counter() - start:.1f}s")
+            explain(cur, "with partial index")
+            # A partitioned index has no storage of its own, its size is the one of the partition indexes
+            cur.execute(
+                "SELECT pg_size_pretty(pg_relation_size(%s::regclass) + COALESCE(SUM(pg_relation_size(inhrelid)), 0)) "
+                "FROM pg_inherits WHERE inhparent = %s::regclass;",
+                [f"ix_{TABLE}_unacked", f"ix_{TABLE}_unacked"]
+            )
+            print(f"Partial index size: {cur.fetchone()[0]}")
+
+            if not args.keep:
+                cur.execute(f"DROP TABLE {TABLE} CASCADE;")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,133 +1,454 @@
 
+import time
+# Taken before the other imports, to time them
+IMPORT_STARTED = time.perf_counter()
 import os
 import json
-import psycopg2
-import psycopg2.extras
+import asyncio
+import logging
+import resource
+import socket
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+from typing import Dict, Iterator, List, Tuple
 
-from models.raw_patient_row import RawPatientRow
-from models.raw_patient import RawPatient
-from models.raw_allergy_row import RawAllergyRow
-from models.raw_allergy import RawAllergy
+from processing.batch_controller import BatchSizeController
+from processing.change_detection import ResourceHashStore
+from processing.code_cache import AllergyCodeCache
+from processing.dead_letters import DeadLetterQueue
+from processing.async_pipeline import AsyncBatchPipeline
+from processing.pipeline import BatchPipeline
+from processing.progress import ProgressTracker
+from processing.raw_fetcher import BatchSize, iter_claimed_batches, iter_unacked_batches
+from processing.raw_transform import TransformedBatch, transform_allergy_rows, transform_patient_rows
+from processing.refined_writer import RefinedWriter
 from processing.raw_updater import RawAllergyUpdater, RawPatientUpdater
 from processing.refining_allergy import AllergyProcessor
 from processing.refining_patients import PatientProcessor
-from repository.database import get_sync_session_context
+from models.tables.raw_table import RawAllergies, RawPatients
+from repository.refined_db import get_refined_db_session_context
 from repository.refined_db import sessionmaker as refined_sessionmaker
+from repository.raw_db import get_raw_db_connection_context, get_raw_db_session_context
 from repository.raw_db import sessionmaker as raw_sessionmaker
+from repository.raw_schema import create_dead_letter_table, create_progress_table, ensure_lease_columns
+from repository.refined_schema import ensure_natural_keys
 
+from logs import FailureLog, configure_logging
+from metrics import metrics
 from settings import settings
 
-def main():
-    raw_db_sessionmaker = raw_sessionmaker
-    refined_db_sessionmaker = refined_sessionmaker
-    # Connect to database
-    raw_conn = psycopg2.connect(
-        dbname=settings.RAW_DB_NAME,
-        user=settings.RAW_DB_USER,
-        password=settings.RAW_DB_PASSWORD,
-        host=settings.RAW_DB_HOST,
-        port=settings.RAW_DB_PORT
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
+
+CLAIM_MODES = ("keyset", "lease")
+EXECUTION_MODES = ("pipeline", "asyncio")
+PROGRESS_MODES = ("watermark", "ack")
+
+# Named, as the module runs as __main__
+log = logging.getLogger("handler")
+
+raw_allergy_updater = RawAllergyUpdater()
+allergy_processor = AllergyProcessor()
+raw_patient_updater = RawPatientUpdater()
+patient_processor = PatientProcessor()
+allergy_code_cache = AllergyCodeCache(max_size=settings.HANDLER_CODE_CACHE_SIZE)
+refined_writer = RefinedWriter(settings.HANDLER_WRITE_PATH)
+allergy_hashes = ResourceHashStore("AllergyIntolerance")
+patient_hashes = ResourceHashStore("Patient")
+allergy_dead_letters = DeadLetterQueue(
+    "allergies", RawAllergies, settings.HANDLER_DEAD_LETTER_ATTEMPTS, settings.HANDLER_DEAD_LETTER_RETRY_SECONDS
+)
+patient_dead_letters = DeadLetterQueue(
+    "patients", RawPatients, settings.HANDLER_DEAD_LETTER_ATTEMPTS, settings.HANDLER_DEAD_LETTER_RETRY_SECONDS
+)
+allergy_progress = ProgressTracker("allergies", settings.HANDLER_GAP_TIMEOUT_SECONDS)
+patient_progress = ProgressTracker("patients", settings.HANDLER_GAP_TIMEOUT_SECONDS)
+# Rejects of the whole run, by reason, logged at the end
+run_failures = {
+    "allergies": FailureLog(settings.LOG_FAILURE_SAMPLES),
+    "patients": FailureLog(settings.LOG_FAILURE_SAMPLES),
+}
+
+
+def select_changed_allergies(rows: List[dict]) -> Tuple[List[dict], List[int]]:
+    with get_refined_db_session_context() as refined_db:
+        changed, unchanged = allergy_hashes.select_changed(refined_db, rows)
+    metrics.inc("handler_rows_total", len(unchanged), entity="allergies", outcome="unchanged")
+    return changed, unchanged
+
+
+def select_changed_patients(rows: List[dict]) -> Tuple[List[dict], List[int]]:
+    with get_refined_db_session_context() as refined_db:
+        changed, unchanged = patient_hashes.select_changed(refined_db, rows)
+    metrics.inc("handler_rows_total", len(unchanged), entity="patients", outcome="unchanged")
+    return changed, unchanged
+
+
+def record_failures(
+    dead_letters: DeadLetterQueue, batch: TransformedBatch, ids_not_acked: Dict[str, str]
+) -> Dict[int, str]:
+    """
+    Count the failed attempt of every raw row of the batch rejected by the raw
+    validation or by the processors, in the dead letters.
+
+    :param ids_not_acked: Failure reason by resource id, from the processors.
+    :return: Failure reason by raw row id.
+    """
+    failures = dict(batch.rejected)
+    for row_id, resource_id in batch.row_ids:
+        if resource_id in ids_not_acked:
+            failures[row_id] = ids_not_acked[resource_id]
+    for reason in failures.values():
+        metrics.reject(dead_letters.source, reason)
+    if settings.HANDLER_DEAD_LETTER_ATTEMPTS <= 0 or not failures:
+        return failures
+    with get_raw_db_session_context() as raw_db:
+        quarantined = dead_letters.record(raw_db, failures)
+    if quarantined:
+        log.warning(
+            "Quarantined %d %s rows after %d failed attempts", quarantined, dead_letters.source, dead_letters.max_attempts
+        )
+    return failures
+
+
+def log_batch(source: str, refined: int, failures: Dict[int, str]) -> None:
+    """
+    Log a written batch in one line, its rejects counted by reason with a few examples.
+    """
+    if not failures:
+        log.info("%s batch: %d rows refined", source, refined)
+        return
+    batch_failures = FailureLog(settings.LOG_FAILURE_SAMPLES)
+    batch_failures.extend(failures.items())
+    log.warning(
+        "%s batch: %d rows refined, %d rejected: %s", source, refined, len(failures), batch_failures.summary(),
+        extra={"rejects": batch_failures.counts}
     )
-    raw_cur = raw_conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    raw_conn.autocommit = False
-
-    raw_allergy_updater = RawAllergyUpdater()
-    allergy_processor = AllergyProcessor()
-    raw_patient_updater = RawPatientUpdater()
-    patient_processor = PatientProcessor()
-
-    # Process allergies
-    raw_cur.execute('SELECT id, data, ack, created_at FROM allergies WHERE ack = false ORDER BY id ASC;')
-    allergies = raw_cur.fetchall()
-    if not allergies:
-        print("No new allergy data to process.")
-    batch_size = 1000  # TODO Define a batch size for processing
-    for offset in range(0, len(allergies), batch_size):
-        allergy_models_rows_batch = []
-        allergy_models_batch = []
-        for row in allergies[offset:offset + batch_size]:
-            try:
-                raw_allergy = RawAllergy(**row['data'])
-                raw_allergy_row = RawAllergyRow(
-                    id=row['id'],
-                    data=raw_allergy,
-                    ack=row['ack'],
-                    created_at=row['created_at']
-                )
-                allergy_models_batch.append(raw_allergy)
-                allergy_models_rows_batch.append(raw_allergy_row)
-                print(f"Processing allergy: {raw_allergy_row.id}")
-            except Exception as e:
-                print(f"Skipping malformed allergy {row['id']} row: {e}")
-                continue
-        
-        try:
-            with get_sync_session_context(raw_db_sessionmaker, refined_db_sessionmaker) as (raw_db, refined_db):
-                success, err = allergy_processor.process_allergies(refined_db,allergy_models_batch)
-                ids_not_acked = []
-                to_ack = []
-                if not success:
-                    print("Some data were malformed")
-                    for malformed_coding in err['failed_allergy_coding_schema']:
-                        ids_not_acked.append(malformed_coding[0])
-                    for malformed_event in err['failed_allergy_event_schema']:
-                        ids_not_acked.append(malformed_event[0])
-                for row in allergy_models_rows_batch:
-                    if row.data.id not in ids_not_acked:
-                        to_ack.append(row.id)  
-                raw_allergy_updater.batch_ack_allergies(raw_db, to_ack)
-        except Exception as e:
-            print(f"Batch processing failed from id {allergy_models_rows_batch[0].id} to id {allergy_models_rows_batch[len(allergy_models_rows_batch)-1].id}: {e}")
-                 
-    raw_cur.execute('SELECT id, data, ack, created_at FROM patients WHERE ack = false ORDER BY id ASC;')
-    patients = raw_cur.fetchall()
-    if not patients:
-        print("No new patient data to process.")
-    batch_size = 1000  # TODO Define a batch size for processing
-    for offset in range(0, len(patients), batch_size):
-        patient_models_rows_batch = []
-        patient_models_batch = []
-        for row in patients[offset:offset + batch_size]:
-            try:
-                raw_patient = RawPatient(**row['data'])
-                raw_patient_row = RawPatientRow(
-                    id=row['id'],
-                    data=raw_patient,
-                    ack=row['ack'],
-                    created_at=row['created_at']
-                )
-                patient_models_rows_batch.append(raw_patient_row)
-                patient_models_batch.append(raw_patient)
-                print(f"Processing patient: {raw_patient_row.id}")
-            except Exception as e:
-                print(f"Skipping malformed patient {row['id']} row: {e}")
-                continue
+    run_failures[source].merge(batch_failures)
+
+
+def write_allergy_batch(batch: TransformedBatch) -> List[int]:
+    """
+    Store a transformed allergy batch in the refined database.
+
+    :return: Ids of the raw rows to ack.
+    """
+    with get_refined_db_session_context() as refined_db:
+        success, err = allergy_processor.write_allergies(refined_db, batch.prepared, allergy_code_cache, refined_writer)
+        ids_not_acked = {}
+        if not success:
+            for malformed_coding in err['failed_allergy_coding_schema']:
+                ids_not_acked.setdefault(malformed_coding[0], malformed_coding[1])
+            for malformed_event in err['failed_allergy_event_schema']:
+                ids_not_acked.setdefault(malformed_event[0], malformed_event[1])
+        if settings.HANDLER_CHANGE_DETECTION:
+            allergy_hashes.record(refined_db, {
+                allergy_id: content_hash for allergy_id, content_hash in batch.hashes.items()
+                if allergy_id not in ids_not_acked
+            })
+    failures = record_failures(allergy_dead_letters, batch, ids_not_acked)
+    refined = [row_id for row_id, allergy_id in batch.row_ids if allergy_id not in ids_not_acked]
+    metrics.inc("handler_rows_total", len(refined), entity="allergies", outcome="refined")
+    log_batch("allergies", len(refined), failures)
+    return refined
+
+
+def write_patient_batch(batch: TransformedBatch) -> List[int]:
+    """
+    Store a transformed patient batch in the refined database.
+
+    :return: Ids of the raw rows to ack.
+    """
+    with get_refined_db_session_context() as refined_db:
+        success, err = patient_processor.write_patients(refined_db, batch.prepared, batch.replaced, refined_writer)
+        ids_not_acked = {}
+        if not success:
+            for malformed_patient in err['failed_patients']:
+                ids_not_acked.setdefault(malformed_patient[0], malformed_patient[1])
+            for malformed_name in err['failed_names']:
+                ids_not_acked.setdefault(malformed_name[0], malformed_name[1])
+            for malformed_address in err['failed_addresses']:
+                ids_not_acked.setdefault(malformed_address[0], malformed_address[1])
+            for malformed_telecom in err['failed_telecoms']:
+                ids_not_acked.setdefault(malformed_telecom[0], malformed_telecom[1])
+        if settings.HANDLER_CHANGE_DETECTION:
+            patient_hashes.record(refined_db, {
+                patient_id: content_hash for patient_id, content_hash in batch.hashes.items()
+                if patient_id not in ids_not_acked
+            })
+    failures = record_failures(patient_dead_letters, batch, ids_not_acked)
+    refined = [row_id for row_id, patient_id in batch.row_ids if patient_id not in ids_not_acked]
+    metrics.inc("handler_rows_total", len(refined), entity="patients", outcome="refined")
+    log_batch("patients", len(refined), failures)
+    return refined
+
+
+def ack_allergies(ids: List[int]) -> None:
+    with get_raw_db_session_context() as raw_db:
+        raw_allergy_updater.batch_ack_allergies(raw_db, ids)
+
+
+def ack_patients(ids: List[int]) -> None:
+    with get_raw_db_session_context() as raw_db:
+        raw_patient_updater.batch_ack_patients(raw_db, ids)
+
+
+def save_progress(progress: ProgressTracker, ids: List[int]) -> None:
+    """
+    End a batch of the watermark progress, saving the progress when it moved.
+    """
+    if progress.done(ids):
+        with metrics.time("handler_stage_seconds", entity=progress.source, stage="progress"):
+            with get_raw_db_session_context() as raw_db:
+                progress.save(raw_db)
+
+
+def save_gaps(*trackers: ProgressTracker) -> None:
+    """
+    Save the gaps met by the reads, so their wait goes on at the next run even when no
+    batch moved the progress.
+    """
+    for progress in trackers:
+        if progress.gaps_changed():
+            with get_raw_db_session_context() as raw_db:
+                progress.save(raw_db)
+
+
+def allergy_batch_done(ids: List[int]) -> None:
+    save_progress(allergy_progress, ids)
+
+
+def patient_batch_done(ids: List[int]) -> None:
+    save_progress(patient_progress, ids)
+
 
+def peak_memory_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def observed_batches(label: str, batches: Iterator[List[dict]], startup: Dict[str, float]) -> Iterator[List[dict]]:
+    """
+    Yield the batches, keeping in ``startup`` the seconds from the handler start to the
+    first batch read of ``label``, and counting the rows read in ``metrics``.
+    """
+    entity = label.lower()
+    for rows in batches:
+        startup.setdefault(label, time.perf_counter() - IMPORT_STARTED)
+        metrics.observe("handler_batch_rows", len(rows), entity=entity)
+        metrics.inc("handler_rows_total", len(rows), entity=entity, outcome="read")
+        yield rows
+
+
+def observe_stage(label: str, stage: str, seconds: float) -> None:
+    metrics.observe("handler_stage_seconds", seconds, entity=label.lower(), stage=stage)
+
+
+def startup_report(startup: Dict[str, float]) -> str:
+    parts = [f"imports {IMPORT_SECONDS:.2f}s"]
+    for database in (raw_sessionmaker, refined_sessionmaker):
+        if database.bootstrap_seconds is not None:
+            parts.append(f"{database.url.database} bootstrap {database.bootstrap_seconds:.2f}s")
+    parts.extend(f"first {label.lower()} batch after {seconds:.2f}s" for label, seconds in startup.items())
+    return "Startup: " + ", ".join(parts)
+
+
+def worker_id() -> str:
+    return settings.HANDLER_WORKER_ID or f"{socket.gethostname()}-{os.getpid()}"
+
+
+def batch_controller(label: str, min_size: int, max_size: int) -> BatchSizeController:
+    """
+    Batch sizes of an entity, starting at ``HANDLER_BATCH_SIZE`` and adapted within the
+    bounds of the entity. Fixed to ``HANDLER_BATCH_SIZE`` when ``HANDLER_BATCH_ADAPTIVE`` is off.
+    """
+    if not settings.HANDLER_BATCH_ADAPTIVE:
+        min_size = max_size = settings.HANDLER_BATCH_SIZE
+    return BatchSizeController(
+        label, min_size, max_size, settings.HANDLER_BATCH_TARGET_SECONDS, initial_size=settings.HANDLER_BATCH_SIZE
+    )
+
+
+def progress_mode() -> str:
+    """
+    The watermark progress is kept by a single handler, leased batches are acked.
+    """
+    if settings.HANDLER_CLAIM_MODE == "lease":
+        return "ack"
+    return settings.HANDLER_PROGRESS_MODE
+
+
+def iter_batches(raw_conn, table: str, mode: str, batch_size: BatchSize) -> Iterator[List[dict]]:
+    """
+    Batches of raw rows still to refine. In "keyset" mode the rows are read in id
+    order, for a single handler, after the high-water mark of the table or, with the
+    "ack" progress, among the unacked rows. In "lease" mode every batch is leased to
+    this worker, so several handlers can run side by side.
+    """
+    if mode == "lease":
+        return iter_claimed_batches(raw_conn, table, batch_size, worker_id(), settings.HANDLER_LEASE_SECONDS)
+    if progress_mode() == "watermark":
+        progress = allergy_progress if table == 'allergies' else patient_progress
+        return progress.batches(raw_conn, table, batch_size)
+    return iter_unacked_batches(raw_conn, table, batch_size)
+
+
+def entity_pipeline(label: str, pool, execution: str) -> Tuple[BatchPipeline, BatchSizeController]:
+    """
+    Pipeline refining the raw rows of an entity, "Allergies" or "Patients", with its
+    batch size controller.
+    """
+    if label == "Allergies":
+        steps = (transform_allergy_rows, write_allergy_batch, ack_allergies, select_changed_allergies)
+        bounds = (settings.HANDLER_ALLERGY_BATCH_MIN, settings.HANDLER_ALLERGY_BATCH_MAX)
+        progress, done = allergy_progress, allergy_batch_done
+    else:
+        steps = (transform_patient_rows, write_patient_batch, ack_patients, select_changed_patients)
+        bounds = (settings.HANDLER_PATIENT_BATCH_MIN, settings.HANDLER_PATIENT_BATCH_MAX)
+        progress, done = patient_progress, patient_batch_done
+    transform, write, ack, select = steps
+    if progress_mode() == "watermark":
+        # Acked rows are only marked, the progress is saved once per batch
+        ack = progress.ack
+    else:
+        done = None
+    controller = batch_controller(label, *bounds)
+    pipeline_class = AsyncBatchPipeline if execution == "asyncio" else BatchPipeline
+    pipeline = pipeline_class(
+        transform, write, ack,
+        pool=pool, workers=settings.HANDLER_TRANSFORM_WORKERS, depth=settings.HANDLER_PIPELINE_DEPTH,
+        select=select if settings.HANDLER_CHANGE_DETECTION else None,
+        controller=controller,
+        done=done,
+        observe=partial(observe_stage, label)
+    )
+    return pipeline, controller
+
+
+async def run_concurrently(pipelines: List[AsyncBatchPipeline], batches: List[Iterator[List[dict]]]) -> List[int]:
+    return list(await asyncio.gather(*(
+        pipeline.run_async(entity_batches) for pipeline, entity_batches in zip(pipelines, batches)
+    )))
+
+
+def main():
+    configure_logging(settings.LOG_LEVEL, settings.LOG_FORMAT)
+    mode = settings.HANDLER_CLAIM_MODE
+    if mode not in CLAIM_MODES:
+        raise ValueError(f"Unknown handler claim mode {mode!r}, expected one of {CLAIM_MODES}")
+    execution = settings.HANDLER_EXECUTION_MODE
+    if execution not in EXECUTION_MODES:
+        raise ValueError(f"Unknown handler execution mode {execution!r}, expected one of {EXECUTION_MODES}")
+    if settings.HANDLER_PROGRESS_MODE not in PROGRESS_MODES:
+        raise ValueError(f"Unknown handler progress mode {settings.HANDLER_PROGRESS_MODE!r}, expected one of {PROGRESS_MODES}")
+
+    if settings.METRICS_HTTP_PORT:
+        metrics.serve(settings.METRICS_HTTP_PORT, settings.METRICS_HTTP_HOST)
+        log.info("Serving metrics on http://%s:%d/metrics", settings.METRICS_HTTP_HOST, settings.METRICS_HTTP_PORT)
+    try:
+        refine(mode, execution)
+    finally:
+        metrics.export(settings.METRICS_PROMETHEUS_FILE, settings.METRICS_SUMMARY_FILE)
+        metrics.stop()
+
+
+def refine(mode: str, execution: str) -> None:
+    """
+    Refine the raw rows still to refine, see ``main``.
+    """
+    # Explicit, so the time it takes is reported apart from the first batches
+    raw_sessionmaker.bootstrap()
+    refined_sessionmaker.bootstrap()
+    startup: Dict[str, float] = {}
+    with ExitStack() as connections:
+        # Raw connections of the pool, in autocommit: only short statements, a transaction
+        # spanning every batch would hold back vacuum
+        raw_conn = connections.enter_context(get_raw_db_connection_context())
+        # In asyncio mode the entities are read at the same time, each on its own connection
+        patient_raw_conn = (
+            connections.enter_context(get_raw_db_connection_context()) if execution == "asyncio" else raw_conn
+        )
+
+        with raw_conn.cursor() as raw_cur:
+            create_dead_letter_table(raw_cur)
+            create_progress_table(raw_cur)
+            if mode == "lease":
+                for table in ('allergies', 'patients'):
+                    ensure_lease_columns(raw_cur, table)
+        if mode == "lease":
+            log.info("Claiming batches as worker %s", worker_id())
+        if progress_mode() == "watermark":
+            with get_raw_db_session_context() as raw_db:
+                allergy_progress.load(raw_db, RawAllergies)
+                patient_progress.load(raw_db, RawPatients)
+
+        with get_refined_db_session_context() as refined_db:
+            ensure_natural_keys(refined_db)
+            log.info("Preloaded %d allergy codes", allergy_code_cache.preload(refined_db))
+
+        workers = settings.HANDLER_TRANSFORM_WORKERS
+        pool = None
+        if workers > 0:
+            pool = ProcessPoolExecutor(max_workers=workers)
+            # Fork the workers now, before the pipeline starts its ack thread. They only
+            # run the transforms and never use the connections inherited from the fork.
+            pool.submit(int).result()
         try:
-            with get_sync_session_context(raw_db_sessionmaker, refined_db_sessionmaker) as (raw_db, refined_db):
-                success, err = patient_processor.process_patients(refined_db, patient_models_batch)
-                ids_not_acked = []
-                to_ack = []
-                if not success:
-                    print("Some data were malformed")
-                    for malformed_patient in err['failed_patients']:
-                        ids_not_acked.append(malformed_patient[0])
-                    for malformed_name in err['failed_names']:
-                        ids_not_acked.append(malformed_name[0])
-                    for malformed_address in err['failed_addresses']:
-                        ids_not_acked.append(malformed_address[0])
-                    for malformed_telecom in err['failed_telecoms']:
-                        ids_not_acked.append(malformed_telecom[0])
-                for row in patient_models_rows_batch:
-                    if row.data.id not in ids_not_acked:
-                        to_ack.append(row.id)
-                raw_patient_updater.batch_ack_patients(raw_db, to_ack)
-        except Exception as e:
-            print(f"Batch processing failed from id {patient_models_rows_batch[0].id} to id {patient_models_rows_batch[len(patient_models_rows_batch)-1].id}: {e}")
-        raw_cur.close()
-        raw_conn.close()
-    
+            allergy_pipeline, allergy_controller = entity_pipeline("Allergies", pool, execution)
+            patient_pipeline, patient_controller = entity_pipeline("Patients", pool, execution)
+            allergy_batches = observed_batches(
+                "Allergies", iter_batches(raw_conn, 'allergies', mode, allergy_controller.next_size), startup
+            )
+            patient_batches = observed_batches(
+                "Patients", iter_batches(patient_raw_conn, 'patients', mode, patient_controller.next_size), startup
+            )
+            if execution == "asyncio":
+                # Allergies and patients share no refined table, their pipelines run side by side
+                allergies_read, patients_read = asyncio.run(run_concurrently(
+                    [allergy_pipeline, patient_pipeline], [allergy_batches, patient_batches]
+                ))
+            else:
+                allergies_read = allergy_pipeline.run(allergy_batches)
+                patients_read = patient_pipeline.run(patient_batches)
+            if progress_mode() == "watermark":
+                save_gaps(allergy_progress, patient_progress)
+
+            if not allergies_read:
+                log.info("No new allergy data to process.")
+            else:
+                log.info(allergy_pipeline.report("Allergies"))
+                log.info(allergy_controller.report())
+                log.info(allergy_code_cache.report())
+                log.info(allergy_dead_letters.report())
+                if progress_mode() == "watermark":
+                    log.info(allergy_progress.report())
+                if settings.HANDLER_CHANGE_DETECTION:
+                    log.info(allergy_hashes.report())
+
+            if not patients_read:
+                log.info("No new patient data to process.")
+            else:
+                log.info(patient_pipeline.report("Patients"))
+                log.info(patient_controller.report())
+                log.info(patient_dead_letters.report())
+                if progress_mode() == "watermark":
+                    log.info(patient_progress.report())
+                if settings.HANDLER_CHANGE_DETECTION:
+                    log.info(patient_hashes.report())
+            for source, failures in run_failures.items():
+                if failures:
+                    log.warning("%d %s rows rejected: %s", len(failures), source, failures.summary())
+        finally:
+            if pool:
+                pool.shutdown()
+    for line in refined_writer.report():
+        log.info(line)
+    log.info(startup_report(startup))
+    log.info(raw_sessionmaker.report())
+    log.info(refined_sessionmaker.report())
+    log.info("Peak memory: %.1f MB", peak_memory_mb())
+
 
 if __name__ == '__main__':
     main()
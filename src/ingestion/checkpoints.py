@@ -0,0 +1,184 @@
+import hashlib
+import logging
+import os
+from datetime import datetime
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+from ingestion.sources import UNTIL_EOF, detect_compression
+
+log = logging.getLogger(__name__)
+
+HEAD_BYTES = 64 * 1024
+# Bytes hashed before the committed offset of a shard, about the last lines stored
+COMMITTED_BYTES = 4096
+
+
+class FileIdentity(NamedTuple):
+    path: str
+    size: int
+    mtime: float
+    head_bytes: int
+    head_hash: str
+    compression: Optional[str] = None
+
+
+class Checkpoint(NamedTuple):
+    start: int
+    end: int
+    committed_offset: int
+
+    @property
+    def done(self) -> bool:
+        return self.committed_offset >= self.end
+
+
+def hash_head(path: str, head_bytes: int) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read(head_bytes)).hexdigest()
+
+
+def hash_committed(path: str, start: int, offset: int) -> Optional[str]:
+    """
+    Hash of the last ``COMMITTED_BYTES`` bytes of the shard starting at ``start``
+    before ``offset``, to check on resume that the bytes already stored did not change.
+    None for a compressed file, whose offsets count decompressed bytes.
+    """
+    if detect_compression(path):
+        return None
+    begin = max(start, offset - COMMITTED_BYTES)
+    with open(path, 'rb') as f:
+        f.seek(begin)
+        return hashlib.sha256(f.read(offset - begin)).hexdigest()
+
+
+def file_identity(path: str, head_bytes: int = HEAD_BYTES) -> FileIdentity:
+    stat = os.stat(path)
+    head_bytes = min(head_bytes, stat.st_size)
+    return FileIdentity(
+        path,
+        stat.st_size,
+        stat.st_mtime,
+        head_bytes,
+        hash_head(path, head_bytes),
+        detect_compression(path) if stat.st_size else None
+    )
+
+
+def create_checkpoint_table(cur) -> None:
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS ingest_checkpoints (
+            file_path TEXT NOT NULL,
+            shard_start BIGINT NOT NULL,
+            shard_end BIGINT NOT NULL,
+            committed_offset BIGINT NOT NULL,
+            file_size BIGINT NOT NULL,
+            file_mtime DOUBLE PRECISION NOT NULL,
+            head_bytes INTEGER NOT NULL,
+            head_hash TEXT NOT NULL,
+            updated_at TIMESTAMP NOT NULL,
+            committed_hash TEXT,
+            PRIMARY KEY (file_path, shard_start)
+        );
+    ''')
+    # Tables created before the committed bytes were hashed
+    cur.execute('ALTER TABLE ingest_checkpoints ADD COLUMN IF NOT EXISTS committed_hash TEXT;')
+    log.info("Ingest checkpoints table created or already exists.")
+
+
+def resume_plan(
+    cur,
+    identity: FileIdentity,
+    plan: Callable[[int, int], List[Tuple[int, int]]]
+) -> List[Checkpoint]:
+    """
+    Return the checkpoints of a file, creating the ones for the bytes not planned yet.
+
+    Checkpoints recorded for the same path are reused when the file still starts with
+    the bytes hashed at the time, did not shrink, and every shard still ends its
+    committed bytes with the bytes hashed when they were stored: such a file is the
+    same one, possibly with lines appended since. A new export written to the same
+    path, repeating the first resources of the previous one, fails the last check.
+    Otherwise the file is considered new and its previous checkpoints are dropped.
+    Compressed files are read as one stream, so they are only reused while their size
+    and modification time are unchanged.
+
+    :param cur: Cursor on the raw database, the caller commits.
+    :param identity: Current identity of the file.
+    :param plan: Function splitting the [start, end) bytes not planned yet into ranges.
+    :return: Checkpoints covering the whole file, ordered by start offset.
+    """
+    cur.execute(
+        'SELECT shard_start, shard_end, committed_offset, head_bytes, head_hash, file_size, file_mtime, committed_hash '
+        'FROM ingest_checkpoints WHERE file_path = %s ORDER BY shard_start;',
+        [identity.path]
+    )
+    rows = cur.fetchall()
+    if rows:
+        head_bytes, head_hash, file_size, file_mtime = rows[0][3], rows[0][4], rows[0][5], rows[0][6]
+        planned_until = max(row[1] for row in rows)
+        if identity.compression:
+            size_matches = identity.size == file_size and identity.mtime == file_mtime
+        else:
+            size_matches = identity.size >= planned_until
+        same_file = (
+            size_matches
+            and identity.size >= head_bytes
+            and (head_bytes == identity.head_bytes and head_hash == identity.head_hash
+                 or hash_head(identity.path, head_bytes) == head_hash)
+            and (identity.compression is not None or all(
+                row[7] is not None and hash_committed(identity.path, row[0], row[2]) == row[7] for row in rows
+            ))
+        )
+        if not same_file:
+            log.info("%s changed since it was last read, loading it from the beginning.", identity.path)
+            cur.execute('DELETE FROM ingest_checkpoints WHERE file_path = %s;', [identity.path])
+            rows = []
+
+    checkpoints = [Checkpoint(row[0], row[1], row[2]) for row in rows]
+    planned_until = checkpoints[-1].end if checkpoints else 0
+    size = UNTIL_EOF if identity.compression else identity.size
+    if size > planned_until:
+        head_bytes, head_hash = (rows[0][3], rows[0][4]) if rows else (identity.head_bytes, identity.head_hash)
+        for start, end in plan(planned_until, size):
+            cur.execute(
+                'INSERT INTO ingest_checkpoints '
+                '(file_path, shard_start, shard_end, committed_offset, file_size, file_mtime, head_bytes, head_hash, '
+                'updated_at, committed_hash) '
+                'VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s);',
+                [identity.path, start, end, start, identity.size, identity.mtime, head_bytes, head_hash, datetime.now(),
+                 hash_committed(identity.path, start, start)]
+            )
+            checkpoints.append(Checkpoint(start, end, start))
+        cur.execute(
+            'UPDATE ingest_checkpoints SET file_size = %s, file_mtime = %s WHERE file_path = %s;',
+            [identity.size, identity.mtime, identity.path]
+        )
+    return checkpoints
+
+
+def open_checkpoint(cur, identity: FileIdentity, start: int) -> Checkpoint:
+    """
+    Create, if missing, an empty checkpoint at ``start``. Used when following a file,
+    where the last checkpoint stays open and grows with the lines appended to it.
+    """
+    cur.execute(
+        'INSERT INTO ingest_checkpoints '
+        '(file_path, shard_start, shard_end, committed_offset, file_size, file_mtime, head_bytes, head_hash, '
+        'updated_at, committed_hash) '
+        'VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) ON CONFLICT (file_path, shard_start) DO NOTHING;',
+        [identity.path, start, start, start, identity.size, identity.mtime, identity.head_bytes, identity.head_hash,
+         datetime.now(), hash_committed(identity.path, start, start)]
+    )
+    return Checkpoint(start, start, start)
+
+
+def advance_checkpoint(cur, path: str, start: int, offset: int) -> None:
+    """
+    Record that every line of the shard before ``offset`` is stored, with the hash of
+    the bytes before it. Must run in the transaction that stored those lines.
+    """
+    cur.execute(
+        'UPDATE ingest_checkpoints SET committed_offset = %s, shard_end = GREATEST(shard_end, %s), updated_at = %s, '
+        'committed_hash = %s WHERE file_path = %s AND shard_start = %s;',
+        [offset, offset, datetime.now(), hash_committed(path, start, offset), path, start]
+    )
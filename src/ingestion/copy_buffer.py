@@ -0,0 +1,68 @@
+import io
+from datetime import datetime
+
+# COPY text format treats backslash, tab and line breaks as control characters
+_COPY_ESCAPES = str.maketrans({
+    "\\": "\\\\",
+    "\t": "\\t",
+    "\n": "\\n",
+    "\r": "\\r",
+})
+
+
+class CopyBuffer:
+    """
+    Bounded in-memory buffer that streams raw JSON documents into a raw table
+    through ``COPY ... FROM STDIN``.
+
+    Documents are appended as already-validated JSON text and sent to the database
+    whenever the buffer reaches ``max_rows`` rows or ``max_bytes`` characters.
+    All rows of a flush share the timestamp taken when the first one was buffered.
+    """
+
+    def __init__(self, cursor, table: str, max_rows: int = 10000, max_bytes: int = 8 * 1024 * 1024) -> None:
+        self.cursor = cursor
+        self.table = table
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self._buffer = io.StringIO()
+        self._rows = 0
+        self._bytes = 0
+        self._created_at = None
+
+    def __len__(self) -> int:
+        return self._rows
+
+    def add(self, document: str) -> int:
+        """
+        Buffer one JSON document, flushing the buffer once it is full.
+
+        :param document: JSON text of a single resource, already checked to be valid.
+        :return: The number of rows copied if the buffer was flushed, 0 otherwise.
+        """
+        if self._created_at is None:
+            self._created_at = datetime.now().isoformat()
+        row = f"{document.translate(_COPY_ESCAPES)}\t{self._created_at}\n"
+        self._buffer.write(row)
+        self._rows += 1
+        self._bytes += len(row)
+        if self._rows >= self.max_rows or self._bytes >= self.max_bytes:
+            return self.flush()
+        return 0
+
+    def flush(self) -> int:
+        """
+        Send the buffered rows to the database.
+
+        :return: The number of rows copied.
+        """
+        if not self._rows:
+            return 0
+        self._buffer.seek(0)
+        self.cursor.copy_expert(f"COPY {self.table} (data, created_at) FROM STDIN", self._buffer)
+        copied = self._rows
+        self._buffer = io.StringIO()
+        self._rows = 0
+        self._bytes = 0
+        self._created_at = None
+        return copied
@@ -0,0 +1,68 @@
+import json
+from typing import Callable, Dict, Tuple
+
+try:
+    import orjson
+except ImportError:  # optional, the stdlib decoder is used instead
+    orjson = None
+
+
+def repair_patient_line(line: str) -> str:
+    return line.replace(":,",":null,")
+
+
+def repair_allergy_line(line: str) -> str:
+    # str.replace hands back the line itself when there is nothing to replace,
+    # so well-formed lines are only scanned, never copied
+    return line.replace('":,"','":null,"').replace('":}', '":null}')
+
+
+def _stdlib_loads(line: str):
+    return json.loads(line)
+
+
+def _orjson_loads(line: str):
+    try:
+        return orjson.loads(line)
+    except orjson.JSONDecodeError:
+        # orjson rejects a few documents the stdlib accepts (NaN, lone surrogates).
+        # Confirming with the stdlib keeps the accepted lines identical.
+        return json.loads(line)
+
+
+JSON_BACKENDS: Dict[str, Callable[[str], object]] = {"json": _stdlib_loads}
+if orjson is not None:
+    JSON_BACKENDS["orjson"] = _orjson_loads
+
+
+def resolve_backend(backend: str = "auto") -> str:
+    """
+    :param backend: "auto" picks the fastest installed backend, or one of JSON_BACKENDS.
+    :return: The name of the JSON backend to use.
+    """
+    if backend == "auto":
+        return "orjson" if "orjson" in JSON_BACKENDS else "json"
+    if backend not in JSON_BACKENDS:
+        raise ValueError(f"JSON backend '{backend}' is not available, expected one of {sorted(JSON_BACKENDS)}")
+    return backend
+
+
+class LineDecoder:
+    """
+    Decoding stage of the reader: repairs the known malformations of a NDJSON line,
+    then parses it with the configured JSON backend.
+    """
+
+    def __init__(self, repair: Callable[[str], str], backend: str = "auto") -> None:
+        self.repair = repair
+        self.backend = resolve_backend(backend)
+        self._loads = JSON_BACKENDS[self.backend]
+
+    def decode(self, line: str) -> Tuple[str, dict]:
+        """
+        :param line: Stripped NDJSON line.
+        :return: The repaired line and the decoded document.
+        :raises ValueError: If the repaired line is not valid JSON.
+        """
+        line = self.repair(line)
+        return line, self._loads(line)
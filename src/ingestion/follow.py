@@ -0,0 +1,253 @@
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from ingestion.checkpoints import (
+    advance_checkpoint,
+    create_checkpoint_table,
+    file_identity,
+    open_checkpoint,
+    resume_plan,
+)
+from ingestion.copy_buffer import CopyBuffer
+from ingestion.decoding import LineDecoder
+from logs import RateLimitedLog
+
+log = logging.getLogger(__name__)
+malformed_lines = RateLimitedLog(log)
+
+
+class FollowedSource(NamedTuple):
+    prefix: str
+    table: str
+    label: str
+    decoder: LineDecoder
+
+
+class FollowedLine(NamedTuple):
+    table: str
+    path: str
+    shard_start: int
+    next_offset: int
+    line: Optional[str]  # None for malformed lines, only their offset matters
+
+
+class FollowedFile:
+    def __init__(self, path: str, source: FollowedSource, inode: int) -> None:
+        self.path = path
+        self.source = source
+        self.inode = inode
+        # (shard start, read position, shard end) of the ranges left by previous runs,
+        # the last one stays open and follows the end of the file
+        self.ranges: List[Tuple[int, int, Optional[int]]] = []
+
+
+class FollowWriter(threading.Thread):
+    """
+    Drains the followed lines into the raw tables with COPY, committing a micro-batch
+    with its checkpoints every ``batch_rows`` rows or ``max_latency`` seconds,
+    whichever comes first.
+    """
+
+    def __init__(self, connect: Callable, lines: "queue.Queue", batch_rows: int, max_latency: float, max_bytes: int) -> None:
+        super().__init__(name="follow-writer", daemon=True)
+        self.connect = connect
+        self.lines = lines
+        self.batch_rows = batch_rows
+        self.max_latency = max_latency
+        self.max_bytes = max_bytes
+        self.stopping = threading.Event()
+        self.error: Optional[Exception] = None
+
+    def run(self) -> None:
+        conn = self.connect()
+        conn.autocommit = False
+        try:
+            with conn.cursor() as cur:
+                buffers: Dict[str, CopyBuffer] = {}
+                offsets: Dict[Tuple[str, int], int] = {}
+                pending = 0
+                rows = 0
+                deadline = None
+                while not (self.stopping.is_set() and self.lines.empty() and not pending):
+                    timeout = self.max_latency if deadline is None else max(deadline - time.monotonic(), 0)
+                    try:
+                        item = self.lines.get(timeout=timeout)
+                    except queue.Empty:
+                        item = None
+                    if item is not None:
+                        if deadline is None:
+                            deadline = time.monotonic() + self.max_latency
+                        if item.line is not None:
+                            if item.table not in buffers:
+                                buffers[item.table] = CopyBuffer(cur, item.table, max_rows=self.batch_rows, max_bytes=self.max_bytes)
+                            buffers[item.table].add(item.line)
+                            rows += 1
+                        offsets[(item.path, item.shard_start)] = item.next_offset
+                        pending += 1
+                    if pending and (pending >= self.batch_rows or time.monotonic() >= deadline):
+                        for buffer in buffers.values():
+                            buffer.flush()
+                        for (path, shard_start), offset in offsets.items():
+                            advance_checkpoint(cur, path, shard_start, offset)
+                        conn.commit()
+                        log.info("Committed %d followed lines (%d malformed).", rows, pending - rows)
+                        for _ in range(pending):
+                            self.lines.task_done()
+                        offsets.clear()
+                        pending = 0
+                        rows = 0
+                        deadline = None
+        except Exception as e:
+            conn.rollback()
+            self.error = e
+            log.error("Follow writer stopped: %s", e)
+        finally:
+            conn.close()
+
+
+class DirectoryFollower:
+    """
+    Polls a directory for NDJSON files and for lines appended to them, resuming every
+    file from its checkpoints. Decoded lines go through a bounded queue: when the
+    database falls behind, the queue fills up and reading pauses until it drains.
+
+    Only lines ended by a newline are read, a line still being written is picked up
+    on a later poll.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        sources: List[FollowedSource],
+        connect: Callable,
+        poll_interval: float = 1.0,
+        batch_rows: int = 5000,
+        max_latency: float = 2.0,
+        queue_rows: int = 50000,
+        max_bytes: int = 8 * 1024 * 1024,
+        maintenance: Optional[Callable] = None
+    ) -> None:
+        """
+        :param maintenance: Called with a cursor before every poll, for periodic schema upkeep.
+        """
+        self.directory = directory
+        self.maintenance = maintenance
+        self.sources = sources
+        self.connect = connect
+        self.poll_interval = poll_interval
+        self.lines: "queue.Queue[FollowedLine]" = queue.Queue(maxsize=queue_rows)
+        self.writer = FollowWriter(connect, self.lines, batch_rows, max_latency, max_bytes)
+        self.files: Dict[str, FollowedFile] = {}
+        self.stopping = threading.Event()
+
+    def stop(self) -> None:
+        self.stopping.set()
+
+    def source_for(self, name: str) -> Optional[FollowedSource]:
+        if not name.endswith('.ndjson'):
+            return None
+        for source in self.sources:
+            if name.startswith(source.prefix):
+                return source
+        return None
+
+    def run(self) -> None:
+        conn = self.connect()
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                create_checkpoint_table(cur)
+                self.writer.start()
+                while not self.stopping.is_set() and self.writer.is_alive():
+                    if self.maintenance:
+                        self.maintenance(cur)
+                    self.poll(cur)
+                    self.stopping.wait(self.poll_interval)
+        finally:
+            self.writer.stopping.set()
+            self.writer.join()
+            conn.close()
+        if self.writer.error:
+            raise self.writer.error
+
+    def poll(self, cur) -> None:
+        for name in sorted(os.listdir(self.directory)):
+            source = self.source_for(name)
+            if source is None:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            followed = self.files.get(path)
+            if followed is not None and (followed.inode != stat.st_ino or stat.st_size < followed.ranges[-1][1]):
+                # Rotated or truncated: let the writer commit what was read, then start over
+                self.wait_for_writer()
+                followed = None
+            if followed is None:
+                followed = self.discover(cur, path, source, stat.st_ino)
+            self.read_new_lines(followed)
+
+    def discover(self, cur, path: str, source: FollowedSource, inode: int) -> FollowedFile:
+        identity = file_identity(path)
+        checkpoints = resume_plan(cur, identity, lambda start, end: [(start, end)])
+        if not checkpoints:
+            checkpoints = [open_checkpoint(cur, identity, 0)]
+        followed = FollowedFile(path, source, inode)
+        followed.ranges = [(c.start, c.committed_offset, c.end) for c in checkpoints if not c.done]
+        last = checkpoints[-1]
+        if not followed.ranges or followed.ranges[-1][0] != last.start:
+            followed.ranges.append((last.start, last.committed_offset, None))
+        else:
+            followed.ranges[-1] = (last.start, last.committed_offset, None)
+        self.files[path] = followed
+        log.info("Following %s from offset %d.", path, last.committed_offset)
+        return followed
+
+    def read_new_lines(self, followed: FollowedFile) -> None:
+        source = followed.source
+        ranges = []
+        with open(followed.path, 'rb') as f:
+            for shard_start, position, end in followed.ranges:
+                f.seek(position)
+                while end is None or position < end:
+                    raw = f.readline()
+                    if not raw.endswith(b'\n') and (end is None or position + len(raw) < end):
+                        break  # incomplete line, or end of file
+                    position += len(raw)
+                    try:
+                        line = raw.decode('utf-8').strip()
+                        if not line:
+                            continue
+                        line, _ = source.decoder.decode(line)
+                    except Exception as e:
+                        malformed_lines.warning(
+                            followed.path, "Skipping malformed %s line at byte %d of %s: %s",
+                            source.label, position - len(raw), followed.path, e
+                        )
+                        line = None
+                    self.put(FollowedLine(source.table, followed.path, shard_start, position, line))
+                    if self.stopping.is_set():
+                        break
+                if end is None or position < end:
+                    ranges.append((shard_start, position, end))
+        followed.ranges = ranges
+
+    def wait_for_writer(self) -> None:
+        while self.lines.unfinished_tasks and self.writer.is_alive():
+            time.sleep(0.05)
+
+    def put(self, item: FollowedLine) -> None:
+        # Blocks while the queue is full, which is what slows reading down to the database pace
+        while True:
+            try:
+                self.lines.put(item, timeout=self.poll_interval)
+                return
+            except queue.Full:
+                if not self.writer.is_alive():
+                    raise RuntimeError("Follow writer stopped, cannot queue more lines")
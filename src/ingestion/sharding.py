@@ -0,0 +1,48 @@
+import os
+from typing import List, Optional, Tuple
+
+from ingestion.sources import UNTIL_EOF, detect_compression
+
+
+def plan_shards(
+    path: str,
+    shards: int,
+    min_shard_bytes: int = 1024 * 1024,
+    start: int = 0,
+    end: Optional[int] = None
+) -> List[Tuple[int, int]]:
+    """
+    Split a NDJSON file, or the [start, end) part of it, into byte ranges that start
+    and end on line boundaries.
+
+    :param path: Path of the NDJSON file.
+    :param shards: Wanted number of shards, fewer are returned for small files.
+    :param min_shard_bytes: Smallest range worth handing to a separate worker.
+    :param start: Offset where the planned part begins, must be a line boundary.
+    :param end: Offset where the planned part ends, None plans until the end of the file.
+    :return: List of (start, end) byte offsets covering the planned part.
+        Compressed files cannot be split and are planned as a single range.
+    """
+    if detect_compression(path):
+        return [(start, UNTIL_EOF if end is None else end)]
+    stop = os.path.getsize(path) if end is None else end
+    if stop <= start:
+        return []
+    shards = max(1, min(shards, (stop - start) // max(min_shard_bytes, 1)))
+    bounds = [start]
+    with open(path, 'rb') as f:
+        for k in range(1, shards):
+            target = start + (stop - start) * k // shards
+            if target <= bounds[-1]:
+                continue
+            # Finish the line holding the byte before the target, the shard starts right after it
+            f.seek(target - 1)
+            f.readline()
+            position = f.tell()
+            if position >= stop:
+                break
+            if position > bounds[-1]:
+                bounds.append(position)
+    bounds.append(stop)
+    return list(zip(bounds[:-1], bounds[1:]))
+
@@ -0,0 +1,87 @@
+import bz2
+import gzip
+import lzma
+import mmap
+import os
+from typing import Iterator, Optional, Tuple, Union
+
+# Offsets of compressed files are positions in the decompressed stream, whose length is
+# only known once it has been read: their ranges end at this offset instead
+UNTIL_EOF = 2 ** 63 - 1
+
+_MAGIC_NUMBERS = (
+    (b"\x1f\x8b", "gzip"),
+    (b"BZh", "bz2"),
+    (b"\xfd7zXZ\x00", "xz"),
+)
+
+_OPENERS = {
+    "gzip": gzip.open,
+    "bz2": bz2.open,
+    "xz": lzma.open,
+}
+
+Line = Union[bytes, memoryview]
+
+
+def detect_compression(path: str) -> Optional[str]:
+    """
+    :return: "gzip", "bz2" or "xz" according to the first bytes of the file, None when it is not compressed.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(6)
+    for magic, compression in _MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def iter_lines(path: str, start: int = 0, end: Optional[int] = None) -> Iterator[Tuple[int, Line]]:
+    """
+    Yield the lines starting inside [start, end) with their offset. Use ``str(line, 'utf-8')``
+    to decode them, it works for both kinds of line.
+
+    Uncompressed files are memory-mapped and every line is a memoryview on the map, so
+    no copy is made before decoding. Compressed files are decompressed as a stream,
+    chunk by chunk, and their offsets count decompressed bytes.
+
+    :param path: Path of the NDJSON file, compressed or not.
+    :param start: Offset of the first line, must be a line boundary.
+    :param end: Offset where reading stops, None reads until the end of the file.
+    """
+    compression = detect_compression(path)
+    if compression:
+        yield from _iter_stream_lines(_OPENERS[compression](path, 'rb'), start, end)
+    else:
+        yield from _iter_mapped_lines(path, start, end)
+
+
+def _iter_stream_lines(stream, start: int, end: Optional[int]) -> Iterator[Tuple[int, bytes]]:
+    with stream:
+        if start:
+            # Decompressed streams can only seek by decompressing up to the offset
+            stream.seek(start)
+        offset = start
+        while end is None or offset < end:
+            raw = stream.readline()
+            if not raw:
+                break
+            yield offset, raw
+            offset += len(raw)
+
+
+def _iter_mapped_lines(path: str, start: int, end: Optional[int]) -> Iterator[Tuple[int, memoryview]]:
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if start >= size:
+            return
+        # The map is not closed explicitly: it is released with the last line still referencing it
+        view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    stop = size if end is None else min(end, size)
+    offset = start
+    find = view.obj.find
+    while offset < stop:
+        newline = find(b'\n', offset)
+        next_offset = size if newline == -1 else newline + 1
+        yield offset, view[offset:next_offset]
+        offset = next_offset
@@ -0,0 +1,140 @@
+"""
+Logging of the reader and the handler: levels, a text or JSON line per record, and
+helpers keeping the hot loops quiet.
+
+``configure_logging`` sets the level and the format of every logger, once per
+process. The loops over rows log per row at DEBUG only, with lazy ``%s`` arguments,
+so a disabled level costs a level check. Rejected rows are summed up once per batch
+by ``FailureLog``, by reason with a few examples, and messages that may repeat on
+every line or batch go through a ``RateLimitedLog``.
+"""
+import json
+import logging
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from metrics import reason_label
+
+LOG_FORMATS = ("text", "json")
+
+# Attributes of every LogRecord, the others come from ``extra``
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record: time, level, logger, message and the ``extra`` fields.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level: str = "INFO", fmt: str = "text") -> None:
+    """
+    Send the records of ``level`` and above to stdout, as their message alone
+    ("text") or as JSON lines ("json").
+    """
+    if fmt not in LOG_FORMATS:
+        raise ValueError(f"Unknown log format {fmt!r}, expected one of {LOG_FORMATS}")
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if fmt == "json" else logging.Formatter("%(message)s"))
+    root = logging.getLogger()
+    for previous in list(root.handlers):
+        root.removeHandler(previous)
+    root.addHandler(handler)
+    root.setLevel(level.upper())
+
+
+class FailureLog:
+    """
+    Failures counted by reason, without the details of the messages (see
+    ``metrics.reason_label``), with the first ``samples`` examples of every reason.
+    """
+
+    def __init__(self, samples: int = 3) -> None:
+        self.samples = samples
+        self.counts: Dict[str, int] = {}
+        self.examples: Dict[str, List[Tuple[object, str]]] = {}
+
+    def __len__(self) -> int:
+        return sum(self.counts.values())
+
+    def add(self, key, reason: str) -> None:
+        label = reason_label(reason)
+        self.counts[label] = self.counts.get(label, 0) + 1
+        examples = self.examples.setdefault(label, [])
+        if len(examples) < self.samples:
+            examples.append((key, reason.strip().replace("\n", " ")[:300]))
+
+    def extend(self, failures: Iterable[Tuple[object, str]]) -> None:
+        for key, reason in failures:
+            self.add(key, reason)
+
+    def merge(self, other: "FailureLog") -> None:
+        for label, count in other.counts.items():
+            self.counts[label] = self.counts.get(label, 0) + count
+            examples = self.examples.setdefault(label, [])
+            examples.extend(other.examples[label][:self.samples - len(examples)])
+
+    def summary(self) -> str:
+        parts = []
+        for label, count in sorted(self.counts.items(), key=lambda item: -item[1]):
+            examples = "; ".join(f"{key}: {reason}" for key, reason in self.examples[label])
+            parts.append(f"{label} x{count} (e.g. {examples})")
+        return ", ".join(parts)
+
+
+class RateLimitedLog:
+    """
+    At most ``limit`` records per ``interval`` seconds for every key of a logger. The
+    records dropped are counted and reported with the next record of their key.
+    """
+
+    def __init__(self, logger: logging.Logger, limit: int = 10, interval: float = 60.0) -> None:
+        self.logger = logger
+        self.limit = limit
+        self.interval = interval
+        self._lock = threading.Lock()
+        # Key to (start of the window, records in the window, records dropped)
+        self._windows: Dict[str, List[float]] = {}
+
+    def log(self, level: int, key: str, msg: str, *args) -> None:
+        if not self.logger.isEnabledFor(level):
+            return
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.setdefault(key, [now, 0, 0])
+            if now - window[0] >= self.interval:
+                window[0], window[1] = now, 0
+            if window[1] >= self.limit:
+                window[2] += 1
+                return
+            window[1] += 1
+            dropped, window[2] = window[2], 0
+        if dropped:
+            msg += f" ({int(dropped)} similar messages dropped)"
+        self.logger.log(level, msg, *args)
+
+    def warning(self, key: str, msg: str, *args) -> None:
+        self.log(logging.WARNING, key, msg, *args)
+
+    def error(self, key: str, msg: str, *args) -> None:
+        self.log(logging.ERROR, key, msg, *args)
+
+    def dropped(self, key: Optional[str] = None) -> int:
+        with self._lock:
+            windows = [self._windows[key]] if key in self._windows else [] if key else list(self._windows.values())
+            return int(sum(window[2] for window in windows))
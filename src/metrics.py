@@ -0,0 +1,286 @@
+"""
+Counters and latency histograms of the reader and the handler, exported in the
+Prometheus text format (to a file, or on a local HTTP endpoint while running) and as
+a JSON summary at exit.
+
+Every metric is declared in ``METRICS``. The stages record into the ``metrics``
+registry of the process. The transforms running in the handler process pool are
+recorded by the main process, from the seconds they return.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from pydantic import ValidationError
+
+# Seconds, from a cached lookup to a large batch write
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+ROWS_BUCKETS = (1, 10, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000)
+
+# Name to (type, help, histogram buckets)
+METRICS: Dict[str, Tuple[str, str, Tuple[float, ...]]] = {
+    "handler_stage_seconds": ("histogram", "Seconds of work of a handler stage on one batch.", SECONDS_BUCKETS),
+    "handler_batch_rows": ("histogram", "Raw rows read per handler batch.", ROWS_BUCKETS),
+    "handler_rows_total": ("counter", "Raw rows by outcome: read, unchanged, refined or rejected.", ()),
+    "handler_rejects_total": ("counter", "Raw rows rejected by the validation or the processors, by reason.", ()),
+    "refined_write_seconds": ("histogram", "Seconds to write the rows of one batch to a refined table.", SECONDS_BUCKETS),
+    "refined_rows_total": ("counter", "Rows sent to a refined table.", ()),
+    "db_commit_seconds": ("histogram", "Seconds to commit a session.", SECONDS_BUCKETS),
+    "reader_load_seconds": (
+        "histogram", "Seconds to load an input file, or one shard of it with several reader workers.", SECONDS_BUCKETS
+    ),
+    "reader_lines_total": ("counter", "Input lines by outcome: stored or malformed.", ()),
+}
+
+log = logging.getLogger(__name__)
+
+# Distinct reasons kept per entity, the others are counted as "other"
+MAX_REASONS = 50
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def reason_label(reason: Union[str, Exception]) -> str:
+    """
+    Reason of a rejection without its details (values, ids, counts), to keep the
+    number of label values small. A validation error is labelled by the location and
+    the type of its first error, e.g. "code.coding.N.code [missing]", list indexes
+    being replaced by N. Any other reason by the start of its first line, up to ':'.
+    """
+    if isinstance(reason, ValidationError):
+        errors = reason.errors()
+        if errors:
+            location = ".".join("N" if isinstance(part, int) else str(part) for part in errors[0]["loc"])
+            return f"{location or reason.title} [{errors[0]['type']}]"[:80]
+    first_line = str(reason).strip().split("\n", 1)[0]
+    return re.sub(r"\d+", "N", first_line.split(":", 1)[0]).strip()[:80] or "unknown"
+
+
+def rejection_reason(e: Exception) -> str:
+    """
+    Text of a rejection. The rejections leave the transform workers as text, so the
+    label of a validation error is put first, where ``reason_label`` reads it again.
+    """
+    if isinstance(e, ValidationError):
+        return f"{reason_label(e)}: {e}"
+    return str(e)
+
+
+class Histogram:
+    def __init__(self, buckets: Iterable[float]) -> None:
+        self.buckets = tuple(sorted(buckets))
+        # One count per bucket, then the values above the last one
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """
+        Upper bound of the bucket holding the ``q`` quantile, the largest value seen
+        above the last bucket.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _render_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+class MetricsRegistry:
+    """
+    Counters and histograms by name and labels, safe to record from several threads.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        if name not in METRICS:
+            raise KeyError(f"Unknown metric {name!r}")
+        key = _labels(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        if name not in METRICS:
+            raise KeyError(f"Unknown metric {name!r}")
+        key = _labels(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(METRICS[name][2])
+            series[key].observe(value)
+
+    @contextmanager
+    def time(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reject(self, entity: str, reason: str) -> None:
+        """
+        Count a rejected row of ``entity`` under the label of its reason.
+        """
+        label = reason_label(reason)
+        with self._lock:
+            reasons = {
+                dict(key)["reason"] for key in self._counters.get("handler_rejects_total", {})
+                if dict(key)["entity"] == entity
+            }
+        if label not in reasons and len(reasons) >= MAX_REASONS:
+            label = "other"
+        self.inc("handler_rejects_total", entity=entity, reason=label)
+        self.inc("handler_rows_total", entity=entity, outcome="rejected")
+
+    def render(self) -> str:
+        """
+        Every metric recorded, in the Prometheus text exposition format.
+        """
+        lines: List[str] = []
+        with self._lock:
+            for name, (kind, help_text, _) in METRICS.items():
+                if name in self._counters:
+                    lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+                    for labels, value in sorted(self._counters[name].items()):
+                        lines.append(f"{name}{_render_labels(labels)} {_number(value)}")
+                elif name in self._histograms:
+                    lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+                    for labels, histogram in sorted(self._histograms[name].items()):
+                        cumulative = 0
+                        for bound, count in zip(histogram.buckets, histogram.counts):
+                            cumulative += count
+                            lines.append(f"{name}_bucket{_render_labels(labels, ('le', f'{bound:g}'))} {cumulative}")
+                        lines.append(f"{name}_bucket{_render_labels(labels, ('le', '+Inf'))} {histogram.count}")
+                        lines.append(f"{name}_sum{_render_labels(labels)} {_number(histogram.sum)}")
+                        lines.append(f"{name}_count{_render_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> dict:
+        """
+        Every metric recorded, the histograms summed up by count, sum, mean, p50, p95 and max.
+        """
+        def series_name(name: str, labels: Labels) -> str:
+            return name + _render_labels(labels)
+
+        with self._lock:
+            counters = {
+                series_name(name, labels): value
+                for name, series in self._counters.items() for labels, value in sorted(series.items())
+            }
+            histograms = {
+                series_name(name, labels): {
+                    "count": h.count,
+                    "sum": round(h.sum, 6),
+                    "mean": round(h.sum / h.count, 6) if h.count else 0.0,
+                    "p50": round(h.quantile(0.5), 6),
+                    "p95": round(h.quantile(0.95), 6),
+                    "max": round(h.max, 6),
+                }
+                for name, series in self._histograms.items() for labels, h in sorted(series.items())
+            }
+        return {"counters": counters, "histograms": histograms}
+
+    def write_prometheus(self, path: str) -> None:
+        """
+        Write the metrics to ``path`` atomically, e.g. for the textfile collector of
+        the node exporter.
+        """
+        temporary = f"{path}.tmp"
+        with open(temporary, "w") as f:
+            f.write(self.render())
+        os.replace(temporary, path)
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        """
+        Serve the metrics on ``http://host:port/metrics`` from a daemon thread, until
+        ``stop``. Port 0 picks a free port, see ``server_address``.
+        """
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes are not worth a log line
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def export(self, prometheus_file: str = "", summary_file: str = "") -> None:
+        """
+        Export the metrics at exit: to ``prometheus_file`` when set, and the JSON
+        summary to ``summary_file``, or logged when it is not set.
+        """
+        if prometheus_file:
+            self.write_prometheus(prometheus_file)
+            log.info("Metrics written to %s", prometheus_file)
+        summary = json.dumps(self.summary(), sort_keys=True)
+        if summary_file:
+            with open(summary_file, "w") as f:
+                f.write(summary + "\n")
+            log.info("Metrics summary written to %s", summary_file)
+        else:
+            log.info("Metrics summary: %s", summary)
+
+
+metrics = MetricsRegistry()
@@ -1,7 +1,9 @@
-from typing import Optional, Union, get_type_hints
+from typing import Optional
 from pydantic import BaseModel, model_validator, field_validator
 from uuid import UUID
 
+from models import validators
+
 class PatientName(BaseModel):
     patient_uuid: UUID
     use: str
@@ -11,18 +13,7 @@ class PatientName(BaseModel):
 
     @model_validator(mode="before")
     def empty_str_to_none(cls, values):
-        hints = get_type_hints(cls)
-        for k, v in values.items():
-            # Only set to None if the field is Optional and the value is an empty string
-            if isinstance(v, str) and v == "":
-                if (k in hints and (
-                        getattr(hints[k], '__origin__', None) is Union and type(None) in hints[k].__args__
-                    )
-                ):
-                    values[k] = None
-                else:
-                    raise ValueError(f"Field '{k}' cannot be an empty string.")
-        return values
+        return validators.empty_str_to_none(cls, values)
     
     @field_validator('family', 'given', 'prefix', mode='before')
     @classmethod
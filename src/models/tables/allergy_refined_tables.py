@@ -4,13 +4,16 @@ from sqlalchemy import (
     String, 
     Integer, 
     ForeignKey,
-    DateTime
+    DateTime,
+    Index
 )
 from sqlalchemy.orm import relationship
 from models.tables import RefinedBase
 
 class AllergyCodes(RefinedBase):
     __tablename__ = "allergy_codes"
+    # Natural key of a code, see repository.refined_schema for existing databases
+    __table_args__ = (Index("ux_allergy_codes_natural_key", "system", "code", "display", unique=True),)
     id = Column(Integer, primary_key=True, autoincrement=True)
     system = Column(String, nullable=False)
     code = Column(String, nullable=False)
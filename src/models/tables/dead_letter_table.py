@@ -0,0 +1,28 @@
+from sqlalchemy import (
+    Column,
+    Integer,
+    String,
+    DateTime,
+    Index,
+    text
+)
+from sqlalchemy.dialects.postgresql import JSONB
+from models.tables import RawBase
+
+class DeadLetters(RawBase):
+    __tablename__ = "dead_letters"
+    # Same index as the handler creates, see repository.raw_schema
+    __table_args__ = (
+        Index("ix_dead_letters_retry", "source", "next_retry_at", postgresql_where=text("quarantined_at IS NOT NULL")),
+    )
+    source = Column(String, primary_key=True)
+    raw_id = Column(Integer, primary_key=True)
+    reason = Column(String, nullable=False)
+    attempts = Column(Integer, nullable=False)
+    first_failed_at = Column(DateTime, nullable=False)
+    last_failed_at = Column(DateTime, nullable=False)
+    # Set while the row is quarantined, moved out of its raw table
+    data = Column(JSONB(none_as_null=True), nullable=True)
+    created_at = Column(DateTime, nullable=True)
+    quarantined_at = Column(DateTime, nullable=True)
+    next_retry_at = Column(DateTime, nullable=True)
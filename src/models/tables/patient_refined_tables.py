@@ -4,10 +4,12 @@ from sqlalchemy import (
     Integer, 
     Date, 
     ForeignKey, 
+    Index,
     UUID as SA_UUID
 )
 from sqlalchemy.orm import relationship
 from models.tables import RefinedBase
+from repository.backends import sqlite_natural_key
 
 class Patient(RefinedBase):
     __tablename__ = "patients"
@@ -21,6 +23,13 @@ class Patient(RefinedBase):
 
 class PatientName(RefinedBase):
     __tablename__ = "patient_names"
+    # Natural keys, see repository.refined_schema for existing databases
+    __table_args__ = (
+        Index(
+            "ux_patient_names_natural_key", "patient_uuid", "use", "family", "given", "prefix",
+            unique=True, postgresql_nulls_not_distinct=True
+        ).ddl_if(dialect="postgresql"),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     patient_uuid = Column(SA_UUID(as_uuid=True), ForeignKey("patients.uuid"), nullable=False)
     use = Column(String, nullable=False)
@@ -31,6 +40,12 @@ class PatientName(RefinedBase):
 
 class Address(RefinedBase):
     __tablename__ = "addresses"
+    __table_args__ = (
+        Index(
+            "ux_addresses_natural_key", "patient_uuid", "city", "state", "country", "postal_code", "line",
+            unique=True, postgresql_nulls_not_distinct=True
+        ).ddl_if(dialect="postgresql"),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     patient_uuid = Column(SA_UUID(as_uuid=True), ForeignKey("patients.uuid"), nullable=False)
     line = Column(String, nullable=False)
@@ -42,9 +57,22 @@ class Address(RefinedBase):
 
 class Telecom(RefinedBase):
     __tablename__ = "telecoms"
+    __table_args__ = (
+        Index("ux_telecoms_natural_key", "patient_uuid", "system", "value", "use", unique=True),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     patient_uuid = Column(SA_UUID(as_uuid=True), ForeignKey("patients.uuid"), nullable=False)
     system = Column(String, nullable=False)
     value = Column(String, nullable=False)
     use = Column(String, nullable=False)
     patient = relationship("Patient", back_populates="telecoms", primaryjoin="Telecom.patient_uuid==Patient.uuid")
+
+# The same natural keys on an embedded SQLite database, see repository.backends
+sqlite_natural_key(
+    "ux_patient_names_natural_key_sqlite",
+    PatientName.patient_uuid, PatientName.use, PatientName.family, PatientName.given, PatientName.prefix
+)
+sqlite_natural_key(
+    "ux_addresses_natural_key_sqlite",
+    Address.patient_uuid, Address.city, Address.state, Address.country, Address.postal_code, Address.line
+)
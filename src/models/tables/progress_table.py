@@ -0,0 +1,19 @@
+from sqlalchemy import (
+    Column,
+    Integer,
+    String,
+    DateTime
+)
+from sqlalchemy.dialects.postgresql import JSONB
+from models.tables import RawBase
+
+class HandlerProgress(RawBase):
+    __tablename__ = "handler_progress"
+    source = Column(String, primary_key=True)
+    # Every raw row up to this id is refined, except the exceptions
+    high_water_mark = Column(Integer, nullable=False)
+    # Sorted ids of the rows up to the high-water mark still to refine
+    exceptions = Column(JSONB, nullable=False)
+    # First id of every gap after the high-water mark, with the time it was first seen
+    gaps = Column(JSONB, nullable=False, default=dict)
+    updated_at = Column(DateTime, nullable=False)
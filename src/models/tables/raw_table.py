@@ -2,21 +2,31 @@ from sqlalchemy import (
     Column, 
     Integer,
     Boolean, 
-    DateTime
+    DateTime,
+    Index,
+    String,
+    text
 )
 from sqlalchemy.dialects.postgresql import JSONB
 from models.tables import RawBase
 
 class RawPatients(RawBase):
     __tablename__ = "patients"
+    # Same index as the reader creates, see repository.raw_schema
+    __table_args__ = (Index("ix_patients_unacked", "id", postgresql_where=text("ack = false")),)
     id = Column(Integer, primary_key=True, autoincrement=True)
     data = Column(JSONB, nullable=False)
     ack = Column(Boolean, default=False)
     created_at = Column(DateTime, nullable=False)
+    claimed_by = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
 
 class RawAllergies(RawBase):
     __tablename__ = "allergies"
+    __table_args__ = (Index("ix_allergies_unacked", "id", postgresql_where=text("ack = false")),)
     id = Column(Integer, primary_key=True, autoincrement=True)
     data = Column(JSONB, nullable=False)
     ack = Column(Boolean, default=False)
-    created_at = Column(DateTime, nullable=False)
\ No newline at end of file
+    created_at = Column(DateTime, nullable=False)
+    claimed_by = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
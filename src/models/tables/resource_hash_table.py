@@ -0,0 +1,13 @@
+from sqlalchemy import (
+    Column,
+    String,
+    DateTime
+)
+from models.tables import RefinedBase
+
+class ResourceHashes(RefinedBase):
+    __tablename__ = "resource_hashes"
+    resource_type = Column(String, primary_key=True)
+    resource_id = Column(String, primary_key=True)
+    content_hash = Column(String, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
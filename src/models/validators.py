@@ -0,0 +1,27 @@
+from functools import lru_cache
+from typing import FrozenSet, Union, get_type_hints
+
+
+@lru_cache(maxsize=None)
+def optional_fields(cls) -> FrozenSet[str]:
+    """
+    Fields of a model annotated as Optional. Resolving the type hints is slow, so it is
+    done once per class rather than for every validated instance.
+    """
+    hints = get_type_hints(cls)
+    return frozenset(
+        k for k, hint in hints.items()
+        if getattr(hint, '__origin__', None) is Union and type(None) in hint.__args__
+    )
+
+
+def empty_str_to_none(cls, values):
+    optional = optional_fields(cls)
+    for k, v in values.items():
+        # Only set to None if the field is Optional and the value is an empty string
+        if isinstance(v, str) and v == "":
+            if k in optional:
+                values[k] = None
+            else:
+                raise ValueError(f"Field '{k}' cannot be an empty string.")
+    return values
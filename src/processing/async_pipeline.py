@@ -0,0 +1,107 @@
+import asyncio
+import time
+from typing import Iterable, List
+
+from processing.pipeline import BatchPipeline, failures
+
+
+class AsyncBatchPipeline(BatchPipeline):
+    """
+    ``BatchPipeline`` on an asyncio event loop, the database calls being offloaded to
+    threads (``asyncio.to_thread``) and the transforms to the process pool.
+
+    Reading (fetch and select), writing and acking are three coroutines linked by
+    queues of at most ``depth`` batches, so the next batch is read from the raw
+    database while the previous ones are written to the refined database and acked.
+    Each stage handles one batch at a time, in order: the batches of an entity are
+    written and acked in the order they were read, and a batch is acked only once its
+    refined rows are committed, as with ``BatchPipeline``. Without a pool the
+    transforms run in threads. The pipelines of different entities share nothing but
+    the pool, so they can run concurrently on one loop.
+    """
+
+    def run(self, batches: Iterable[List[dict]]) -> int:
+        return asyncio.run(self.run_async(batches))
+
+    async def run_async(self, batches: Iterable[List[dict]]) -> int:
+        """
+        :param batches: Batches of raw rows (id, data, ack, created_at), read in a thread.
+        :return: Number of rows read.
+        """
+        transforms = asyncio.Queue(maxsize=self.depth)
+        acks = asyncio.Queue(maxsize=self.depth)
+        writer = asyncio.ensure_future(self._write_loop(transforms, acks))
+        acker = asyncio.ensure_future(self._ack_loop_async(acks))
+        start = time.perf_counter()
+        try:
+            return await self._read_loop(iter(batches), transforms, acks)
+        finally:
+            await transforms.put(None)
+            await writer
+            await acks.put(None)
+            await acker
+            self.wall = time.perf_counter() - start
+
+    async def _read_loop(self, batches, transforms: asyncio.Queue, acks: asyncio.Queue) -> int:
+        loop = asyncio.get_running_loop()
+        processed = 0
+        while True:
+            fetched = time.perf_counter()
+            rows = await asyncio.to_thread(next, batches, None)
+            if rows is None:
+                self.fetch_stats.busy += time.perf_counter() - fetched
+                return processed
+            self.fetch_stats.add(time.perf_counter() - fetched)
+            processed += len(rows)
+            first_id, last_id = rows[0]['id'], rows[-1]['id']
+            rows = [dict(row) for row in rows]
+            row_ids = [row['id'] for row in rows]
+            timing = [len(rows), 0.0]
+            if self.select:
+                selected = time.perf_counter()
+                try:
+                    with self.select_stats.measure():
+                        rows, skipped = await asyncio.to_thread(self.select, rows)
+                except Exception as e:
+                    failures.error("batch", "Batch processing failed from id %s to id %s: %s", first_id, last_id, e)
+                    await acks.put((None, None, row_ids))
+                    continue
+                timing[1] += time.perf_counter() - selected
+                if not rows:
+                    await acks.put((skipped, timing, row_ids))
+                    continue
+                if skipped:
+                    await acks.put((skipped, None, None))
+            if self.pool:
+                future = loop.run_in_executor(self.pool, self.transform, rows)
+            else:
+                future = asyncio.ensure_future(asyncio.to_thread(self.transform, rows))
+            await transforms.put((first_id, last_id, timing, row_ids, future))
+
+    async def _write_loop(self, transforms: asyncio.Queue, acks: asyncio.Queue) -> None:
+        while True:
+            entry = await transforms.get()
+            if entry is None:
+                return
+            first_id, last_id, timing, row_ids, future = entry
+            try:
+                waited = time.perf_counter()
+                seconds, batch = await future
+                self.transform_wait += time.perf_counter() - waited
+                self.transform_stats.add(seconds)
+                written = time.perf_counter()
+                with self.write_stats.measure():
+                    ids = await asyncio.to_thread(self.write, batch)
+            except Exception as e:
+                failures.error("batch", "Batch processing failed from id %s to id %s: %s", first_id, last_id, e)
+                await acks.put((None, None, row_ids))
+                continue
+            timing[1] += seconds + time.perf_counter() - written
+            await acks.put((ids, timing, row_ids))
+
+    async def _ack_loop_async(self, acks: asyncio.Queue) -> None:
+        while True:
+            entry = await acks.get()
+            if entry is None:
+                return
+            await asyncio.to_thread(self._finish, *entry)
@@ -0,0 +1,107 @@
+import logging
+import threading
+from typing import List, Optional
+
+log = logging.getLogger(__name__)
+
+
+class BatchSizeController:
+    """
+    Size the handler batches of an entity so that each takes about ``target_seconds``
+    to validate, write and ack.
+
+    Every processed batch is reported with ``observe``. The time per row is smoothed
+    over the batches (exponential moving average, ``smoothing`` being the weight of the
+    last batch) and the next size is the number of rows that fit in the target at that
+    rate, moving at most by a factor ``max_step`` per batch and kept within
+    ``[min_size, max_size]``. Changes of less than ``deadband`` (a fraction of the
+    current size) are ignored so the size settles instead of jittering.
+
+    ``observe`` is called from the ack thread of the pipeline while the batches are
+    read in the main thread, hence the lock.
+    """
+
+    def __init__(
+        self,
+        label: str,
+        min_size: int,
+        max_size: int,
+        target_seconds: float,
+        initial_size: Optional[int] = None,
+        smoothing: float = 0.5,
+        max_step: float = 2.0,
+        deadband: float = 0.1
+    ) -> None:
+        if not 0 < min_size <= max_size:
+            raise ValueError(f"Invalid {label} batch size bounds [{min_size}, {max_size}]")
+        if target_seconds <= 0:
+            raise ValueError(f"Invalid {label} batch target latency {target_seconds}")
+        self.label = label
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_seconds = target_seconds
+        self.smoothing = smoothing
+        self.max_step = max_step
+        self.deadband = deadband
+        self._size = self._bounded(initial_size or min_size)
+        self._lock = threading.Lock()
+        # Smoothed seconds per row, None before the first batch
+        self.row_seconds: Optional[float] = None
+        # Size of every batch read, in order
+        self.sizes: List[int] = []
+        self.rows = 0
+        self.seconds = 0.0
+
+    def _bounded(self, size: float) -> int:
+        return max(self.min_size, min(self.max_size, int(size)))
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def next_size(self) -> int:
+        """
+        Size of the next batch to read. Called before every batch by the raw fetchers.
+        """
+        with self._lock:
+            self.sizes.append(self._size)
+            return self._size
+
+    def observe(self, rows: int, seconds: float) -> None:
+        """
+        :param rows: Number of raw rows of the batch.
+        :param seconds: Time spent validating, writing and acking the batch.
+        """
+        if rows <= 0 or seconds <= 0:
+            return
+        with self._lock:
+            self.rows += rows
+            self.seconds += seconds
+            row_seconds = seconds / rows
+            if self.row_seconds is None:
+                self.row_seconds = row_seconds
+            else:
+                self.row_seconds = self.smoothing * row_seconds + (1 - self.smoothing) * self.row_seconds
+            ideal = self.target_seconds / self.row_seconds
+            ideal = min(max(ideal, self._size / self.max_step), self._size * self.max_step)
+            size = self._bounded(ideal)
+            if abs(size - self._size) > self.deadband * self._size:
+                log.info(
+                    "%s batch size %d -> %d (%.3f ms per row, target %.2fs)",
+                    self.label, self._size, size, self.row_seconds * 1000, self.target_seconds
+                )
+                self._size = size
+
+    def throughput(self) -> float:
+        """
+        Rows validated, written and acked per second of work.
+        """
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def report(self) -> str:
+        sizes = self.sizes or [self._size]
+        return (
+            f"{self.label} batch size: settled at {self._size} (bounds {self.min_size}-{self.max_size}, "
+            f"{min(sizes)}-{max(sizes)} over {len(self.sizes)} batches), "
+            f"{self.throughput():.0f} rows/s of work at {self.target_seconds:.2f}s per batch target"
+        )
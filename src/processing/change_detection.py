@@ -0,0 +1,78 @@
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from models.tables.resource_hash_table import ResourceHashes
+
+
+class ResourceHashStore:
+    """
+    Hash of the last refined payload of every resource of a type, by resource id.
+
+    The hash is ``md5(data::text)`` of the raw JSONB, computed by the raw database
+    when the rows are read (see ``processing.raw_fetcher``): the text of a JSONB value
+    is canonical, keys sorted and whitespace normalized, so a resource exported again
+    unchanged gets the same hash. Only resources refined without failure are recorded,
+    the others are refined again whatever their hash.
+    """
+
+    def __init__(self, resource_type: str) -> None:
+        self.resource_type = resource_type
+        self.unchanged = 0
+        self.changed = 0
+
+    def select_changed(self, session: Session, rows: List[dict]) -> Tuple[List[dict], List[int]]:
+        """
+        Split a batch of raw rows on whether their resource changed since it was last
+        refined. The changed rows get the previous hash of their resource, if any, as
+        ``previous_hash``.
+
+        :param session: Session on the refined database.
+        :param rows: Raw rows with their ``content_hash``.
+        :return: The rows to refine, and the ids of the raw rows left unchanged.
+        """
+        resource_ids = {row['data'].get('id') for row in rows if isinstance(row['data'], dict)}
+        resource_ids.discard(None)
+        stored = dict(session.execute(
+            select(ResourceHashes.resource_id, ResourceHashes.content_hash).where(
+                ResourceHashes.resource_type == self.resource_type,
+                ResourceHashes.resource_id.in_(resource_ids)
+            )
+        ).all()) if resource_ids else {}
+
+        changed, unchanged = [], []
+        for row in rows:
+            resource_id = row['data'].get('id') if isinstance(row['data'], dict) else None
+            previous_hash = stored.get(resource_id)
+            if previous_hash is not None and previous_hash == row['content_hash']:
+                unchanged.append(row['id'])
+            else:
+                changed.append({**row, 'previous_hash': previous_hash})
+        self.unchanged += len(unchanged)
+        self.changed += len(changed)
+        return changed, unchanged
+
+    def record(self, session: Session, hashes: Dict[str, str]) -> None:
+        """
+        Store the hashes of refined resources, in the transaction of their refined rows.
+
+        :param hashes: Content hash by resource id.
+        """
+        if not hashes:
+            return
+        now = datetime.now()
+        stmt = insert(ResourceHashes)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[ResourceHashes.resource_type, ResourceHashes.resource_id],
+            set_={"content_hash": stmt.excluded.content_hash, "updated_at": stmt.excluded.updated_at}
+        )
+        session.execute(stmt, [
+            {"resource_type": self.resource_type, "resource_id": resource_id, "content_hash": content_hash, "updated_at": now}
+            for resource_id, content_hash in hashes.items()
+        ])
+
+    def report(self) -> str:
+        return f"{self.resource_type} change detection: {self.unchanged} unchanged, {self.changed} to refine"
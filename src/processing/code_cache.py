@@ -0,0 +1,100 @@
+from collections import OrderedDict
+from typing import Dict, Iterable, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from models.tables.allergy_refined_tables import AllergyCodes
+
+# (code, system, display)
+CodeKey = Tuple[str, str, str]
+
+
+class AllergyCodeCache:
+    """
+    Ids of the allergy codes by natural key, kept across batches with LRU eviction.
+
+    Codes missing from the cache are upserted with a single
+    ``INSERT ... ON CONFLICT ... RETURNING`` in a transaction of their own, committed
+    right away: a cached id always refers to a committed code, even when the batch
+    that needed it is rolled back. A batch whose codes are all cached makes no query.
+    """
+
+    def __init__(self, max_size: int = 10000) -> None:
+        self.max_size = max_size
+        self.ids: "OrderedDict[CodeKey, int]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.round_trips = 0
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _store(self, key: CodeKey, code_id: int) -> None:
+        self.ids[key] = code_id
+        self.ids.move_to_end(key)
+        if len(self.ids) > self.max_size:
+            self.ids.popitem(last=False)
+
+    def preload(self, session: Session) -> int:
+        """
+        Fill the cache with the newest codes of the refined database.
+
+        :return: Number of codes loaded.
+        """
+        rows = session.execute(
+            select(AllergyCodes.id, AllergyCodes.code, AllergyCodes.system, AllergyCodes.display)
+            .order_by(AllergyCodes.id.desc())
+            .limit(self.max_size)
+        ).all()
+        self.round_trips += 1
+        # Oldest first, so the newest codes are the last evicted
+        for code_id, code, system, display in reversed(rows):
+            self._store((code, system, display), code_id)
+        return len(rows)
+
+    def resolve(self, session: Session, keys: Iterable[CodeKey]) -> Dict[CodeKey, int]:
+        """
+        :param session: Session on the refined database, only its engine is used.
+        :param keys: Natural keys of the codes.
+        :return: Id of every code, the missing ones being inserted.
+        """
+        resolved = {}
+        missing = []
+        for key in set(keys):
+            code_id = self.ids.get(key)
+            if code_id is None:
+                missing.append(key)
+            else:
+                self.ids.move_to_end(key)
+                resolved[key] = code_id
+        self.hits += len(resolved)
+        self.misses += len(missing)
+        if not missing:
+            return resolved
+
+        # Sorted, so concurrent handlers lock the same codes in the same order
+        stmt = insert(AllergyCodes).values([
+            {"code": code, "system": system, "display": display}
+            for code, system, display in sorted(missing)
+        ])
+        # A no-op update rather than DO NOTHING, so the existing codes are returned too
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[AllergyCodes.system, AllergyCodes.code, AllergyCodes.display],
+            set_={"system": stmt.excluded.system}
+        ).returning(AllergyCodes.id, AllergyCodes.code, AllergyCodes.system, AllergyCodes.display)
+        with session.get_bind().begin() as connection:
+            rows = connection.execute(stmt).all()
+        self.round_trips += 1
+        for code_id, code, system, display in rows:
+            key = (code, system, display)
+            resolved[key] = code_id
+            self._store(key, code_id)
+        return resolved
+
+    def report(self) -> str:
+        return (
+            f"Allergy code cache: {len(self.ids)} codes, {self.hits} hits, {self.misses} misses, "
+            f"{self.round_trips} round trips"
+        )
@@ -0,0 +1,128 @@
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import delete, insert as plain_insert, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from models.tables.dead_letter_table import DeadLetters
+
+
+class DeadLetterQueue:
+    """
+    Failures of the raw rows of a table that could not be refined.
+
+    Every rejection of a raw row is counted in the raw ``dead_letters`` table, with its
+    last reason. A row stays in its raw table, and is retried by the next handler
+    runs, until it has failed ``max_attempts`` times. It is then quarantined: its data
+    is moved to ``dead_letters`` and the row deleted from the raw table, so the
+    handler scan of unacked rows no longer reads it.
+
+    ``replay`` puts the quarantined rows back in their raw table, with their id, to be
+    refined again once the validation rules are fixed. A replayed row that fails
+    again is quarantined at once, its next retry time doubling on every attempt
+    past ``max_attempts``, starting at ``retry_seconds``. The attempts of a row are
+    only counted for validation failures: a batch that fails as a whole (e.g. the
+    refined database is down) is retried without counting.
+    """
+
+    def __init__(self, source: str, raw_model, max_attempts: int = 3, retry_seconds: float = 3600.0) -> None:
+        self.source = source
+        self.raw_model = raw_model
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.failed = 0
+        self.quarantined = 0
+        self.replayed = 0
+
+    def next_retry(self, attempts: int, now: datetime) -> datetime:
+        return now + timedelta(seconds=self.retry_seconds * 2 ** max(0, attempts - self.max_attempts))
+
+    def record(self, session: Session, failures: Dict[int, str]) -> int:
+        """
+        Count a failed attempt for every raw row of ``failures`` and quarantine the
+        rows that reached ``max_attempts``.
+
+        :param session: Session on the raw database.
+        :param failures: Failure reason by raw row id.
+        :return: Number of rows quarantined.
+        """
+        if not failures:
+            return 0
+        now = datetime.now()
+        stmt = insert(DeadLetters)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[DeadLetters.source, DeadLetters.raw_id],
+            set_={
+                "attempts": DeadLetters.attempts + 1,
+                "reason": stmt.excluded.reason,
+                "last_failed_at": stmt.excluded.last_failed_at,
+            }
+        )
+        session.execute(stmt, [
+            {"source": self.source, "raw_id": raw_id, "reason": reason[:1000], "attempts": 1,
+             "first_failed_at": now, "last_failed_at": now}
+            for raw_id, reason in failures.items()
+        ])
+        self.failed += len(failures)
+
+        attempts = dict(session.execute(
+            select(DeadLetters.raw_id, DeadLetters.attempts).where(
+                DeadLetters.source == self.source,
+                DeadLetters.raw_id.in_(list(failures)),
+                DeadLetters.attempts >= self.max_attempts
+            )
+        ).all())
+        if not attempts:
+            return 0
+        raw = self.raw_model
+        rows = session.execute(
+            select(raw.id, raw.data, raw.created_at).where(raw.id.in_(list(attempts)))
+        ).all()
+        if rows:
+            session.execute(update(DeadLetters), [
+                {"source": self.source, "raw_id": raw_id, "data": data, "created_at": created_at,
+                 "quarantined_at": now, "next_retry_at": self.next_retry(attempts[raw_id], now)}
+                for raw_id, data, created_at in rows
+            ])
+            session.execute(delete(raw).where(raw.id.in_([row[0] for row in rows])))
+        self.quarantined += len(rows)
+        return len(rows)
+
+    def replay(self, session: Session, due_only: bool = True, limit: Optional[int] = None) -> List[int]:
+        """
+        Move quarantined rows back to their raw table, unacked. Their attempts are kept.
+
+        :param session: Session on the raw database.
+        :param due_only: Only replay the rows whose next retry time has passed.
+        :param limit: Maximum number of rows to replay.
+        :return: Ids of the rows replayed.
+        """
+        query = select(DeadLetters.raw_id, DeadLetters.data, DeadLetters.created_at).where(
+            DeadLetters.source == self.source,
+            DeadLetters.quarantined_at.is_not(None)
+        ).order_by(DeadLetters.raw_id)
+        if due_only:
+            query = query.where(DeadLetters.next_retry_at <= datetime.now())
+        if limit:
+            query = query.limit(limit)
+        rows = session.execute(query).all()
+        if not rows:
+            return []
+        session.execute(plain_insert(self.raw_model), [
+            {"id": raw_id, "data": data, "ack": False, "created_at": created_at}
+            for raw_id, data, created_at in rows
+        ])
+        session.execute(update(DeadLetters), [
+            {"source": self.source, "raw_id": raw_id, "data": None, "created_at": None,
+             "quarantined_at": None, "next_retry_at": None}
+            for raw_id, _, _ in rows
+        ])
+        self.replayed += len(rows)
+        return [raw_id for raw_id, _, _ in rows]
+
+    def report(self) -> str:
+        return (
+            f"{self.source} dead letters: {self.failed} failed rows counted, {self.quarantined} quarantined "
+            f"after {self.max_attempts} attempts"
+        )
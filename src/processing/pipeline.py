@@ -0,0 +1,229 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from logs import RateLimitedLog
+from processing.batch_controller import BatchSizeController
+
+log = logging.getLogger(__name__)
+# A failing database fails every batch, at most a few of them are logged per minute
+failures = RateLimitedLog(log)
+
+
+class StageStats:
+    """
+    Time spent working by a pipeline stage. ``slots`` is how many batches the stage
+    can work on at once, e.g. the number of processes of a pool. When given,
+    ``observe(stage, seconds)`` is told the seconds of every batch.
+    """
+
+    def __init__(self, name: str, slots: int = 1, observe: Optional[Callable[[str, float], None]] = None) -> None:
+        self.name = name
+        self.slots = slots
+        self.observe = observe
+        self.batches = 0
+        self.busy = 0.0
+
+    def add(self, seconds: float) -> None:
+        self.batches += 1
+        self.busy += seconds
+        if self.observe:
+            self.observe(self.name, seconds)
+
+    @contextmanager
+    def measure(self):
+        """
+        Time the block. A failing block counts as busy time but not as a batch.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.busy += time.perf_counter() - start
+            raise
+        self.add(time.perf_counter() - start)
+
+    def utilization(self, wall: float) -> float:
+        return self.busy / (wall * self.slots) if wall > 0 else 0.0
+
+
+def _run_inline(function: Callable, *args) -> Future:
+    future = Future()
+    try:
+        future.set_result(function(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+class BatchPipeline:
+    """
+    Refine raw batches in three overlapping stages:
+
+    * transform: ``transform(rows)`` runs in ``pool``, up to ``depth`` batches ahead of
+      the writes. Returns ``(seconds, batch)``, the time it worked and its output.
+    * write: ``write(batch)`` runs in the calling process, stores the batch in the
+      refined database and returns the raw ids to ack.
+    * ack: ``ack(ids)`` runs in a thread, fed by a queue of at most ``depth`` batches.
+
+    So batch N+1 is transformed while batch N is written and batch N-1 acked. Without
+    a pool the transform runs inline and nothing overlaps. A batch whose transform or
+    write fails is reported and not acked, the next batches go on.
+
+    When given, ``select(rows)`` runs in the calling process before the transform and
+    returns the rows to refine and the ids of the rows to ack without refining them.
+
+    When given, ``controller`` is told the rows and the seconds of work (select,
+    transform, write and ack) of every batch once it is acked, to size the next
+    batches. Failed batches are not reported to it.
+
+    When given, ``done(ids)`` runs in the ack thread once a batch is over, whether its
+    rows were acked, rejected or the batch failed, with the ids of every row read in
+    the batch. Batches failing before their write may be over before the previous ones.
+
+    When given, ``observe(stage, seconds)`` is told the seconds of work of every
+    stage on every batch, e.g. to record them in ``metrics``.
+    """
+
+    def __init__(
+        self,
+        transform: Callable,
+        write: Callable,
+        ack: Callable[[List[int]], None],
+        pool: Optional[Executor] = None,
+        workers: int = 1,
+        depth: int = 2,
+        select: Optional[Callable[[List[dict]], Tuple[List[dict], List[int]]]] = None,
+        controller: Optional[BatchSizeController] = None,
+        done: Optional[Callable[[List[int]], None]] = None,
+        observe: Optional[Callable[[str, float], None]] = None
+    ) -> None:
+        self.transform = transform
+        self.select = select
+        self.controller = controller
+        self.done = done
+        self.write = write
+        self.ack = ack
+        self.pool = pool
+        self.depth = max(1, depth)
+        self.fetch_stats = StageStats("fetch", observe=observe)
+        self.select_stats = StageStats("select", observe=observe)
+        self.transform_stats = StageStats("transform", slots=workers if pool else 1, observe=observe)
+        self.write_stats = StageStats("write", observe=observe)
+        self.ack_stats = StageStats("ack", observe=observe)
+        self.transform_wait = 0.0
+        self.wall = 0.0
+
+    def run(self, batches: Iterable[List[dict]]) -> int:
+        """
+        :param batches: Batches of raw rows (id, data, ack, created_at), read in the calling process.
+        :return: Number of rows read.
+        """
+        acks = queue.Queue(maxsize=self.depth)
+        acker = threading.Thread(target=self._ack_loop, args=(acks,), daemon=True)
+        acker.start()
+        start = time.perf_counter()
+        pending = deque()
+        processed = 0
+        try:
+            batches = iter(batches)
+            while True:
+                fetched = time.perf_counter()
+                rows = next(batches, None)
+                if rows is None:
+                    self.fetch_stats.busy += time.perf_counter() - fetched
+                    break
+                self.fetch_stats.add(time.perf_counter() - fetched)
+                processed += len(rows)
+                first_id, last_id = rows[0]['id'], rows[-1]['id']
+                # Plain dictionaries, the cursor rows are sent to another process
+                rows = [dict(row) for row in rows]
+                row_ids = [row['id'] for row in rows]
+                # Rows read and seconds of work of the batch, for the controller
+                timing = [len(rows), 0.0]
+                if self.select:
+                    selected = time.perf_counter()
+                    try:
+                        with self.select_stats.measure():
+                            rows, skipped = self.select(rows)
+                    except Exception as e:
+                        failures.error("batch", "Batch processing failed from id %s to id %s: %s", first_id, last_id, e)
+                        acks.put((None, None, row_ids))
+                        continue
+                    timing[1] += time.perf_counter() - selected
+                    if not rows:
+                        acks.put((skipped, timing, row_ids))
+                        continue
+                    if skipped:
+                        acks.put((skipped, None, None))
+                submit = self.pool.submit if self.pool else _run_inline
+                pending.append((first_id, last_id, timing, row_ids, submit(self.transform, rows)))
+                if len(pending) >= self.depth:
+                    self._write(pending.popleft(), acks)
+            while pending:
+                self._write(pending.popleft(), acks)
+        finally:
+            acks.put(None)
+            acker.join()
+            self.wall = time.perf_counter() - start
+        return processed
+
+    def _write(self, entry, acks: queue.Queue) -> None:
+        first_id, last_id, timing, row_ids, future = entry
+        try:
+            waited = time.perf_counter()
+            seconds, batch = future.result()
+            self.transform_wait += time.perf_counter() - waited
+            self.transform_stats.add(seconds)
+            written = time.perf_counter()
+            with self.write_stats.measure():
+                ids = self.write(batch)
+        except Exception as e:
+            failures.error("batch", "Batch processing failed from id %s to id %s: %s", first_id, last_id, e)
+            acks.put((None, None, row_ids))
+            return
+        timing[1] += seconds + time.perf_counter() - written
+        acks.put((ids, timing, row_ids))
+
+    def _ack_loop(self, acks: queue.Queue) -> None:
+        while True:
+            entry = acks.get()
+            if entry is None:
+                return
+            self._finish(*entry)
+
+    def _finish(self, ids: Optional[List[int]], timing: Optional[list], row_ids: Optional[List[int]]) -> None:
+        """
+        Ack the ``ids`` of a batch, report its ``timing`` to the controller and, when
+        ``row_ids`` is given, tell ``done`` that the batch is over.
+        """
+        acked = time.perf_counter()
+        try:
+            if ids:
+                with self.ack_stats.measure():
+                    self.ack(ids)
+        except Exception as e:
+            failures.error("ack", "Ack failed for ids %s to %s: %s", ids[0], ids[-1], e)
+        else:
+            if timing and self.controller:
+                self.controller.observe(timing[0], timing[1] + time.perf_counter() - acked)
+        if row_ids is not None and self.done:
+            try:
+                self.done(row_ids)
+            except Exception as e:
+                failures.error("progress", "Progress failed for ids %s to %s: %s", row_ids[0], row_ids[-1], e)
+
+    def report(self, label: str) -> str:
+        stages = [self.fetch_stats, self.transform_stats, self.write_stats, self.ack_stats]
+        if self.select:
+            stages.insert(1, self.select_stats)
+        stages = " | ".join(f"{stats.name} {stats.utilization(self.wall):.0%}" for stats in stages)
+        return (
+            f"{label}: {self.write_stats.batches} batches written in {self.wall:.2f}s, utilization {stages}, "
+            f"writes waited {self.transform_wait:.2f}s on transforms"
+        )
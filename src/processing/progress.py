@@ -0,0 +1,187 @@
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Set
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from models.tables.progress_table import HandlerProgress
+from processing.raw_fetcher import BatchSize, fetch_rows_by_id, iter_batches_after, next_batch_size
+
+
+class ProgressTracker:
+    """
+    Progress of the handler on a raw table, instead of an ``ack`` flag on every row: a
+    high-water mark, every row up to it being refined, and the ids of the rows up to it
+    still to refine (the exceptions), kept in one row of the raw ``handler_progress``
+    table. Saving the progress of a batch updates that row only, however many raw rows
+    the batch had, and the raw rows are never rewritten.
+
+    The rows are read with ``batches``: first the exceptions, then the rows after the
+    high-water mark. ``ack`` marks refined rows and ``done`` ends a batch, its rows not
+    acked becoming exceptions. The high-water mark only moves over batches that are
+    over, in the order they were read, so a batch still in flight or that failed is
+    never skipped. ``ack`` and ``done`` are called from the pipeline ack thread while
+    the batches are read in another, hence the lock.
+
+    The reads stop at the ids missing while the reader writes to the table. The gaps
+    met this way are kept with the time they were first seen, and skipped once missing
+    for ``gap_timeout`` seconds, so an id never written does not hold the mark for good.
+
+    :param source: Raw table of the progress.
+    :param gap_timeout: Seconds after which a gap is skipped, never when None.
+    """
+
+    def __init__(self, source: str, gap_timeout: Optional[float] = None) -> None:
+        self.source = source
+        self.gap_timeout = gap_timeout
+        self.high_water_mark = 0
+        self.exceptions: Set[int] = set()
+        # First id of every gap after the high-water mark, with the time it was first seen
+        self.gaps: Dict[int, datetime] = {}
+        self._saved_gaps: Dict[int, datetime] = {}
+        self._lock = threading.Lock()
+        # Ids of the batches read and not over yet, by first id, in the order they were read
+        self._batches: Dict[int, List[int]] = {}
+        self._over: Set[int] = set()
+        self._acked: Set[int] = set()
+        self.retried = 0
+        self.saves = 0
+
+    def load(self, session: Session, raw_model) -> None:
+        """
+        Read the progress saved for the table. Without any, start after the rows acked
+        by the previous handlers, i.e. before the first unacked row.
+
+        :param session: Session on the raw database.
+        :param raw_model: ORM model of the raw table.
+        """
+        progress = session.get(HandlerProgress, self.source)
+        if progress is not None:
+            self.high_water_mark = progress.high_water_mark
+            self.exceptions = set(progress.exceptions)
+            self.gaps = {int(i): datetime.fromisoformat(seen) for i, seen in (progress.gaps or {}).items()}
+            self._saved_gaps = dict(self.gaps)
+            return
+        first_unacked = session.execute(select(func.min(raw_model.id)).where(raw_model.ack.is_(False))).scalar()
+        if first_unacked is not None:
+            self.high_water_mark = first_unacked - 1
+        else:
+            self.high_water_mark = session.execute(select(func.max(raw_model.id))).scalar() or 0
+        self.exceptions = set()
+
+    def save(self, session: Session) -> None:
+        with self._lock:
+            high_water_mark = self.high_water_mark
+            # Rows after the high-water mark are read again anyway
+            exceptions = sorted(i for i in self.exceptions if i <= high_water_mark)
+            # The gaps under the mark are passed, filled or skipped
+            self.gaps = {i: seen for i, seen in self.gaps.items() if i > high_water_mark}
+            gaps = dict(self.gaps)
+        stmt = insert(HandlerProgress)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[HandlerProgress.source],
+            set_={
+                "high_water_mark": stmt.excluded.high_water_mark,
+                "exceptions": stmt.excluded.exceptions,
+                "gaps": stmt.excluded.gaps,
+                "updated_at": stmt.excluded.updated_at,
+            }
+        )
+        session.execute(stmt, [{
+            "source": self.source, "high_water_mark": high_water_mark, "exceptions": exceptions,
+            "gaps": {str(i): seen.isoformat() for i, seen in gaps.items()}, "updated_at": datetime.now()
+        }])
+        self._saved_gaps = gaps
+        self.saves += 1
+
+    def gaps_changed(self) -> bool:
+        """
+        Whether gaps were met since the last save, to save them even when no batch
+        moved the progress.
+        """
+        with self._lock:
+            return self.gaps != self._saved_gaps
+
+    def add_exceptions(self, ids: Iterable[int]) -> None:
+        """
+        Have rows up to the high-water mark refined again, e.g. replayed dead letters.
+        """
+        with self._lock:
+            self.exceptions.update(ids)
+
+    def batches(self, raw_conn, table: str, batch_size: BatchSize) -> Iterator[List[dict]]:
+        """
+        Batches of the rows still to refine: the exceptions, then the rows after the
+        high-water mark (see ``processing.raw_fetcher.iter_batches_after``). Exceptions
+        whose row no longer exists, e.g. quarantined, are dropped.
+        """
+        with self._lock:
+            retry = sorted(self.exceptions)
+        start = 0
+        while start < len(retry):
+            chunk = retry[start:start + next_batch_size(batch_size)]
+            start += len(chunk)
+            rows = fetch_rows_by_id(raw_conn, table, chunk)
+            with self._lock:
+                self.exceptions.difference_update(set(chunk) - {row['id'] for row in rows})
+            if rows:
+                self.retried += len(rows)
+                self._read(rows)
+                yield rows
+        for rows in iter_batches_after(raw_conn, table, batch_size, self.high_water_mark, self.gap_expired):
+            self._read(rows)
+            yield rows
+
+    def gap_expired(self, first_id: int) -> bool:
+        """
+        Record the gap starting at ``first_id`` and tell whether it has been missing for
+        ``gap_timeout`` seconds.
+        """
+        if self.gap_timeout is None:
+            return False
+        now = datetime.now()
+        with self._lock:
+            first_seen = self.gaps.setdefault(first_id, now)
+        return (now - first_seen).total_seconds() >= self.gap_timeout
+
+    def _read(self, rows: List[dict]) -> None:
+        with self._lock:
+            self._batches[rows[0]['id']] = [row['id'] for row in rows]
+
+    def ack(self, ids: List[int]) -> None:
+        with self._lock:
+            self._acked.update(ids)
+
+    def done(self, ids: List[int]) -> bool:
+        """
+        End the batch of ``ids``: its acked rows are refined, the others become exceptions.
+
+        :return: Whether the progress changed and should be saved.
+        """
+        with self._lock:
+            ids = set(ids)
+            acked = ids & self._acked
+            self._acked -= ids
+            changed = bool(acked & self.exceptions) or not (ids - acked) <= self.exceptions
+            self.exceptions -= acked
+            self.exceptions |= ids - acked
+            self._over.add(min(ids))
+            # Move the high-water mark over the batches over, in the order they were read
+            while self._batches:
+                first_id = next(iter(self._batches))
+                if first_id not in self._over:
+                    break
+                self._over.discard(first_id)
+                batch_ids = self._batches.pop(first_id)
+                if batch_ids[-1] > self.high_water_mark:
+                    self.high_water_mark = batch_ids[-1]
+                    changed = True
+            return changed
+
+    def report(self) -> str:
+        return (
+            f"{self.source} progress: high-water mark {self.high_water_mark}, {len(self.exceptions)} exceptions, "
+            f"{self.retried} rows retried, {len(self.gaps)} open gaps, {self.saves} saves"
+        )
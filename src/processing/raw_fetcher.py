@@ -0,0 +1,204 @@
+import logging
+from typing import Callable, Dict, Iterator, List, Optional, Union
+
+import psycopg2.extras
+
+from repository.prepared import PreparedStatement
+
+log = logging.getLogger(__name__)
+
+# Hash of the payload, the text of a JSONB value being canonical, see processing.change_detection
+CONTENT_HASH = "md5(data::text) AS content_hash"
+
+# A fixed batch size, or a function returning the size of the next batch
+BatchSize = Union[int, Callable[[], int]]
+
+
+# Keyset reads run for every batch, prepared once per connection, by name
+_statements: Dict[str, PreparedStatement] = {}
+
+
+def _statement(name: str, sql: str) -> PreparedStatement:
+    if name not in _statements:
+        _statements[name] = PreparedStatement(name, sql)
+    return _statements[name]
+
+
+def next_batch_size(batch_size: BatchSize) -> int:
+    return batch_size() if callable(batch_size) else batch_size
+
+
+def iter_unacked_batches(raw_conn, table: str, batch_size: BatchSize) -> Iterator[List[dict]]:
+    """
+    Stream the unacked rows of a raw table in id order, one batch at a time.
+
+    Uses keyset pagination: every batch is a separate ``id > last id`` query served by
+    the partial index on unacked rows, so only one batch is held in memory whatever
+    the size of the backlog, and rows acked meanwhile are not read again.
+
+    :param raw_conn: psycopg2 connection to the raw database.
+    :param table: Raw table to read, "allergies" or "patients".
+    :param batch_size: Maximum number of rows per batch, or a function returning it
+        before every batch, e.g. ``BatchSizeController.next_size``.
+    :return: Iterator over lists of rows as dictionaries (id, data, ack, created_at, content_hash).
+    """
+    last_id = 0
+    statement = _statement(
+        f"fetch_unacked_{table}",
+        f'SELECT id, data, ack, created_at, {CONTENT_HASH} FROM {table} WHERE ack = false AND id > %s ORDER BY id ASC LIMIT %s;'
+    )
+    with raw_conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as raw_cur:
+        while True:
+            statement.execute(raw_cur, [last_id, next_batch_size(batch_size)])
+            rows = raw_cur.fetchall()
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1]['id']
+
+
+def claim_unacked_batch(raw_conn, table: str, batch_size: int, worker_id: str, lease_seconds: float) -> List[dict]:
+    """
+    Lease up to ``batch_size`` unacked rows of a raw table to ``worker_id``.
+
+    Rows locked by a concurrent claim are skipped (``FOR UPDATE SKIP LOCKED``), so
+    several handler workers can claim at the same time without waiting on each other
+    nor getting the same rows. A row leased by a worker stays out of the other claims
+    until it is acked or its lease expires, the rows of a crashed worker are so
+    claimed again once their lease is over. The claim is committed before returning,
+    so the lease holds while the batch is being processed.
+
+    :param raw_conn: psycopg2 connection to the raw database.
+    :param table: Raw table to read, "allergies" or "patients".
+    :param batch_size: Maximum number of rows to claim.
+    :param worker_id: Name of the claiming worker, stored in ``claimed_by``.
+    :param lease_seconds: Duration of the lease.
+    :return: Claimed rows as dictionaries (id, data, ack, created_at, content_hash), in id order.
+    """
+    with raw_conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as raw_cur:
+        raw_cur.execute(
+            f'''
+            UPDATE {table}
+            SET claimed_by = %s, lease_expires_at = now() + %s * interval '1 second'
+            WHERE id IN (
+                SELECT id FROM {table}
+                WHERE ack = false AND (lease_expires_at IS NULL OR lease_expires_at < now())
+                ORDER BY id ASC
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, data, ack, created_at, {CONTENT_HASH};
+            ''',
+            [worker_id, lease_seconds, batch_size]
+        )
+        rows = raw_cur.fetchall()
+    if not raw_conn.autocommit:
+        raw_conn.commit()
+    return sorted(rows, key=lambda row: row['id'])
+
+
+def iter_claimed_batches(raw_conn, table: str, batch_size: BatchSize, worker_id: str, lease_seconds: float) -> Iterator[List[dict]]:
+    """
+    Claim and yield batches of unacked rows until none is left to claim, see
+    ``claim_unacked_batch``. Rows left unacked by this worker keep their lease and are
+    not claimed again before it expires, so a failing batch does not loop.
+    ``batch_size`` is an int or a function returning the size of the next batch.
+    """
+    while True:
+        rows = claim_unacked_batch(raw_conn, table, next_batch_size(batch_size), worker_id, lease_seconds)
+        if not rows:
+            return
+        yield rows
+
+
+def fetch_rows_by_id(raw_conn, table: str, ids: List[int]) -> List[dict]:
+    """
+    The rows of a raw table with the given ids that still exist, in id order.
+    """
+    with raw_conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as raw_cur:
+        raw_cur.execute(
+            f'SELECT id, data, ack, created_at, {CONTENT_HASH} FROM {table} WHERE id = ANY(%s) ORDER BY id ASC;',
+            [list(ids)]
+        )
+        return raw_cur.fetchall()
+
+
+def iter_batches_after(
+    raw_conn,
+    table: str,
+    batch_size: BatchSize,
+    after_id: int,
+    skip_gap: Optional[Callable[[int], bool]] = None
+) -> Iterator[List[dict]]:
+    """
+    Stream the rows of a raw table with an id above ``after_id``, in id order, one batch
+    at a time, whatever their ``ack``. Used with the high-water mark of
+    ``processing.progress``.
+
+    A row id missing from a batch may belong to a reader transaction not committed yet,
+    which the high-water mark must not skip. Every read tells, in the same statement,
+    whether another session holds a write lock on the table. While one does, a batch
+    stops at the first missing id and the iteration ends there, unless ``skip_gap``,
+    called with that id, tells to skip it: some ids are never written (a reader range
+    rolled back, a failed COPY flush, a quarantined row) and a writer that commits all
+    the time, e.g. the follow mode, would otherwise hold the mark before them forever.
+
+    Ids missing while nobody writes were rolled back or deleted, and are skipped. As
+    the lock check runs after the snapshot of the read, a writer may have committed in
+    between: such a gap is only skipped if the next read, from a later snapshot, still
+    misses it.
+
+    :param raw_conn: psycopg2 connection to the raw database, in autocommit.
+    :param table: Raw table to read, "allergies" or "patients".
+    :param batch_size: Maximum number of rows per batch, or a function returning it.
+    :param after_id: Id after which to read.
+    :param skip_gap: Called with the first missing id of a gap met while another session
+        writes, returns whether to skip the gap. Without it the iteration always stops.
+    :return: Iterator over lists of rows as dictionaries (id, data, ack, created_at, content_hash).
+    """
+    last_id = after_id
+    # First id of the last gap met while nobody wrote, skipped if the next read misses it too
+    unconfirmed = None
+    statement = _statement(
+        f"fetch_after_{table}",
+        f'''
+        SELECT id, data, ack, created_at, {CONTENT_HASH},
+            EXISTS (SELECT 1 FROM pg_locks WHERE relation = '{table}'::regclass
+                AND mode = 'RowExclusiveLock' AND pid <> pg_backend_pid()) AS writers_active
+        FROM {table} WHERE id > %s ORDER BY id ASC LIMIT %s;
+        '''
+    )
+    with raw_conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as raw_cur:
+        while True:
+            statement.execute(raw_cur, [last_id, next_batch_size(batch_size)])
+            rows = raw_cur.fetchall()
+            if not rows:
+                return
+            active = rows[0]['writers_active']
+            for row in rows:
+                del row['writers_active']
+            stop = None
+            expected = last_id + 1
+            for index, row in enumerate(rows):
+                if row['id'] != expected:
+                    if active:
+                        skip = skip_gap is not None and skip_gap(expected)
+                        if skip:
+                            log.warning("Skipping ids %d to %d of %s, missing for too long", expected, row['id'] - 1, table)
+                    else:
+                        skip = expected == unconfirmed
+                        unconfirmed = None if skip else expected
+                    if not skip:
+                        stop = index
+                        break
+                expected = row['id'] + 1
+            if stop is None:
+                yield rows
+                last_id = rows[-1]['id']
+                continue
+            if stop:
+                yield rows[:stop]
+                last_id = rows[stop - 1]['id']
+            if active:
+                log.info("Stopping %s at id %d, it may still be written by the reader", table, expected)
+                return
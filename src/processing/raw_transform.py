@@ -0,0 +1,91 @@
+import logging
+import time
+from typing import Dict, Iterator, List, NamedTuple, Set, Tuple, Union
+
+from metrics import rejection_reason
+from models.raw_allergy import RawAllergy
+from models.raw_patient import RawPatient
+from processing.refining_allergy import AllergyProcessor, PreparedAllergies
+from processing.refining_patients import PatientProcessor, PreparedPatients
+
+log = logging.getLogger(__name__)
+
+
+class TransformedBatch(NamedTuple):
+    # (raw row id, resource id) of the rows that passed the raw validation
+    row_ids: List[Tuple[int, str]]
+    prepared: Union[PreparedAllergies, PreparedPatients]
+    # Content hash by resource id of the rows that passed the raw validation
+    hashes: Dict[str, str]
+    # Ids of the resources refined before, with another content
+    replaced: Set[str]
+    # (raw row id, reason) of the rows that failed the raw validation
+    rejected: List[Tuple[int, str]]
+
+
+def _hashes(rows: List[dict], row_ids: List[Tuple[int, str]]) -> Tuple[Dict[str, str], Set[str]]:
+    by_id = {row['id']: row for row in rows}
+    hashes, replaced = {}, set()
+    for row_id, resource_id in row_ids:
+        row = by_id[row_id]
+        if row.get('content_hash') is not None:
+            hashes[resource_id] = row['content_hash']
+        if row.get('previous_hash') is not None:
+            replaced.add(resource_id)
+    return hashes, replaced
+
+
+def _validated(
+    rows: List[dict], model, label: str, row_ids: List[Tuple[int, str]], rejected: List[Tuple[int, str]]
+) -> Iterator:
+    """
+    Validate the raw rows one by one while they are refined, appending the ids of the
+    valid ones to ``row_ids``. The malformed rows are appended to ``rejected`` with
+    the reason and skipped, the handler logs them once per batch.
+    """
+    # Checked once per batch, the rows are only logged one by one at DEBUG
+    debug = log.isEnabledFor(logging.DEBUG)
+    for row in rows:
+        try:
+            if row['created_at'] is None:
+                raise ValueError("created_at is missing")
+            raw = model.model_validate(row['data'])
+        except Exception as e:
+            if debug:
+                log.debug("Skipping malformed %s %s row: %s", label, row['id'], e)
+            rejected.append((row['id'], rejection_reason(e)))
+            continue
+        row_ids.append((row['id'], raw.id))
+        if debug:
+            log.debug("Processing %s: %s", label, row['id'])
+        yield raw
+
+
+def transform_allergy_rows(rows: List[dict]) -> Tuple[float, TransformedBatch]:
+    """
+    Validate a batch of raw allergy rows and turn them into refined rows, in a single
+    pass. Runs in the handler process pool, so it does not access any database.
+
+    :param rows: Raw rows as dictionaries (id, data, ack, created_at), with their
+        ``content_hash`` and ``previous_hash`` when change detection is on.
+    :return: The seconds spent and the transformed batch.
+    """
+    start = time.perf_counter()
+    row_ids, rejected = [], []
+    prepared = AllergyProcessor.prepare_allergies(_validated(rows, RawAllergy, "allergy", row_ids, rejected))
+    return time.perf_counter() - start, TransformedBatch(row_ids, prepared, *_hashes(rows, row_ids), rejected)
+
+
+def transform_patient_rows(rows: List[dict]) -> Tuple[float, TransformedBatch]:
+    """
+    Validate a batch of raw patient rows and turn them into refined rows, in a single
+    pass. Runs in the handler process pool, so it does not access any database.
+
+    :param rows: Raw rows as dictionaries (id, data, ack, created_at), with their
+        ``content_hash`` and ``previous_hash`` when change detection is on.
+    :return: The seconds spent and the transformed batch.
+    """
+    start = time.perf_counter()
+    row_ids, rejected = [], []
+    prepared = PatientProcessor.prepare_patients(_validated(rows, RawPatient, "patient", row_ids, rejected))
+    return time.perf_counter() - start, TransformedBatch(row_ids, prepared, *_hashes(rows, row_ids), rejected)
@@ -0,0 +1,109 @@
+import time
+from typing import Dict, List, Sequence
+
+import psycopg2.extras
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from metrics import metrics
+from repository.backends import conflict_target
+
+WRITE_PATHS = ("core", "orm")
+
+# Refined keys are uuid.UUID, sent as they are by the core path
+psycopg2.extras.register_uuid()
+
+
+def _quoted(columns: Sequence[str]) -> str:
+    return ", ".join(f'"{column}"' for column in columns)
+
+
+class RefinedWriter:
+    """
+    Insert rows given as column tuples into the refined tables, the rows conflicting on
+    the unique ``key`` being skipped, or updated on the ``update`` columns.
+
+    The "core" path sends the tuples with psycopg2 ``execute_values``, ``page_size``
+    rows per statement, on the connection and in the transaction of the session. On
+    another driver, e.g. an embedded SQLite database (see ``repository.backends``), it
+    is a single Core ``executemany`` of the rows. The "orm" path is an ORM bulk insert
+    of one dictionary per row.
+
+    The rows written and the time spent are kept by table, and recorded in ``metrics``.
+    """
+
+    def __init__(self, path: str = "core", page_size: int = 1000) -> None:
+        if path not in WRITE_PATHS:
+            raise ValueError(f"Unknown write path {path!r}, expected one of {WRITE_PATHS}")
+        self.path = path
+        self.page_size = page_size
+        # Table name to [rows, seconds]
+        self.stats: Dict[str, List[float]] = {}
+
+    def insert(
+        self,
+        session: Session,
+        model,
+        columns: Sequence[str],
+        rows: List[tuple],
+        key: Sequence[str],
+        update: Sequence[str] = ()
+    ) -> None:
+        """
+        :param session: Session on the refined database.
+        :param model: ORM model of the table.
+        :param columns: Columns of the tuples.
+        :param rows: One tuple per row, in the order of ``columns``.
+        :param key: Columns of the unique index the rows may conflict on.
+        :param update: Columns updated on conflict. The conflicting rows are skipped when empty.
+        """
+        if not rows:
+            return
+        start = time.perf_counter()
+        if self.path == "orm":
+            self._insert_orm(session, model, columns, rows, key, update)
+        elif session.get_bind().dialect.driver == "psycopg2":
+            self._insert_core(session, model, columns, rows, key, update)
+        else:
+            self._insert_executemany(session, model, columns, rows, key, update)
+        elapsed = time.perf_counter() - start
+        stats = self.stats.setdefault(model.__tablename__, [0, 0.0])
+        stats[0] += len(rows)
+        stats[1] += elapsed
+        metrics.observe("refined_write_seconds", elapsed, table=model.__tablename__)
+        metrics.inc("refined_rows_total", len(rows), table=model.__tablename__)
+
+    def _insert_core(self, session: Session, model, columns, rows, key, update) -> None:
+        if update:
+            conflict = "DO UPDATE SET " + ", ".join(f'"{column}" = EXCLUDED."{column}"' for column in update)
+        else:
+            conflict = "DO NOTHING"
+        sql = f"INSERT INTO {model.__tablename__} ({_quoted(columns)}) VALUES %s ON CONFLICT ({_quoted(key)}) {conflict}"
+        with session.connection().connection.cursor() as cursor:
+            psycopg2.extras.execute_values(cursor, sql, rows, page_size=self.page_size)
+
+    def _upsert(self, session: Session, model, table, key, update):
+        stmt = insert(table)
+        index_elements = conflict_target(session, model, key)
+        if update:
+            return stmt.on_conflict_do_update(
+                index_elements=index_elements,
+                set_={column: stmt.excluded[column] for column in update}
+            )
+        return stmt.on_conflict_do_nothing(index_elements=index_elements)
+
+    def _insert_executemany(self, session: Session, model, columns, rows, key, update) -> None:
+        # On the table rather than the model, the ORM would split the rows in groups
+        # of the same NULL columns
+        stmt = self._upsert(session, model, model.__table__, key, update)
+        session.connection().execute(stmt, [dict(zip(columns, row)) for row in rows])
+
+    def _insert_orm(self, session: Session, model, columns, rows, key, update) -> None:
+        stmt = self._upsert(session, model, model, key, update)
+        session.execute(stmt, [dict(zip(columns, row)) for row in rows])
+
+    def report(self) -> List[str]:
+        return [
+            f"{table}: {int(rows)} rows in {seconds:.2f}s ({rows / seconds if seconds else 0:.0f} rows/s, {self.path} path)"
+            for table, (rows, seconds) in self.stats.items()
+        ]
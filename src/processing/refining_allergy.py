@@ -1,89 +1,126 @@
-from typing import List, Tuple
+import logging
+from typing import Iterable, List, NamedTuple, Optional, Set, Tuple
 from datetime import datetime
-from sqlalchemy import tuple_
 from uuid import UUID
 
 from exceptions.exceptions import *
 from models.raw_allergy import RawAllergy
 from models.allergy_event import AllergyEventSchema
 from models.allergy_code import AllergyCodeSchema
-from models.tables.allergy_refined_tables import AllergyCodes, AllergyEvents
+from models.tables.allergy_refined_tables import AllergyEvents
+from processing.code_cache import AllergyCodeCache
+from processing.refined_writer import RefinedWriter
 from repository.database import SessionDatabase
 
+log = logging.getLogger(__name__)
+
+ALLERGY_EVENT_COLUMNS = ("uuid", "patient_uuid", "category", "criticality", "code_id", "recorded_date", "created_at")
+
+
+class PreparedAllergies(NamedTuple):
+    # Event row in ALLERGY_EVENT_COLUMNS order without code_id nor created_at, with the key of its code
+    events: List[Tuple[tuple, Tuple[str, str, str]]]
+    code_keys: Set[Tuple[str, str, str]]
+    failed_allergy_code: List[Tuple[str, str]]
+    failed_allergy_event: List[Tuple[str, str]]
+
 
 class AllergyProcessor:
     @staticmethod
-    def process_allergies(session: SessionDatabase, allergy_rows: List[RawAllergy]) -> Tuple[bool, dict]:
+    def process_allergies(
+        session: SessionDatabase,
+        allergy_rows: List[RawAllergy],
+        code_cache: Optional[AllergyCodeCache] = None
+    ) -> Tuple[bool, dict]:
         """
         Process a RawAllergy instance and return an AllergyRefinedTables instance.
         
         :param allergy_row: An instance of RawAllergy containing the raw allergy data.
         :return: An instance of AllergyRefinedTables with processed allergy data.
         """
+        return AllergyProcessor.write_allergies(session, AllergyProcessor.prepare_allergies(allergy_rows), code_cache)
+
+    @staticmethod
+    def prepare_allergies(allergy_rows: Iterable[RawAllergy]) -> PreparedAllergies:
+        """
+        Validate the coding and the event of every allergy and turn it into its event
+        row, in a single pass, without database access so it can run in another process
+        than the writes.
+
+        :param allergy_rows: Validated raw allergies, consumed once.
+        :return: The event rows with the key of their code, still without ``code_id``,
+            the keys of the codes to look up and the failures.
+        """
         failed_allergy_code = []
         failed_allergy_event = []
         code_keys = set()
+        events = []
         for allergy_row in allergy_rows:
             try:
                 coding = AllergyCodeSchema(**allergy_row.code.coding[0].model_dump())
             except Exception as e:
-                print("Got an allergy coding schema incompatibility")
+                log.debug("Allergy coding schema incompatibility for uuid %s: %s", allergy_row.id, e)
                 failed_allergy_code.append((allergy_row.id, "Coding schema incompatibility: " + str(e)))
                 continue
-            code_keys.add((coding.code, coding.system, coding.display))
-
-        
-        existing_codes = session.query(AllergyCodes).filter(
-            tuple_(AllergyCodes.code, AllergyCodes.system, AllergyCodes.display).in_(code_keys)
-        ).all()
-        code_map = {(c.code, c.system, c.display): c for c in existing_codes}
-
-        missing_code_keys = [key for key in code_keys if key not in code_map]
+            code_key = (coding.code, coding.system, coding.display)
+            code_keys.add(code_key)
+            try:
+                allergy_event_schema = AllergyEventSchema(
+                    uuid=UUID(allergy_row.id),
+                    patient_uuid=allergy_row.patient.reference,
+                    category=allergy_row.category,
+                    criticality=allergy_row.criticality,
+                    recorded_date=allergy_row.recordedDate
+                )
+            except Exception as e:
+                log.debug("Allergy event schema incompatibility for uuid %s: %s", allergy_row.id, e)
+                failed_allergy_event.append((allergy_row.id, "Allergy event schema incompatibility: " + str(e)))
+                continue
+            events.append(((
+                allergy_event_schema.uuid,
+                allergy_event_schema.patient_uuid,
+                allergy_event_schema.category.value if allergy_event_schema.category else None,
+                allergy_event_schema.criticality,
+                allergy_event_schema.recorded_date
+            ), code_key))
+        return PreparedAllergies(events, code_keys, failed_allergy_code, failed_allergy_event)
 
-        new_code_objs = [
-            AllergyCodes(code=code, system=system, display=display)
-            for code, system, display in missing_code_keys
-        ]
-        if new_code_objs:
-            session.bulk_save_objects(new_code_objs)
+    @staticmethod
+    def write_allergies(
+        session: SessionDatabase,
+        prepared: PreparedAllergies,
+        code_cache: Optional[AllergyCodeCache] = None,
+        writer: Optional[RefinedWriter] = None
+    ) -> Tuple[bool, dict]:
+        """
+        Store the allergy events, with the codes missing from the refined database.
+        Events already stored are updated.
 
-        all_codes = session.query(AllergyCodes).filter(
-            tuple_(AllergyCodes.code, AllergyCodes.system, AllergyCodes.display).in_(code_keys)
-        ).all()
-        code_map = {(c.code, c.system, c.display): c for c in all_codes}
+        :param session: Session on the refined database.
+        :param prepared: Output of ``prepare_allergies``.
+        :param code_cache: Cache resolving the code ids, kept across batches. A new one
+            is used when not given.
+        :param writer: Writer of the refined rows, a new one on the core path when not given.
+        :return: Whether every allergy was refined, and the failures by kind.
+        """
+        code_cache = code_cache if code_cache is not None else AllergyCodeCache()
+        code_ids = code_cache.resolve(session, prepared.code_keys)
 
-        allergy_events = []
-        for allergy_row in allergy_rows:
-            coding_valid = True
-            try:
-                coding = AllergyCodeSchema(**allergy_row.code.coding[0].model_dump())
-            except Exception as e:
-                coding_valid = False
-                print("Already caught before, no need to log again...")
-            if coding_valid:
-                code_obj = code_map[(coding.code, coding.system, coding.display)]
-                try:
-                    allergy_event_schema = AllergyEventSchema(
-                        uuid=UUID(allergy_row.id),
-                        patient_uuid=allergy_row.patient.reference,
-                        category=allergy_row.category,
-                        criticality=allergy_row.criticality,
-                        code_id=code_obj.id,
-                        recorded_date=allergy_row.recordedDate
-                    )
-                except Exception as e:
-                    print(f"Got an allergy event schema incompatibility for uuid {allergy_row.id}")
-                    print(e)
-                    failed_allergy_event.append((allergy_row.id, "Allergy event schema incompatibility: " + str(e)))
-                    continue
-                allergy_event = AllergyEvents(
-                    **allergy_event_schema.model_dump(),
-                    created_at=datetime.now()
-                )
-                allergy_events.append(allergy_event)
+        # By uuid, the last version of an event sent twice in the batch wins
+        allergy_events = {}
+        created_at = datetime.now()
+        for (uuid, patient_uuid, category, criticality, recorded_date), code_key in prepared.events:
+            allergy_events[uuid] = (uuid, patient_uuid, category, criticality, code_ids[code_key], recorded_date, created_at)
 
-        session.bulk_save_objects(allergy_events)
+        # An event refined again, its resource having changed, is updated in place
+        writer = writer if writer is not None else RefinedWriter()
+        writer.insert(
+            session, AllergyEvents, ALLERGY_EVENT_COLUMNS, list(allergy_events.values()),
+            key=("uuid",), update=ALLERGY_EVENT_COLUMNS[1:-1]
+        )
         
+        failed_allergy_code = prepared.failed_allergy_code
+        failed_allergy_event = prepared.failed_allergy_event
         all_data_success = len(failed_allergy_code) == 0 and len(failed_allergy_event) == 0
         return all_data_success, {
             "failed_allergy_coding_schema": failed_allergy_code,
@@ -1,18 +1,53 @@
-from typing import List, Tuple
+import logging
+from typing import Iterable, List, NamedTuple, Optional, Tuple
 from uuid import UUID
+from sqlalchemy import delete
 from sqlalchemy.orm import Session
-from sqlalchemy import tuple_, and_, or_
 
+from metrics import rejection_reason
 from models.raw_patient import RawPatient
 from models.patient import Patient as PatientModel
 from models.address import Address as AddressModel
 from models.telecom import Telecom as TelecomModel
 from models.patient_name import PatientName as PatientNameModel
 from models.tables.patient_refined_tables import Patient, PatientName, Address, Telecom
+from processing.refined_writer import RefinedWriter
+
+log = logging.getLogger(__name__)
+
+PATIENT_COLUMNS = ("uuid", "birth_date", "gender")
+PATIENT_NAME_COLUMNS = ("patient_uuid", "use", "family", "given", "prefix")
+ADDRESS_COLUMNS = ("patient_uuid", "line", "city", "state", "postal_code", "country")
+TELECOM_COLUMNS = ("patient_uuid", "system", "value", "use")
+
+class PreparedPatients(NamedTuple):
+    # Rows in the order of the *_COLUMNS of their table
+    patients: List[tuple]
+    names: List[tuple]
+    addresses: List[tuple]
+    telecoms: List[tuple]
+    failed_patients: List[Tuple[str, str]]
+    failed_names: List[Tuple[str, str]]
+    failed_addresses: List[Tuple[str, str]]
+    failed_telecoms: List[Tuple[str, str]]
+
 
 class PatientProcessor:
     @staticmethod
     def process_patients(session: Session, patient_rows: List[RawPatient]) -> Tuple[bool, dict]:
+        return PatientProcessor.write_patients(session, PatientProcessor.prepare_patients(patient_rows))
+
+    @staticmethod
+    def prepare_patients(patient_rows: Iterable[RawPatient]) -> PreparedPatients:
+        """
+        Validate the patients with their names, addresses and telecoms and turn them into
+        their rows, in a single pass, without database access so it can run in another
+        process than the writes. A patient is kept only with at least one valid name,
+        address and telecom.
+
+        :param patient_rows: Validated raw patients, consumed once.
+        :return: The rows of the kept patients and the failures.
+        """
         failed_patients = []
         failed_names = []
         failed_addresses = []
@@ -22,18 +57,12 @@ class PatientProcessor:
         address_objs = []
         telecom_objs = []
 
-        # Collect unique keys for deduplication
-        patient_uuids = set()
-        patient_name_keys = set()
-        address_keys = set()
-        telecom_keys = set()
-
         # Prepare objects to insert
         for patient_row in patient_rows:
             try:
                 patient_uuid = UUID(patient_row.id)
             except Exception as e:
-                print(f"Skipping patient {patient_row.id} due to invalid UUID: {e}")
+                log.debug("Skipping patient %s due to invalid UUID: %s", patient_row.id, e)
                 failed_patients.append((patient_row.id, f"Invalid UUID: {e}"))
                 continue
 
@@ -48,12 +77,13 @@ class PatientProcessor:
                         given=name.given,
                         prefix=name.prefix if name.prefix else None
                     )
-                    patient_names.append(patient_name)
-                    key = (str(patient_name.patient_uuid), patient_name.use, patient_name.family, patient_name.given, patient_name.prefix if patient_name.prefix else None)
-                    patient_name_keys.add(key)
+                    patient_names.append((
+                        patient_name.patient_uuid, patient_name.use, patient_name.family, patient_name.given,
+                        patient_name.prefix if patient_name.prefix else None
+                    ))
                 except Exception as e:
-                    print(f"Skipping name for patient {patient_row.id} due to error: {e}")
-                    failed_names.append((patient_row.id, str(e)))
+                    log.debug("Skipping name for patient %s due to error: %s", patient_row.id, e)
+                    failed_names.append((patient_row.id, rejection_reason(e)))
             if not patient_names:
                 failed_patients.append((patient_row.id, "No valid names found"))
                 continue
@@ -70,19 +100,13 @@ class PatientProcessor:
                         postal_code=getattr(address, "postalCode", None),
                         country=address.country
                     )
-                    patient_addresses.append(patient_address)
-                    key = (
-                        str(patient_address.patient_uuid),
-                        patient_address.city,
-                        patient_address.state,
-                        patient_address.country,
-                        patient_address.postal_code,
-                        patient_address.full_line_str
-                    )
-                    address_keys.add(key)
+                    patient_addresses.append((
+                        patient_address.patient_uuid, patient_address.full_line_str, patient_address.city,
+                        patient_address.state, patient_address.postal_code, patient_address.country
+                    ))
                 except Exception as e:
-                    print(f"Skipping address for patient {patient_row.id} due to error: {e}")
-                    failed_addresses.append((patient_row.id, str(e)))
+                    log.debug("Skipping address for patient %s due to error: %s", patient_row.id, e)
+                    failed_addresses.append((patient_row.id, rejection_reason(e)))
             if not patient_addresses:
                 failed_patients.append((patient_row.id, "No valid addresses found"))
                 continue
@@ -97,17 +121,12 @@ class PatientProcessor:
                         value=telecom.value,
                         use=telecom.use
                     )
-                    patient_telecoms.append(patient_telecom)
-                    key = (
-                        str(patient_telecom.patient_uuid), 
-                        patient_telecom.system, 
-                        patient_telecom.value, 
-                        patient_telecom.use
-                    )
-                    telecom_keys.add(key)
+                    patient_telecoms.append((
+                        patient_telecom.patient_uuid, patient_telecom.system, patient_telecom.value, patient_telecom.use
+                    ))
                 except Exception as e:
-                    print(f"Skipping telecom for patient {patient_row.id} due to error: {e}")
-                    failed_telecoms.append((patient_row.id, str(e)))
+                    log.debug("Skipping telecom for patient %s due to error: %s", patient_row.id, e)
+                    failed_telecoms.append((patient_row.id, rejection_reason(e)))
             if not patient_telecoms:
                 failed_patients.append((patient_row.id, "No valid telecoms found"))
                 continue
@@ -120,132 +139,71 @@ class PatientProcessor:
                     gender=patient_row.gender
                 )
             except Exception as e:
-                print(f"Skipping patient {patient_row.id} due to schema incompatibility: {e}")
-                failed_patients.append((patient_row.id, str(e)))
+                log.debug("Skipping patient %s due to schema incompatibility: %s", patient_row.id, e)
+                failed_patients.append((patient_row.id, rejection_reason(e)))
                 continue
 
             # Only add patient if there is at least one of each
             if patient_names and patient_addresses and patient_telecoms:
-                patient_objs.append(patient_schema)
+                patient_objs.append((patient_schema.uuid, patient_schema.birth_date, patient_schema.gender.value))
                 patient_name_objs.extend(patient_names)
                 address_objs.extend(patient_addresses)
                 telecom_objs.extend(patient_telecoms)
-        
-
-        # Query existing records
-        existing_patients = set(r[0] for r in session.query(Patient.uuid).filter(Patient.uuid.in_(patient_uuids)).all())
-
-        # PatientName deduplication
-        existing_names = set()
-        if patient_name_keys:
-            name_filters = [
-                and_(
-                    PatientName.patient_uuid == k[0],
-                    PatientName.use == k[1],
-                    PatientName.family == k[2],
-                    PatientName.given == k[3],
-                    PatientName.prefix == k[4],
-                ) for k in patient_name_keys
-            ]
-            existing_names = set(
-                tuple(r) for r in session.query(
-                    PatientName.patient_uuid, PatientName.use, PatientName.family, PatientName.given, PatientName.prefix
-                ).filter(or_(*name_filters)).all()
-            )
-
-        # Address deduplication
-        existing_addresses = set()
-        if address_keys:
-            address_filters = [
-                and_(
-                    Address.patient_uuid == k[0],
-                    Address.city == k[1],
-                    Address.state == k[2],
-                    Address.country == k[3],
-                    Address.postal_code == k[4],
-                    Address.line == k[5],
-                ) for k in address_keys
-            ]
-            existing_addresses = set(
-                tuple(r) for r in session.query(
-                    Address.patient_uuid, Address.city, Address.state, Address.country, Address.postal_code, Address.line
-                ).filter(or_(*address_filters)).all()
-            )
-
-        # Telecom deduplication
-        existing_telecoms = set()
-        if telecom_keys:
-            telecom_filters = [
-                and_(
-                    Telecom.patient_uuid == k[0],
-                    Telecom.system == k[1],
-                    Telecom.value == k[2],
-                    Telecom.use == k[3],
-                ) for k in telecom_keys
-            ]
-            existing_telecoms = set(
-                tuple(r) for r in session.query(
-                    Telecom.patient_uuid, Telecom.system, Telecom.value, Telecom.use
-                ).filter(or_(*telecom_filters)).all()
-            )
-
-        # Filter out objects that already exist in DB
-        patient_objs_to_insert = []
-        for p in patient_objs:
-            if p.uuid not in existing_patients:
-                patient_objs_to_insert.append(Patient(
-                        uuid=p.uuid,
-                        birth_date=p.birth_date,
-                        gender=p.gender
-                    )
-                )
-        patient_name_objs_to_insert = []
-        for n in patient_name_objs:
-            if (n.patient_uuid, n.use, n.family, n.given, n.prefix if n.prefix else None) not in existing_names:
-                patient_name_objs_to_insert.append(PatientName(
-                        patient_uuid=n.patient_uuid,
-                        use=n.use,
-                        family=n.family,
-                        given=n.given,
-                        prefix=n.prefix if n.prefix else None
-                    )
-                )
-        address_objs_to_insert = []
-        for a in address_objs:
-            if (a.patient_uuid, a.city, a.state, a.country, a.postal_code, a.full_line_str) not in existing_addresses:
-                address_objs_to_insert.append(Address(
-                        patient_uuid=a.patient_uuid,
-                        line=a.full_line_str,
-                        city=a.city,
-                        state=a.state,
-                        postal_code=a.postal_code,
-                        country=a.country
-                    )
-                )
-        telecom_objs_to_insert = []
-        for t in telecom_objs:
-            if (t.patient_uuid, t.system, t.value, t.use) not in existing_telecoms:
-                telecom_objs_to_insert.append(Telecom(
-                        patient_uuid=t.patient_uuid,
-                        system=t.system,
-                        value=t.value,
-                        use=t.use
-                    )
-                )
+        return PreparedPatients(
+            patient_objs, patient_name_objs, address_objs, telecom_objs,
+            failed_patients, failed_names, failed_addresses, failed_telecoms
+        )
+
+    @staticmethod
+    def write_patients(
+        session: Session,
+        prepared: PreparedPatients,
+        replaced: Iterable[str] = (),
+        writer: Optional[RefinedWriter] = None
+    ) -> Tuple[bool, dict]:
+        """
+        Store the prepared patients, names, addresses and telecoms. The rows already in
+        the refined database, or twice in the batch, are skipped by the database on
+        their natural-key unique index, whatever the size of the batch.
+
+        Patients already stored are updated. The names, addresses and telecoms of the
+        ``replaced`` patients, whose resource changed, are replaced by the new ones.
+
+        :param session: Session on the refined database.
+        :param prepared: Output of ``prepare_patients``.
+        :param replaced: Ids of the patients refined before from another content.
+        :param writer: Writer of the refined rows, a new one on the core path when not given.
+        :return: Whether every patient was refined, and the failures by kind.
+        """
+        patient_objs, patient_name_objs, address_objs, telecom_objs = prepared[:4]
+        failed_patients, failed_names, failed_addresses, failed_telecoms = prepared[4:]
+
+        writer = writer if writer is not None else RefinedWriter()
+        # By uuid, the last version of a patient sent twice in the batch wins
+        patient_rows = list({p[0]: p for p in patient_objs}.values())
+
+        # Patients first, the other tables reference them
+        writer.insert(session, Patient, PATIENT_COLUMNS, patient_rows, key=("uuid",), update=("birth_date", "gender"))
+
+        replaced_uuids = set()
+        for patient_id in replaced:
+            try:
+                replaced_uuids.add(UUID(patient_id))
+            except ValueError:
+                continue
+        replaced_uuids &= set(p[0] for p in patient_objs)
+        if replaced_uuids:
+            for table in (PatientName, Address, Telecom):
+                session.execute(delete(table).where(table.patient_uuid.in_(replaced_uuids)))
+
+        writer.insert(session, PatientName, PATIENT_NAME_COLUMNS, patient_name_objs, key=PATIENT_NAME_COLUMNS)
+        writer.insert(session, Address, ADDRESS_COLUMNS, address_objs, key=("patient_uuid", "city", "state", "country", "postal_code", "line"))
+        writer.insert(session, Telecom, TELECOM_COLUMNS, telecom_objs, key=TELECOM_COLUMNS)
 
-        # Bulk insert
-        if patient_objs_to_insert:
-            session.bulk_save_objects(patient_objs_to_insert)
-        if patient_name_objs_to_insert:
-            session.bulk_save_objects(patient_name_objs_to_insert)
-        if address_objs_to_insert:
-            session.bulk_save_objects(address_objs_to_insert)
-        if telecom_objs_to_insert:
-            session.bulk_save_objects(telecom_objs_to_insert)
         success = len(failed_patients) == 0 and len(failed_names) == 0 and len(failed_addresses) == 0 and len(failed_telecoms) == 0
         return success, {
             "failed_patients": failed_patients,
             "failed_names": failed_names,
             "failed_addresses": failed_addresses,
             "failed_telecoms": failed_telecoms
-        }
\ No newline at end of file
+        }
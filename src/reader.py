@@ -1,85 +1,352 @@
 import json
+import logging
 import ndjson
 import psycopg2
 import psycopg2.extras
 import os
-from datetime import datetime
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+from typing import Callable, List, NamedTuple, Optional, Tuple
 
+from ingestion.checkpoints import advance_checkpoint, create_checkpoint_table, file_identity, resume_plan
+from ingestion.copy_buffer import CopyBuffer
+from ingestion.decoding import LineDecoder, repair_allergy_line, repair_patient_line
+from ingestion.follow import DirectoryFollower, FollowedSource
+from ingestion.sharding import plan_shards
+from ingestion.sources import iter_lines
+from repository.raw_schema import RAW_TABLES, create_raw_table, ensure_partitions
+from logs import RateLimitedLog, configure_logging
+from metrics import metrics
 from settings import settings
 
-def read_and_store_data():
+READER_MODES = ("insert", "copy")
+
+log = logging.getLogger(__name__)
+# A few malformed lines per file and minute are logged, they are all counted in the file summary
+malformed_lines = RateLimitedLog(log)
+
+
+# (input file, raw table, label used in logs, line repair)
+SOURCES = [
+    (settings.PATIENT_INPUT_PATH, 'patients', 'patient', repair_patient_line),
+    (settings.ALLERGY_INPUT_PATH, 'allergies', 'allergy', repair_allergy_line),
+]
+
+
+def connect_raw_db():
+    return psycopg2.connect(
+        dbname=settings.RAW_DB_NAME,
+        user=settings.RAW_DB_USER,
+        password=settings.RAW_DB_PASSWORD,
+        host=settings.RAW_DB_HOST,
+        port=settings.RAW_DB_PORT
+    )
+
+
+def create_raw_tables(cur) -> None:
+    for table in RAW_TABLES:
+        create_raw_table(cur, table, partitioned=settings.RAW_PARTITION_BY_CREATED_AT)
+        ensure_partitions(cur, table, date.today())
+        log.info("%s table created or already exists.", table.capitalize())
+
+
+def store_file(
+    cur,
+    path: str,
+    table: str,
+    label: str,
+    decoder: LineDecoder,
+    mode: str = "copy",
+    start: int = 0,
+    end: Optional[int] = None,
+    checkpoint: Optional[Callable[[int], None]] = None
+) -> Tuple[int, int]:
+    """
+    Read a NDJSON file, or a byte range of it, and store every well-formed line in a raw table.
+
+    :param cur: Cursor on the raw database, inside the caller's transaction.
+    :param path: Path of the NDJSON file.
+    :param table: Raw table receiving the documents.
+    :param label: Resource name used when reporting malformed lines.
+    :param decoder: Decoding stage repairing and parsing each line.
+    :param mode: "insert" for one INSERT per line, "copy" for buffered COPY FROM STDIN.
+    :param start: Offset of the first line to read, must be a line boundary.
+    :param end: Offset where reading stops, None reads until the end of the file.
+    :param checkpoint: Called with the offset of the next unread line each time the
+        lines before it are sent to the database, and once the range is done.
+    :return: Number of stored lines and number of malformed lines.
+    """
+    if mode not in READER_MODES:
+        raise ValueError(f"Unknown reader mode '{mode}', expected one of {READER_MODES}")
+    copy_buffer = None
+    if mode == "copy":
+        copy_buffer = CopyBuffer(
+            cur,
+            table,
+            max_rows=settings.READER_COPY_BUFFER_ROWS,
+            max_bytes=settings.READER_COPY_BUFFER_BYTES
+        )
+    stored = 0
+    malformed = 0
+    position = start
+    for i, (offset, raw) in enumerate(iter_lines(path, start, end), 1):
+        position = offset + len(raw)
+        try:
+            line = str(raw, 'utf-8').strip()
+            if not line:
+                continue
+            # The document is only decoded to validate the line, the repaired line is what gets stored
+            line, _ = decoder.decode(line)
+            if copy_buffer is None:
+                cur.execute(f'INSERT INTO {table} (data, created_at) VALUES (%s::jsonb,%s);', [line, datetime.now()])
+        except Exception as e:
+            malformed += 1
+            # Line numbers are only known when reading from the beginning of the file
+            location = f"line {i}" if start == 0 else f"line at byte {offset}"
+            malformed_lines.warning(path, "Skipping malformed %s %s of %s: %s", label, location, path, e)
+            continue
+        stored += 1
+        if copy_buffer is not None:
+            # COPY errors concern the whole buffer, they are not a malformed line
+            if copy_buffer.add(line) and checkpoint:
+                checkpoint(position)
+        elif checkpoint and stored % settings.READER_CHECKPOINT_ROWS == 0:
+            checkpoint(position)
+    if copy_buffer is not None:
+        copy_buffer.flush()
+    if checkpoint:
+        checkpoint(position if end is None else max(position, end))
+    return stored, malformed
+
+
+class ShardReport(NamedTuple):
+    path: str
+    start: int
+    end: int
+    stored: int
+    malformed: int
+    error: Optional[str] = None
+    seconds: float = 0.0
+
+
+def store_shard(
+    path: str,
+    table: str,
+    label: str,
+    decoder: LineDecoder,
+    mode: str,
+    start: int,
+    end: int,
+    committed_offset: int
+) -> ShardReport:
+    """
+    Load one byte range of a NDJSON file in its own connection, committing at every
+    checkpoint. Runs inside the reader process pool.
+
+    :param start: Offset of the shard, identifying its checkpoint.
+    :param committed_offset: Offset where the previous runs stopped.
+    """
+    conn = None
+    started = time.perf_counter()
+    try:
+        conn = connect_raw_db()
+        conn.autocommit = False
+        with conn.cursor() as cur:
+            def checkpoint(offset: int) -> None:
+                advance_checkpoint(cur, path, start, offset)
+                conn.commit()
+
+            stored, malformed = store_file(cur, path, table, label, decoder, mode, committed_offset, end, checkpoint)
+        conn.commit()
+        return ShardReport(path, start, end, stored, malformed, seconds=time.perf_counter() - started)
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        return ShardReport(
+            path, start, end, 0, 0, f"{e} (stopped after the last checkpoint)", time.perf_counter() - started
+        )
+    finally:
+        if conn:
+            conn.close()
+
+
+def read_and_store_data_parallel(mode: str, workers: int, sources: Optional[List[tuple]] = None) -> List[ShardReport]:
+    """
+    Split every input file into newline-aligned shards and load them in a process pool.
+    Each shard is committed on its own, so a failing shard does not roll back the others.
+    Shards planned by a previous run are resumed from their checkpoint.
+
+    :param sources: Files to load, as in ``SOURCES`` (the default).
+    """
+    sources = SOURCES if sources is None else sources
+    def plan(start: int, end: int) -> List[Tuple[int, int]]:
+        # A few shards per worker keeps the pool busy when lines have uneven sizes
+        return plan_shards(path, workers * settings.READER_SHARDS_PER_WORKER, start=start, end=end)
+
+    conn = connect_raw_db()
+    shards = []
+    try:
+        with conn.cursor() as cur:
+            create_raw_tables(cur)
+            create_checkpoint_table(cur)
+            for path, table, label, repair in sources:
+                pending = [c for c in resume_plan(cur, file_identity(path), plan) if not c.done]
+                if not pending:
+                    log.info("%s was already loaded, skipping it.", path)
+                decoder = LineDecoder(repair, settings.READER_JSON_BACKEND)
+                shards.extend((path, table, label, decoder, c) for c in pending)
+        conn.commit()
+    finally:
+        conn.close()
+
+    reports = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(store_shard, path, table, label, decoder, mode, c.start, c.end, c.committed_offset)
+            for path, table, label, decoder, c in shards
+        ]
+        for future in futures:
+            reports.append(future.result())
+
+    for path, table, label, _ in sources:
+        file_reports = [r for r in reports if r.path == path]
+        if not file_reports:
+            continue
+        stored = sum(r.stored for r in file_reports)
+        malformed = sum(r.malformed for r in file_reports)
+        # The shards ran in the pool processes, their metrics are recorded here
+        for r in file_reports:
+            metrics.observe("reader_load_seconds", r.seconds, table=table)
+        metrics.inc("reader_lines_total", stored, table=table, outcome="stored")
+        metrics.inc("reader_lines_total", malformed, table=table, outcome="malformed")
+        failed = [r for r in file_reports if r.error]
+        log.info(
+            "Stored %d %s lines from %s (%d malformed) in %d shards using %s mode.",
+            stored, label, path, malformed, len(file_reports), mode
+        )
+        for r in failed:
+            log.error("Shard %d-%d of %s failed and was rolled back: %s", r.start, r.end, path, r.error)
+    return reports
+
+
+def read_and_store_data(mode: str = None, workers: int = None, sources: Optional[List[tuple]] = None):
+    mode = mode or settings.READER_MODE
+    workers = workers or settings.READER_WORKERS
+    sources = SOURCES if sources is None else sources
+    if workers > 1:
+        read_and_store_data_parallel(mode, workers, sources)
+        return
     # Connect to PostgreSQL for data history
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(
-            dbname=settings.RAW_DB_NAME,
-            user=settings.RAW_DB_USER,
-            password=settings.RAW_DB_PASSWORD,
-            host=settings.RAW_DB_HOST,
-            port=settings.RAW_DB_PORT
-        )
+        conn = connect_raw_db()
         cur = conn.cursor()
         # Start transaction
         conn.autocommit = False
 
         # Create tables if not exist
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS patients (
-                id SERIAL PRIMARY KEY,
-                data JSONB,
-                ack BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP
-            );
-        ''')
-        print("Patients table created or already exists.")
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS allergies (
-                id SERIAL PRIMARY KEY,
-                data JSONB,
-                ack BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP
-            );
-        ''')
-        print("Allergies table created or already exists.")
-
-        # Read Patient data
-        with open('/data/Patient.ndjson', 'r') as f:
-            for i, line in enumerate(f, 1):
-                line = line.strip()
-                if not line:
-                    continue
-                try:
-                    line = line.replace(":,",":null,")
-                    patient = json.loads(line)
-                    cur.execute('INSERT INTO patients (data, created_at) VALUES (%s,%s);', [psycopg2.extras.Json(patient), datetime.now()])
-                except Exception as e:
-                    print(f"Skipping malformed patient line {i}: {e}")
-
-        # Read Allergy data
-        with open('/data/AllergyIntolerance.ndjson', 'r') as f:
-            for i, line in enumerate(f, 1):
-                line = line.strip()
-                if not line:
-                    continue
-                try:
-                    line = line.replace('":,"','":null,"').replace('":}', '":null}')
-                    allergy = json.loads(line)
-                    cur.execute('INSERT INTO allergies (data, created_at) VALUES (%s,%s);', [psycopg2.extras.Json(allergy), datetime.now()])
-                except Exception as e:
-                    print(f"Skipping malformed allergy line {i}: {e}")
-
+        create_raw_tables(cur)
+        create_checkpoint_table(cur)
         conn.commit()
+
+        for path, table, label, repair in sources:
+            checkpoints = resume_plan(cur, file_identity(path), lambda start, end: [(start, end)])
+            conn.commit()
+            pending = [c for c in checkpoints if not c.done]
+            if not pending:
+                log.info("%s was already loaded, skipping it.", path)
+                continue
+            decoder = LineDecoder(repair, settings.READER_JSON_BACKEND)
+            stored = malformed = 0
+            started = time.perf_counter()
+            for c in pending:
+                def checkpoint(offset: int, start: int = c.start) -> None:
+                    advance_checkpoint(cur, path, start, offset)
+                    conn.commit()
+
+                shard_stored, shard_malformed = store_file(cur, path, table, label, decoder, mode, c.committed_offset, c.end, checkpoint)
+                stored += shard_stored
+                malformed += shard_malformed
+            metrics.observe("reader_load_seconds", time.perf_counter() - started, table=table)
+            metrics.inc("reader_lines_total", stored, table=table, outcome="stored")
+            metrics.inc("reader_lines_total", malformed, table=table, outcome="malformed")
+            log.info("Stored %d %s lines from %s (%d malformed) using %s mode.", stored, label, path, malformed, mode)
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"Error occurred: {e}")
+        log.exception("Error occurred: %s", e)
     finally:
         if cur:
             cur.close()
         if conn:
             conn.close()
 
+
+def follow_and_store_data(directory: str = None):
+    """
+    Keep storing the NDJSON files of a directory, and the lines appended to them,
+    until the process is interrupted or terminated.
+    """
+    directory = directory or settings.READER_FOLLOW_DIR
+    conn = connect_raw_db()
+    try:
+        with conn.cursor() as cur:
+            create_raw_tables(cur)
+        conn.commit()
+    finally:
+        conn.close()
+
+    sources = [
+        FollowedSource(
+            os.path.basename(path).split('.')[0],
+            table,
+            label,
+            LineDecoder(repair, settings.READER_JSON_BACKEND)
+        )
+        for path, table, label, repair in SOURCES
+    ]
+    partitions_day = date.today()
+
+    def create_partitions(cur) -> None:
+        # Monthly partitions are created ahead of time, checking once a day is enough
+        nonlocal partitions_day
+        if date.today() != partitions_day:
+            partitions_day = date.today()
+            for table in RAW_TABLES:
+                ensure_partitions(cur, table, partitions_day)
+
+    follower = DirectoryFollower(
+        directory,
+        sources,
+        connect_raw_db,
+        poll_interval=settings.READER_FOLLOW_POLL_SECONDS,
+        batch_rows=settings.READER_FOLLOW_BATCH_ROWS,
+        max_latency=settings.READER_FOLLOW_MAX_LATENCY_SECONDS,
+        queue_rows=settings.READER_FOLLOW_QUEUE_ROWS,
+        max_bytes=settings.READER_COPY_BUFFER_BYTES,
+        maintenance=create_partitions
+    )
+    signal.signal(signal.SIGTERM, lambda signum, frame: follower.stop())
+    log.info("Following %s", directory)
+    try:
+        follower.run()
+    except KeyboardInterrupt:
+        follower.stop()
+
+
 if __name__ == '__main__':
-    read_and_store_data()
-    print("Finished")
+    configure_logging(settings.LOG_LEVEL, settings.LOG_FORMAT)
+    if settings.METRICS_HTTP_PORT:
+        metrics.serve(settings.METRICS_HTTP_PORT, settings.METRICS_HTTP_HOST)
+    try:
+        if settings.READER_FOLLOW:
+            follow_and_store_data()
+        else:
+            read_and_store_data()
+    finally:
+        metrics.export(settings.METRICS_PROMETHEUS_FILE, settings.METRICS_SUMMARY_FILE)
+        metrics.stop()
+    log.info("Finished")
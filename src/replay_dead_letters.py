@@ -0,0 +1,51 @@
+"""
+Put the quarantined raw rows back in their raw table, so the next handler run refines
+them again, e.g. once the validation rules are fixed. See ``processing.dead_letters``.
+The replayed ids are added to the exceptions of the handler progress, so run it while
+the handler is stopped.
+
+Usage (from the repository root):
+    python -u ./src/replay_dead_letters.py                 # rows due for a retry
+    python -u ./src/replay_dead_letters.py --all           # every quarantined row
+    python -u ./src/replay_dead_letters.py --source patients --limit 1000
+"""
+import argparse
+import logging
+
+from models.tables.raw_table import RawAllergies, RawPatients
+from logs import configure_logging
+from processing.dead_letters import DeadLetterQueue
+from processing.progress import ProgressTracker
+from repository.raw_db import get_raw_db_session_context
+from settings import settings
+
+RAW_MODELS = {"allergies": RawAllergies, "patients": RawPatients}
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", nargs="+", default=list(RAW_MODELS), choices=list(RAW_MODELS))
+    parser.add_argument("--all", action="store_true", help="also replay the rows whose next retry time has not come")
+    parser.add_argument("--limit", type=int, default=None, help="maximum number of rows to replay per source")
+    args = parser.parse_args()
+    configure_logging(settings.LOG_LEVEL, settings.LOG_FORMAT)
+
+    for source in args.source:
+        dead_letters = DeadLetterQueue(
+            source, RAW_MODELS[source], settings.HANDLER_DEAD_LETTER_ATTEMPTS, settings.HANDLER_DEAD_LETTER_RETRY_SECONDS
+        )
+        with get_raw_db_session_context() as raw_db:
+            replayed = dead_letters.replay(raw_db, due_only=not args.all, limit=args.limit)
+            if replayed:
+                # Their ids are below the high-water mark of the handler
+                progress = ProgressTracker(source)
+                progress.load(raw_db, RAW_MODELS[source])
+                progress.add_exceptions(replayed)
+                progress.save(raw_db)
+        log.info("Replayed %d quarantined %s rows", len(replayed), source)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""
+Refine NDJSON files into an embedded SQLite database, with the transforms and the
+processors of the handler and no service running, e.g. to replay a large corpus or
+profile the processors on a laptop or a CI box. See ``repository.backends``.
+
+The lines are decoded as by the reader, then validated, transformed and written by
+batches of ``--batch-size`` as by the handler, every batch in its own transaction,
+the patients first. Replaying into the same database refines the resources again,
+updating them in place. With ``--profile`` the replay runs under cProfile and its
+stats are written to a file, e.g. for ``python -m pstats`` or snakeviz.
+
+Usage (from the repository root):
+    python -u ./src/replay_local.py --database /tmp/refined.db
+    python -u ./src/replay_local.py --patients /tmp/fhir/Patient.ndjson --allergies /tmp/fhir/AllergyIntolerance.ndjson \\
+        --database /tmp/refined.db --batch-size 5000 --profile /tmp/replay.prof
+"""
+import argparse
+import cProfile
+import logging
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Iterator, List, NamedTuple, Optional, Tuple
+
+from ingestion.decoding import JSON_BACKENDS, LineDecoder, repair_allergy_line, repair_patient_line
+from ingestion.sources import iter_lines
+from logs import FailureLog, configure_logging
+from models.tables import RefinedBase
+from processing.code_cache import AllergyCodeCache
+from processing.raw_transform import TransformedBatch, transform_allergy_rows, transform_patient_rows
+from processing.refined_writer import RefinedWriter
+from processing.refining_allergy import AllergyProcessor
+from processing.refining_patients import PatientProcessor
+from repository.backends import embedded_database
+from repository.database import SessionDatabase, get_db_session
+
+log = logging.getLogger(__name__)
+
+
+@contextmanager
+def get_session_context(database: SessionDatabase):
+    return get_db_session(database)
+
+
+class ReplayReport(NamedTuple):
+    entity: str
+    lines: int
+    malformed: int
+    refined: int
+    failures: FailureLog
+    seconds: float
+
+    def __str__(self) -> str:
+        rate = self.lines / self.seconds if self.seconds else 0
+        line = (
+            f"{self.entity}: {self.lines} lines, {self.malformed} malformed, {self.refined} refined, "
+            f"{len(self.failures)} rejected in {self.seconds:.2f}s ({rate:.0f} lines/s)"
+        )
+        return line + (f": {self.failures.summary()}" if self.failures else "")
+
+
+def raw_batches(path: str, decoder: LineDecoder, batch_size: int, malformed: List[int]) -> Iterator[List[dict]]:
+    """
+    Batches of the lines of ``path`` as raw rows, their id being their line number.
+    The lines the reader would not store are counted in ``malformed[0]``.
+    """
+    rows = []
+    for number, (_, raw) in enumerate(iter_lines(path), 1):
+        try:
+            line = str(raw, 'utf-8').strip()
+            if not line:
+                continue
+            _, document = decoder.decode(line)
+        except Exception:
+            malformed[0] += 1
+            continue
+        rows.append({'id': number, 'data': document, 'ack': False, 'created_at': datetime.now()})
+        if len(rows) >= batch_size:
+            yield rows
+            rows = []
+    if rows:
+        yield rows
+
+
+def batch_failures(batch: TransformedBatch, failures: dict) -> List[Tuple[object, str]]:
+    """
+    (id, reason) of every raw row of the batch rejected by the validation or by the
+    processor, once per row.
+    """
+    reasons = {}
+    for kind in failures.values():
+        for resource_id, reason in kind:
+            reasons.setdefault(resource_id, reason)
+    return batch.rejected + [(row_id, reasons[resource_id]) for row_id, resource_id in batch.row_ids if resource_id in reasons]
+
+
+def replay_file(
+    database: SessionDatabase,
+    entity: str,
+    path: str,
+    decoder: LineDecoder,
+    transform: Callable[[List[dict]], Tuple[float, TransformedBatch]],
+    write: Callable,
+    batch_size: int
+) -> ReplayReport:
+    start = time.perf_counter()
+    malformed = [0]
+    lines = refined = 0
+    failures = FailureLog()
+    for rows in raw_batches(path, decoder, batch_size, malformed):
+        _, batch = transform(rows)
+        with get_session_context(database) as session:
+            _, errors = write(session, batch)
+        rejected = batch_failures(batch, errors)
+        failures.extend(rejected)
+        lines += len(rows)
+        refined += len(rows) - len(rejected)
+        log.debug("%s batch: %d rows refined, %d rejected", entity, len(rows) - len(rejected), len(rejected))
+    return ReplayReport(entity, lines + malformed[0], malformed[0], refined, failures, time.perf_counter() - start)
+
+
+def replay(
+    database: SessionDatabase,
+    patients_path: str,
+    allergies_path: str,
+    batch_size: int = 1000,
+    writer: Optional[RefinedWriter] = None,
+    json_backend: str = "auto"
+) -> List[ReplayReport]:
+    """
+    Refine the patients then the allergies of the NDJSON files into ``database``.
+    """
+    writer = writer if writer is not None else RefinedWriter()
+    code_cache = AllergyCodeCache()
+    return [
+        replay_file(
+            database, "patients", patients_path, LineDecoder(repair_patient_line, json_backend), transform_patient_rows,
+            lambda session, batch: PatientProcessor.write_patients(session, batch.prepared, (), writer), batch_size
+        ),
+        replay_file(
+            database, "allergies", allergies_path, LineDecoder(repair_allergy_line, json_backend), transform_allergy_rows,
+            lambda session, batch: AllergyProcessor.write_allergies(session, batch.prepared, code_cache, writer), batch_size
+        ),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", default="data/Patient.ndjson")
+    parser.add_argument("--allergies", default="data/AllergyIntolerance.ndjson")
+    parser.add_argument("--database", default="", help="SQLite file receiving the refined rows, in memory when not set")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--json-backend", default="auto", choices=["auto", *JSON_BACKENDS])
+    parser.add_argument("--profile", help="file receiving the cProfile stats of the replay")
+    parser.add_argument("--log-level", default="INFO")
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+
+    database = embedded_database(RefinedBase, args.database)
+    writer = RefinedWriter()
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    reports = replay(database, args.patients, args.allergies, args.batch_size, writer, args.json_backend)
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        log.info("Profile written to %s", args.profile)
+    for report in reports:
+        log.info(str(report))
+    for line in writer.report():
+        log.info(line)
+
+
+if __name__ == '__main__':
+    main()
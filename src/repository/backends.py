@@ -0,0 +1,62 @@
+"""
+The refined database on Postgres, or on an embedded SQLite file to replay a corpus or
+profile the processors with no service running.
+
+The processors only write through ``processing.refined_writer.RefinedWriter`` and
+``processing.code_cache.AllergyCodeCache``, with ``INSERT ... ON CONFLICT`` on the
+natural keys, which both backends run. SQLite differs in two ways:
+
+- NULLs are distinct in its unique indexes, there is no ``NULLS NOT DISTINCT``. The
+  natural keys with a nullable column get a SQLite index of their own on
+  ``ifnull(column, '')`` (``sqlite_natural_key``), and the conflicts are detected on
+  the same expressions (``conflict_target``).
+- A single transaction writes at a time. The code cache commits the new codes on a
+  connection of its own, so a session must not hold writes when it resolves codes:
+  write every batch in its own session, as the handler does.
+"""
+from typing import List, Sequence
+
+from sqlalchemy import Column, Index, func, literal_column
+from sqlalchemy.orm import Session
+
+from repository.database import SessionDatabase
+
+# The value a NULL of a natural key is indexed as on SQLite, rendered in the SQL so the
+# conflict target matches the index expression
+_NULL_KEY = literal_column("''")
+
+
+def backend(session: Session) -> str:
+    return session.get_bind().dialect.name
+
+
+def _null_safe(column: Column):
+    return func.ifnull(column, _NULL_KEY) if column.nullable else column
+
+
+def sqlite_natural_key(name: str, *columns: Column) -> Index:
+    """
+    Unique index of a natural key created on SQLite only, its nullable columns indexed
+    as '' so that two NULLs conflict as with ``postgresql_nulls_not_distinct``.
+    """
+    return Index(name, *(_null_safe(column) for column in columns), unique=True).ddl_if(dialect="sqlite")
+
+
+def conflict_target(session: Session, model, key: Sequence[str]) -> List:
+    """
+    Index elements of the ``ON CONFLICT`` on the natural key ``key`` of ``model``,
+    matching its unique index on the backend of ``session``.
+    """
+    columns = [getattr(model, column) for column in key]
+    if backend(session) == "sqlite":
+        return [_null_safe(column) for column in columns]
+    return columns
+
+
+def embedded_database(basemodel, path: str = "") -> SessionDatabase:
+    """
+    Database in the SQLite file ``path``, created with the tables of ``basemodel`` on
+    first use, or in memory when ``path`` is empty. An in-memory database has a
+    single connection, use it from one thread at a time.
+    """
+    return SessionDatabase(basemodel, None, None, None, None, url=f"sqlite:///{path}" if path else "sqlite://")
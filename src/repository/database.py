@@ -1,25 +1,186 @@
+import logging
+import threading
+import time
 from contextlib import contextmanager
-from typing import Generator, Tuple
+from typing import Dict, Generator, Optional, Tuple
 
-from sqlalchemy import URL, create_engine
+from sqlalchemy import URL, create_engine, event, make_url
 from sqlalchemy.orm import Session, declarative_base, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from logs import RateLimitedLog
+from metrics import metrics
+from repository.prepared import allow_prepared_statements
 
 BaseModel = declarative_base()
 
+log = logging.getLogger(__name__)
+# Logged on every failed session, a failing database fails them all
+session_errors = RateLimitedLog(log)
+
 class SessionDatabase:
-    def __init__(self, basemodel, username, password, host, database) -> None:
-        url_object = URL.create(
+    """
+    Connection pool of a database, shared by its ORM sessions (``session``) and the
+    psycopg2 connections used directly (``raw_connection``).
+
+    Nothing is done at creation, so importing the modules holding the databases needs
+    no database. The engine is created on first use, and the schema bootstrapped
+    (the tables of ``basemodel`` missing are created) on the first session or
+    connection, or beforehand with ``bootstrap``.
+
+    :param pool_size: Connections kept open in the pool.
+    :param max_overflow: Connections opened above ``pool_size`` when they are all in
+        use, closed once returned.
+    :param pool_pre_ping: Test every connection when it is checked out, replacing the
+        ones closed by the server meanwhile.
+    :param pool_recycle: Seconds after which a connection is replaced, -1 for never.
+    :param prepared_statements: Let the ``repository.prepared.PreparedStatement`` be
+        prepared on the connections of the pool. Turn it off behind a pooler in
+        transaction mode, e.g. PgBouncer, whose server connections change between
+        transactions.
+    :param url: URL of another database than Postgres, instead of the connection
+        parameters, e.g. an embedded SQLite file (``sqlite:///refined.db``), see
+        ``repository.backends``. The pool options only apply to Postgres, and
+        ``raw_connection`` needs psycopg2.
+    """
+    def __init__(
+        self,
+        basemodel,
+        username,
+        password,
+        host,
+        database,
+        port: Optional[int] = None,
+        pool_size: int = 5,
+        max_overflow: int = 5,
+        pool_pre_ping: bool = True,
+        pool_recycle: int = 1800,
+        prepared_statements: bool = True,
+        url: Optional[str] = None
+    ) -> None:
+        self.url = make_url(url) if url else URL.create(
             "postgresql+psycopg2",
             username=username,
             password=password,
             host=host,
+            port=int(port) if port else None,
             database=database,
         )
+        self.basemodel = basemodel
+        if self.url.get_backend_name() == "sqlite":
+            # The connections are used by the pipeline threads, one at a time. An in-memory
+            # database lives in its connection, the single one of the pool.
+            self._engine_options = dict(connect_args={"check_same_thread": False})
+            if self.url.database in (None, "", ":memory:"):
+                self._engine_options["poolclass"] = StaticPool
+        else:
+            self._engine_options = dict(
+                pool_size=pool_size,
+                max_overflow=max_overflow,
+                pool_pre_ping=pool_pre_ping,
+                pool_recycle=pool_recycle
+            )
+        self.prepared_statements = prepared_statements and self.url.get_backend_name() == "postgresql"
+        # Reentrant, the bootstrap creates the engine
+        self._lock = threading.RLock()
+        self._engine = None
+        self._session = None
+        self.bootstrap_seconds: Optional[float] = None
+        self._stats_lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.peak_checked_out = 0
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            with self._lock:
+                if self._engine is None:
+                    engine = create_engine(self.url, **self._engine_options)
+                    event.listen(engine, "connect", self._on_connect)
+                    event.listen(engine, "checkout", self._on_checkout)
+                    self._engine = engine
+        return self._engine
 
-        self.engine = create_engine(url_object)
-        basemodel.metadata.create_all(self.engine)
-        self.session = sessionmaker(bind=self.engine)
-        print("Database connection opened")
+    def bootstrap(self) -> None:
+        """
+        Create the missing tables of the models, once, and time it.
+        """
+        if self._session is not None:
+            return
+        with self._lock:
+            if self._session is not None:
+                return
+            start = time.perf_counter()
+            self.basemodel.metadata.create_all(self.engine)
+            self.bootstrap_seconds = time.perf_counter() - start
+            self._session = sessionmaker(bind=self.engine)
+            log.info("Database %s opened in %.2fs", self.url.database, self.bootstrap_seconds)
+
+    @property
+    def session(self) -> sessionmaker:
+        self.bootstrap()
+        return self._session
+
+    def _on_connect(self, dbapi_connection, connection_record) -> None:
+        with self._stats_lock:
+            self.connects += 1
+        if self.prepared_statements:
+            allow_prepared_statements(dbapi_connection)
+        if self.url.get_backend_name() == "sqlite":
+            cursor = dbapi_connection.cursor()
+            # Checked by Postgres, the writes reference the patients they insert first
+            cursor.execute("PRAGMA foreign_keys=ON")
+            # Readers do not wait for the writer, and a commit does not wait for the disk
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.close()
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy) -> None:
+        # A single connection, in the static pool of an in-memory database
+        checked_out = self.engine.pool.checkedout() if hasattr(self.engine.pool, "checkedout") else 1
+        with self._stats_lock:
+            self.checkouts += 1
+            self.peak_checked_out = max(self.peak_checked_out, checked_out)
+
+    @contextmanager
+    def raw_connection(self):
+        """
+        A psycopg2 connection of the pool, in autocommit, e.g. to stream the raw rows
+        with short statements without holding back vacuum. The connection goes back to
+        the pool, out of autocommit, on exit.
+        """
+        self.bootstrap()
+        with self.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            yield connection.connection.dbapi_connection
+
+    def pool_stats(self) -> Dict[str, int]:
+        if self._engine is None:
+            return dict.fromkeys(("size", "checked_out", "overflow", "peak_checked_out", "connects", "checkouts"), 0)
+        pool = self._engine.pool
+        if not hasattr(pool, "checkedout"):
+            # The static pool of an in-memory database, its connection is never closed
+            return {"size": 1, "checked_out": 0, "overflow": 0, "peak_checked_out": self.peak_checked_out,
+                    "connects": self.connects, "checkouts": self.checkouts}
+        with self._stats_lock:
+            return {
+                "size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "overflow": max(0, pool.overflow()),
+                "peak_checked_out": self.peak_checked_out,
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+            }
+
+    def report(self) -> str:
+        if self._engine is None:
+            return f"{self.url.database} pool: not used"
+        stats = self.pool_stats()
+        return (
+            f"{self.url.database} pool: {stats['connects']} connections opened, {stats['checkouts']} checkouts, "
+            f"at most {stats['peak_checked_out']} in use at once (pool size {stats['size']}), "
+            f"{stats['checked_out']} still in use"
+        )
 
 def get_db_session(
     sessionmanager: SessionDatabase,
@@ -28,13 +189,14 @@ def get_db_session(
     db = sessionmanager.session()
     try:
         yield db
-        db.commit()
+        with metrics.time("db_commit_seconds", database=sessionmanager.url.database):
+            db.commit()
     except Exception as e:
         if commit_on_exception:
             db.commit()
         else:
             db.rollback()
-        print(f"Closing database session due to error: {str(e)}")
+        session_errors.warning("session", "Closing database session due to error: %s", e)
         raise e
     finally:
         db.close()
@@ -61,17 +223,19 @@ def sync_dbs_session(
     refined_db = refined_sessionmanager.session()
     try:
         yield raw_db, refined_db
-        raw_db.commit()
-        refined_db.commit()
+        with metrics.time("db_commit_seconds", database=raw_sessionmanager.url.database):
+            raw_db.commit()
+        with metrics.time("db_commit_seconds", database=refined_sessionmanager.url.database):
+            refined_db.commit()
     except Exception as e:
         raw_db.rollback()
         refined_db.rollback()
-        print(f"Closing database session due error: {str(e)}")
+        session_errors.warning("sessions", "Closing database sessions due to error: %s", e)
         raise e
     finally:
         raw_db.close()
         refined_db.close()
-        print(f"Database sessions closed")
+        log.debug("Database sessions closed")
 
 @contextmanager
 def get_sync_session_context(
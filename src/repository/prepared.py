@@ -0,0 +1,54 @@
+import re
+import threading
+import weakref
+from typing import Sequence
+
+# Names of the statements prepared on every connection allowed to prepare them
+_prepared: "weakref.WeakKeyDictionary[object, set[str]]" = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def allow_prepared_statements(dbapi_connection) -> None:
+    """
+    Let the ``PreparedStatement`` executed on a psycopg2 connection be prepared on the
+    server. Called by ``repository.database.SessionDatabase`` for every connection of
+    its pool.
+    """
+    with _lock:
+        _prepared.setdefault(dbapi_connection, set())
+
+
+class PreparedStatement:
+    """
+    A statement run many times on the same connections, e.g. the keyset read of a
+    raw table, parsed and planned once per connection with ``PREPARE`` instead of on
+    every execution.
+
+    The statement is only prepared on the connections allowed to, the pooled
+    connections of a ``SessionDatabase`` with prepared statements on. It is sent as
+    it is on any other connection, e.g. the ones opened by the reader or the
+    benchmarks. A prepared statement lives as long as its connection, across the
+    checkouts from the pool.
+
+    :param name: Name of the statement, unique among the prepared statements.
+    :param sql: Statement with psycopg2 ``%s`` placeholders.
+    """
+
+    def __init__(self, name: str, sql: str) -> None:
+        self.name = name
+        self.sql = sql
+        self.params = sql.count("%s")
+        placeholders = iter(range(1, self.params + 1))
+        self._prepare = f"PREPARE {name} AS " + re.sub(r"%s", lambda _: f"${next(placeholders)}", sql).rstrip().rstrip(";")
+        self._execute = f"EXECUTE {name}" + (f" ({', '.join(['%s'] * self.params)})" if self.params else "")
+
+    def execute(self, cur, params: Sequence = ()) -> None:
+        with _lock:
+            prepared = _prepared.get(cur.connection)
+        if prepared is None:
+            cur.execute(self.sql, params)
+            return
+        if self.name not in prepared:
+            cur.execute(self._prepare)
+            prepared.add(self.name)
+        cur.execute(self._execute, params)
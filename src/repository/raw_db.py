@@ -9,9 +9,24 @@ sessionmaker = SessionDatabase(
     username=settings.RAW_DB_USER,
     password=settings.RAW_DB_PASSWORD,
     host=settings.RAW_DB_HOST,
-    database=settings.RAW_DB_NAME
+    database=settings.RAW_DB_NAME,
+    port=settings.RAW_DB_PORT,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_POOL_MAX_OVERFLOW,
+    pool_pre_ping=settings.DB_POOL_PRE_PING,
+    pool_recycle=settings.DB_POOL_RECYCLE_SECONDS,
+    prepared_statements=settings.DB_PREPARED_STATEMENTS
 )
 
 @contextmanager
 def get_raw_db_session_context(commit_on_exception: bool = False):
-    return get_db_session(sessionmaker, commit_on_exception)
\ No newline at end of file
+    return get_db_session(sessionmaker, commit_on_exception)
+
+
+@contextmanager
+def get_raw_db_connection_context():
+    """
+    psycopg2 connection of the raw database pool, in autocommit.
+    """
+    with sessionmaker.raw_connection() as connection:
+        yield connection
@@ -0,0 +1,147 @@
+import logging
+from datetime import date
+from typing import List, Tuple
+
+import psycopg2
+
+RAW_TABLES = ("patients", "allergies")
+
+log = logging.getLogger(__name__)
+
+
+def create_raw_table(cur, table: str, partitioned: bool = False) -> None:
+    """
+    Create a raw table if it does not exist, with a partial index on the unacked rows
+    so the handler scan does not read the acked history. Only the "ack" progress and
+    the "lease" claim mode set ``ack``, the watermark progress reads after its
+    high-water mark on the primary key.
+
+    :param cur: Cursor on the raw database.
+    :param table: Name of the raw table.
+    :param partitioned: Range-partition a new table by ``created_at`` month. Has no
+        effect on a table that already exists.
+    """
+    if partitioned:
+        cur.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                id SERIAL,
+                data JSONB,
+                ack BOOLEAN DEFAULT FALSE,
+                created_at TIMESTAMP NOT NULL,
+                claimed_by TEXT,
+                lease_expires_at TIMESTAMP,
+                PRIMARY KEY (id, created_at)
+            ) PARTITION BY RANGE (created_at);
+        ''')
+        cur.execute(f'CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT;')
+    else:
+        cur.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                id SERIAL PRIMARY KEY,
+                data JSONB,
+                ack BOOLEAN DEFAULT FALSE,
+                created_at TIMESTAMP,
+                claimed_by TEXT,
+                lease_expires_at TIMESTAMP
+            );
+        ''')
+    ensure_lease_columns(cur, table)
+    cur.execute(f'CREATE INDEX IF NOT EXISTS ix_{table}_unacked ON {table} (id) WHERE ack = false;')
+
+
+def ensure_lease_columns(cur, table: str) -> None:
+    """
+    Add the columns used by handler workers to claim rows to a raw table created
+    before they existed. Adding nullable columns does not rewrite the table.
+    """
+    cur.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS claimed_by TEXT, ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP;')
+
+
+def create_dead_letter_table(cur) -> None:
+    """
+    Create the table of the raw rows that failed to refine, see ``processing.dead_letters``.
+    """
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS dead_letters (
+            source TEXT NOT NULL,
+            raw_id INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            first_failed_at TIMESTAMP NOT NULL,
+            last_failed_at TIMESTAMP NOT NULL,
+            data JSONB,
+            created_at TIMESTAMP,
+            quarantined_at TIMESTAMP,
+            next_retry_at TIMESTAMP,
+            PRIMARY KEY (source, raw_id)
+        );
+    ''')
+    cur.execute(
+        'CREATE INDEX IF NOT EXISTS ix_dead_letters_retry ON dead_letters (source, next_retry_at) '
+        'WHERE quarantined_at IS NOT NULL;'
+    )
+
+
+def create_progress_table(cur) -> None:
+    """
+    Create the table of the handler progress on every raw table, see ``processing.progress``.
+    """
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS handler_progress (
+            source TEXT PRIMARY KEY,
+            high_water_mark INTEGER NOT NULL,
+            exceptions JSONB NOT NULL,
+            updated_at TIMESTAMP NOT NULL,
+            gaps JSONB NOT NULL DEFAULT '{}'
+        );
+    ''')
+    cur.execute("ALTER TABLE handler_progress ADD COLUMN IF NOT EXISTS gaps JSONB NOT NULL DEFAULT '{}';")
+
+
+def is_partitioned(cur, table: str) -> bool:
+    cur.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s);", [table])
+    row = cur.fetchone()
+    return bool(row and row[0])
+
+
+def month_ranges(day: date, months_ahead: int) -> List[Tuple[date, date]]:
+    ranges = []
+    year, month = day.year, day.month
+    for _ in range(months_ahead + 1):
+        next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+        ranges.append((date(year, month, 1), date(next_year, next_month, 1)))
+        year, month = next_year, next_month
+    return ranges
+
+
+def ensure_partitions(cur, table: str, day: date, months_ahead: int = 1) -> None:
+    """
+    Create the monthly partitions of ``table`` from the month of ``day`` to
+    ``months_ahead`` months later. Does nothing when the table is not partitioned.
+
+    A partition cannot be created once its rows were stored in the default partition,
+    such a month stays in the default partition.
+    """
+    if not is_partitioned(cur, table):
+        return
+    in_transaction = not cur.connection.autocommit
+    for start, end in month_ranges(day, months_ahead):
+        name = f"{table}_{start.year:04d}_{start.month:02d}"
+        cur.execute('SELECT to_regclass(%s);', [name])
+        if cur.fetchone()[0] is not None:
+            continue
+        if in_transaction:
+            cur.execute('SAVEPOINT ensure_partition;')
+        try:
+            cur.execute(
+                f'CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s);',
+                [start, end]
+            )
+            log.info("Partition %s created.", name)
+        except psycopg2.Error as e:
+            if in_transaction:
+                cur.execute('ROLLBACK TO SAVEPOINT ensure_partition;')
+            log.warning("Could not create partition %s, its rows stay in %s_default: %s", name, table, e)
+        else:
+            if in_transaction:
+                cur.execute('RELEASE SAVEPOINT ensure_partition;')
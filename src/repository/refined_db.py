@@ -10,7 +10,13 @@ sessionmaker = SessionDatabase(
     username=settings.REFINED_DB_USER,
     password=settings.REFINED_DB_PASSWORD,
     host=settings.REFINED_DB_HOST,
-    database=settings.REFINED_DB_NAME
+    database=settings.REFINED_DB_NAME,
+    port=settings.REFINED_DB_PORT,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_POOL_MAX_OVERFLOW,
+    pool_pre_ping=settings.DB_POOL_PRE_PING,
+    pool_recycle=settings.DB_POOL_RECYCLE_SECONDS,
+    prepared_statements=settings.DB_PREPARED_STATEMENTS
 )
 
 @contextmanager
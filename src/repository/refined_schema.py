@@ -0,0 +1,52 @@
+from typing import Tuple
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+# Any constant shared by the handlers migrating the refined schema
+SCHEMA_LOCK_ID = 7041
+
+# Unique index, table and columns of the natural keys, the same as the refined models
+NATURAL_KEYS: Tuple[Tuple[str, str, Tuple[str, ...]], ...] = (
+    ("ux_allergy_codes_natural_key", "allergy_codes", ("system", "code", "display")),
+    ("ux_patient_names_natural_key", "patient_names", ("patient_uuid", "use", "family", "given", "prefix")),
+    ("ux_addresses_natural_key", "addresses", ("patient_uuid", "city", "state", "country", "postal_code", "line")),
+    ("ux_telecoms_natural_key", "telecoms", ("patient_uuid", "system", "value", "use")),
+)
+
+# Tables referencing a table of natural keys, as (table, column)
+REFERENCES = {
+    "allergy_codes": ("allergy_events", "code_id"),
+}
+
+
+def ensure_natural_keys(session: Session) -> None:
+    """
+    Create the natural-key unique indexes of the refined tables on a database created
+    before they existed. The rows stored twice meanwhile are merged first: the oldest
+    copy is kept, and the rows referencing the others are moved to it.
+    """
+    missing = [
+        (index, table, columns) for index, table, columns in NATURAL_KEYS
+        if session.execute(text("SELECT to_regclass(:index);"), {"index": index}).scalar() is None
+    ]
+    if not missing:
+        return
+    session.execute(text("SELECT pg_advisory_xact_lock(:lock_id);"), {"lock_id": SCHEMA_LOCK_ID})
+    for index, table, columns in missing:
+        key = ", ".join(f'"{column}"' for column in columns)
+        # PARTITION BY groups NULLs together, as the indexes do
+        duplicates = f"SELECT id, min(id) OVER (PARTITION BY {key}) AS keep_id FROM {table}"
+        if table in REFERENCES:
+            referencing_table, column = REFERENCES[table]
+            session.execute(text(f'''
+                UPDATE {referencing_table} SET {column} = duplicates.keep_id
+                FROM ({duplicates}) AS duplicates
+                WHERE {referencing_table}.{column} = duplicates.id AND duplicates.id <> duplicates.keep_id;
+            '''))
+        session.execute(text(f'''
+            DELETE FROM {table}
+            USING ({duplicates}) AS duplicates
+            WHERE {table}.id = duplicates.id AND duplicates.id <> duplicates.keep_id;
+        '''))
+        session.execute(text(f'CREATE UNIQUE INDEX IF NOT EXISTS {index} ON {table} ({key}) NULLS NOT DISTINCT;'))
@@ -12,6 +12,54 @@ class Settings(BaseSettings):
     REFINED_DB_PASSWORD: str
     REFINED_DB_HOST: str
     REFINED_DB_PORT: str
+    DB_POOL_SIZE: int = 5
+    DB_POOL_MAX_OVERFLOW: int = 5
+    DB_POOL_PRE_PING: bool = True
+    DB_POOL_RECYCLE_SECONDS: int = 1800
+    DB_PREPARED_STATEMENTS: bool = True
+    PATIENT_INPUT_PATH: str = "/data/Patient.ndjson"
+    ALLERGY_INPUT_PATH: str = "/data/AllergyIntolerance.ndjson"
+    RAW_PARTITION_BY_CREATED_AT: bool = False
+    READER_MODE: str = "copy"
+    READER_COPY_BUFFER_ROWS: int = 10000
+    READER_COPY_BUFFER_BYTES: int = 8 * 1024 * 1024
+    READER_WORKERS: int = 1
+    READER_SHARDS_PER_WORKER: int = 4
+    READER_CHECKPOINT_ROWS: int = 10000
+    READER_JSON_BACKEND: str = "auto"
+    READER_FOLLOW: bool = False
+    READER_FOLLOW_DIR: str = "/data"
+    READER_FOLLOW_POLL_SECONDS: float = 1.0
+    READER_FOLLOW_BATCH_ROWS: int = 5000
+    READER_FOLLOW_MAX_LATENCY_SECONDS: float = 2.0
+    READER_FOLLOW_QUEUE_ROWS: int = 50000
+    HANDLER_BATCH_SIZE: int = 1000
+    HANDLER_BATCH_ADAPTIVE: bool = True
+    HANDLER_BATCH_TARGET_SECONDS: float = 1.0
+    HANDLER_ALLERGY_BATCH_MIN: int = 200
+    HANDLER_ALLERGY_BATCH_MAX: int = 20000
+    HANDLER_PATIENT_BATCH_MIN: int = 100
+    HANDLER_PATIENT_BATCH_MAX: int = 10000
+    HANDLER_CLAIM_MODE: str = "keyset"
+    HANDLER_PROGRESS_MODE: str = "watermark"
+    HANDLER_LEASE_SECONDS: float = 300.0
+    HANDLER_GAP_TIMEOUT_SECONDS: float = 600.0
+    HANDLER_WORKER_ID: str = ""
+    HANDLER_TRANSFORM_WORKERS: int = 2
+    HANDLER_PIPELINE_DEPTH: int = 2
+    HANDLER_EXECUTION_MODE: str = "pipeline"
+    HANDLER_CODE_CACHE_SIZE: int = 10000
+    HANDLER_CHANGE_DETECTION: bool = True
+    HANDLER_WRITE_PATH: str = "core"
+    HANDLER_DEAD_LETTER_ATTEMPTS: int = 3
+    HANDLER_DEAD_LETTER_RETRY_SECONDS: float = 3600.0
+    METRICS_PROMETHEUS_FILE: str = ""
+    METRICS_SUMMARY_FILE: str = ""
+    METRICS_HTTP_PORT: int = 0
+    METRICS_HTTP_HOST: str = "127.0.0.1"
+    LOG_LEVEL: str = "INFO"
+    LOG_FORMAT: str = "text"
+    LOG_FAILURE_SAMPLES: int = 3
 
     class Config:
         env_file = ".env"
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The application modules import each other relative to src/, as in the containers
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
@@ -0,0 +1,96 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from processing.async_pipeline import AsyncBatchPipeline
+
+
+def double_ids(rows):
+    if any(row['id'] < 0 for row in rows):
+        raise ValueError("negative id")
+    return 0.01, [row['id'] * 2 for row in rows]
+
+
+def batches(*ids):
+    return [[{'id': i, 'data': {}} for i in batch] for batch in ids]
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_async_pipeline_writes_and_acks_batches_in_order(workers):
+    written, acked = [], []
+
+    def write(batch):
+        # The first batches take longest, they must still be written first
+        time.sleep(0.01 * (10 - len(written)))
+        written.append(batch)
+        return [i // 2 for i in batch]
+
+    pool = ProcessPoolExecutor(max_workers=workers) if workers else None
+    try:
+        pipeline = AsyncBatchPipeline(double_ids, write, acked.append, pool=pool, workers=workers, depth=2)
+        processed = pipeline.run(batches([1, 2], [3], [4, 5, 6], [7]))
+    finally:
+        if pool:
+            pool.shutdown()
+
+    assert processed == 7
+    assert written == [[2, 4], [6], [8, 10, 12], [14]]
+    assert acked == [[1, 2], [3], [4, 5, 6], [7]]
+    assert pipeline.write_stats.batches == 4
+
+
+def test_async_pipeline_does_not_ack_failed_batches():
+    acked = []
+
+    def write(batch):
+        if 6 in batch:
+            raise RuntimeError("refined database down")
+        return [i // 2 for i in batch]
+
+    pipeline = AsyncBatchPipeline(double_ids, write, acked.append)
+    assert pipeline.run(batches([1], [-1], [3], [4])) == 4
+    assert acked == [[1], [4]]
+    assert "2 batches written" in pipeline.report("Allergies")
+
+
+def test_async_pipeline_acks_only_committed_batches():
+    committed, acked_before_commit = set(), []
+
+    def write(batch):
+        time.sleep(0.01)
+        committed.update(batch)
+        return [i // 2 for i in batch]
+
+    def ack(ids):
+        acked_before_commit.extend(i for i in ids if i * 2 not in committed)
+
+    AsyncBatchPipeline(double_ids, write, ack, depth=3).run(batches(*[[i] for i in range(1, 10)]))
+    assert acked_before_commit == []
+
+
+def test_entities_run_side_by_side():
+    barrier = threading.Barrier(2, timeout=5)
+
+    def write(batch):
+        # Only returns once the other entity writes too
+        barrier.wait()
+        return [i // 2 for i in batch]
+
+    allergies, patients = [], []
+    pipelines = [
+        AsyncBatchPipeline(double_ids, write, allergies.append),
+        AsyncBatchPipeline(double_ids, write, patients.append),
+    ]
+
+    async def run():
+        return await asyncio.gather(
+            pipelines[0].run_async(batches([1], [2])),
+            pipelines[1].run_async(batches([3], [4])),
+        )
+
+    assert asyncio.run(run()) == [2, 2]
+    assert allergies == [[1], [2]]
+    assert patients == [[3], [4]]
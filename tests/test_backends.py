@@ -0,0 +1,60 @@
+import os
+
+from sqlalchemy import create_mock_engine, func, select
+
+from models.tables import RefinedBase
+from models.tables.allergy_refined_tables import AllergyCodes, AllergyEvents
+from models.tables.patient_refined_tables import Address, Patient, PatientName, Telecom
+from replay_local import get_session_context, replay
+from repository.backends import embedded_database
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+PATIENTS = os.path.join(DATA_DIR, "Patient.ndjson")
+ALLERGIES = os.path.join(DATA_DIR, "AllergyIntolerance.ndjson")
+
+
+def counts(database):
+    with get_session_context(database) as session:
+        return {
+            model.__tablename__: session.execute(select(func.count()).select_from(model)).scalar()
+            for model in (Patient, PatientName, Address, Telecom, AllergyCodes, AllergyEvents)
+        }
+
+
+def test_processors_refine_into_an_embedded_database(tmp_path):
+    database = embedded_database(RefinedBase, str(tmp_path / "refined.db"))
+    patients, allergies = replay(database, PATIENTS, ALLERGIES, batch_size=4)
+
+    assert (patients.lines, patients.refined, len(patients.failures)) == (10, 10, 0)
+    assert (allergies.lines, allergies.refined, len(allergies.failures)) == (38, 33, 5)
+    assert allergies.failures.counts == {"Allergy event schema incompatibility": 5}
+    assert counts(database) == {
+        "patients": 10, "patient_names": 11, "addresses": 10, "telecoms": 10, "allergy_codes": 10, "allergy_events": 33,
+    }
+
+
+def test_replaying_again_adds_no_rows(tmp_path):
+    database = embedded_database(RefinedBase, str(tmp_path / "refined.db"))
+    replay(database, PATIENTS, ALLERGIES)
+    first = counts(database)
+    # Names without prefix and addresses without postal code conflict as on Postgres
+    replay(database, PATIENTS, ALLERGIES, batch_size=3)
+    assert counts(database) == first
+
+
+def test_in_memory_database():
+    database = embedded_database(RefinedBase)
+    patients, allergies = replay(database, PATIENTS, ALLERGIES)
+    assert (patients.refined, allergies.refined) == (10, 33)
+    assert counts(database)["allergy_events"] == 33
+
+
+def test_postgres_schema_keeps_its_natural_keys():
+    statements = []
+    engine = create_mock_engine("postgresql+psycopg2://", lambda sql, *args, **kwargs: statements.append(
+        str(sql.compile(dialect=engine.dialect))
+    ))
+    RefinedBase.metadata.create_all(engine, checkfirst=False)
+    indexes = [statement for statement in statements if "INDEX" in statement]
+    assert any("ux_patient_names_natural_key ON patient_names" in s and "NULLS NOT DISTINCT" in s for s in indexes)
+    assert not any("_sqlite" in s for s in indexes)
@@ -0,0 +1,75 @@
+import pytest
+
+from processing.batch_controller import BatchSizeController
+from processing.pipeline import BatchPipeline
+
+
+def test_batches_grow_toward_the_target_latency():
+    controller = BatchSizeController("Allergies", 100, 10000, target_seconds=1.0, initial_size=1000)
+    # 0.1 ms per row: 10000 rows fit in the target, reached in steps of at most 2x
+    for _ in range(5):
+        size = controller.next_size()
+        controller.observe(size, size * 0.0001)
+    assert controller.sizes == [1000, 2000, 4000, 8000, 10000]
+    assert controller.size == 10000
+    assert controller.throughput() == pytest.approx(10000)
+
+
+def test_batches_shrink_when_slow_and_stay_within_bounds():
+    controller = BatchSizeController("Patients", 100, 10000, target_seconds=1.0, initial_size=1000)
+    for _ in range(5):
+        size = controller.next_size()
+        controller.observe(size, size * 0.05)
+    assert controller.sizes == [1000, 500, 250, 125, 100]
+    assert controller.size == 100
+
+
+def test_small_changes_are_ignored():
+    controller = BatchSizeController("Patients", 100, 10000, target_seconds=1.0, initial_size=1000)
+    controller.observe(1000, 1.05)
+    assert controller.size == 1000
+    # Failed or empty batches tell nothing
+    controller.observe(0, 0.0)
+    assert controller.row_seconds == pytest.approx(0.00105)
+
+
+def test_fixed_bounds_keep_the_size():
+    controller = BatchSizeController("Allergies", 500, 500, target_seconds=1.0, initial_size=1000)
+    assert controller.next_size() == 500
+    controller.observe(500, 0.001)
+    assert controller.next_size() == 500
+
+
+def test_invalid_bounds_are_rejected():
+    with pytest.raises(ValueError):
+        BatchSizeController("Allergies", 1000, 100, target_seconds=1.0)
+
+
+def test_pipeline_reports_every_acked_batch():
+    controller = BatchSizeController("Allergies", 1, 100, target_seconds=1.0, initial_size=2)
+    observed = []
+    controller.observe = lambda rows, seconds: observed.append((rows, seconds))
+
+    def select(rows):
+        # Rows with an odd id are unchanged
+        return [row for row in rows if row['id'] % 2 == 0], [row['id'] for row in rows if row['id'] % 2]
+
+    def write(batch):
+        if -4 in batch:
+            raise RuntimeError("refined database down")
+        return [i // 2 for i in batch]
+
+    pipeline = BatchPipeline(
+        lambda rows: (0.5, [row['id'] * 2 for row in rows]), write, lambda ids: None,
+        select=select, controller=controller
+    )
+    pipeline.run([
+        [{'id': 1}, {'id': 2}],
+        [{'id': 3}],
+        [{'id': -2}],
+        [{'id': 4}, {'id': 6}, {'id': 8}],
+    ])
+
+    # The failed batch is left out, the batch of unchanged rows is acked before the first one is written
+    assert [rows for rows, _ in observed] == [1, 2, 3]
+    assert observed[0][1] < 0.5 and observed[1][1] >= 0.5 and observed[2][1] >= 0.5
@@ -0,0 +1,50 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from models.tables.resource_hash_table import ResourceHashes
+from processing.change_detection import ResourceHashStore
+
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite://")
+    ResourceHashes.__table__.create(engine)
+    with Session(engine) as session:
+        session.add_all([
+            ResourceHashes(resource_type="Patient", resource_id="p1", content_hash="h1", updated_at=datetime.now()),
+            ResourceHashes(resource_type="Patient", resource_id="p2", content_hash="h2", updated_at=datetime.now()),
+            ResourceHashes(resource_type="AllergyIntolerance", resource_id="p3", content_hash="h3", updated_at=datetime.now()),
+        ])
+        session.commit()
+        yield session
+
+
+def row(row_id, resource_id, content_hash):
+    return {'id': row_id, 'data': {'id': resource_id}, 'content_hash': content_hash}
+
+
+def test_unchanged_resources_are_skipped(session):
+    store = ResourceHashStore("Patient")
+    changed, unchanged = store.select_changed(session, [
+        row(1, "p1", "h1"),
+        row(2, "p2", "other"),
+        row(3, "p3", "h3"),
+        row(4, None, "h4"),
+    ])
+
+    assert unchanged == [1]
+    assert [r['id'] for r in changed] == [2, 3, 4]
+    # Only the patient refined before from another content is replaced
+    assert [r['previous_hash'] for r in changed] == ["h2", None, None]
+    assert (store.unchanged, store.changed) == (1, 3)
+
+
+def test_rows_without_object_payload_are_refined(session):
+    changed, unchanged = ResourceHashStore("Patient").select_changed(session, [
+        {'id': 1, 'data': ["not", "a", "resource"], 'content_hash': "h1"},
+    ])
+    assert unchanged == []
+    assert [r['id'] for r in changed] == [1]
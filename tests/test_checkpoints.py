@@ -0,0 +1,82 @@
+import json
+import sqlite3
+
+from ingestion.checkpoints import HEAD_BYTES, advance_checkpoint, file_identity, resume_plan
+
+
+class SqliteCursor:
+    """
+    The statements of ingestion.checkpoints on SQLite.
+    """
+
+    def __init__(self, connection: sqlite3.Connection) -> None:
+        self.cursor = connection.cursor()
+
+    def execute(self, sql: str, params=()) -> None:
+        self.cursor.execute(sql.replace("%s", "?").replace("GREATEST(", "MAX("), params)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+
+def checkpoint_cursor() -> SqliteCursor:
+    cur = SqliteCursor(sqlite3.connect(":memory:"))
+    # As created by create_checkpoint_table
+    cur.execute('''
+        CREATE TABLE ingest_checkpoints (
+            file_path TEXT NOT NULL, shard_start BIGINT NOT NULL, shard_end BIGINT NOT NULL,
+            committed_offset BIGINT NOT NULL, file_size BIGINT NOT NULL, file_mtime DOUBLE PRECISION NOT NULL,
+            head_bytes INTEGER NOT NULL, head_hash TEXT NOT NULL, updated_at TIMESTAMP NOT NULL, committed_hash TEXT,
+            PRIMARY KEY (file_path, shard_start)
+        );
+    ''')
+    return cur
+
+
+def lines(ids) -> bytes:
+    return b"".join(json.dumps({"resourceType": "Patient", "id": str(i)}).encode() + b"\n" for i in ids)
+
+
+def write(path, data: bytes, mode: str = "wb") -> None:
+    with open(path, mode) as f:
+        f.write(data)
+
+
+def single_shard(start, end):
+    return [(start, end)]
+
+
+def store(cur, path) -> int:
+    """
+    Plan the file and mark it stored up to its end, as the reader does.
+    """
+    checkpoints = resume_plan(cur, file_identity(path), single_shard)
+    end = checkpoints[-1].end
+    advance_checkpoint(cur, path, checkpoints[-1].start, end)
+    return end
+
+
+def test_appended_lines_resume_after_the_committed_offset(tmp_path):
+    path = str(tmp_path / "Patient.ndjson")
+    write(path, lines(range(1000)))
+    cur = checkpoint_cursor()
+    committed = store(cur, path)
+
+    write(path, lines(range(1000, 1100)), "ab")
+    checkpoints = resume_plan(cur, file_identity(path), single_shard)
+    assert [c.committed_offset for c in checkpoints if not c.done] == [committed]
+
+
+def test_a_rewritten_file_with_the_same_head_is_read_again(tmp_path):
+    path = str(tmp_path / "Patient.ndjson")
+    write(path, lines(range(5000)))
+    cur = checkpoint_cursor()
+    committed = store(cur, path)
+
+    # A new export repeating the first resources, the hashed head included, and larger
+    # than the previous one
+    write(path, lines(range(2000)) + lines(range(10000, 14000)))
+    identity = file_identity(path)
+    assert identity.head_bytes == HEAD_BYTES and identity.size > committed
+    checkpoints = resume_plan(cur, identity, single_shard)
+    assert [(c.start, c.committed_offset, c.end) for c in checkpoints] == [(0, 0, identity.size)]
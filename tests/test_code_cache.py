@@ -0,0 +1,25 @@
+from processing.code_cache import AllergyCodeCache
+
+
+def test_cached_codes_resolve_without_round_trip():
+    cache = AllergyCodeCache()
+    cache._store(("227493005", "http://snomed.info/sct", "Cashew nuts"), 1)
+    cache._store(("91935009", "http://snomed.info/sct", "Peanut"), 2)
+
+    # No session is needed when every code is cached
+    resolved = cache.resolve(None, [("91935009", "http://snomed.info/sct", "Peanut")] * 3)
+
+    assert resolved == {("91935009", "http://snomed.info/sct", "Peanut"): 2}
+    assert (cache.hits, cache.misses, cache.round_trips) == (1, 0, 0)
+
+
+def test_least_recently_used_code_is_evicted():
+    cache = AllergyCodeCache(max_size=2)
+    cache._store(("a", "s", "A"), 1)
+    cache._store(("b", "s", "B"), 2)
+    cache.resolve(None, [("a", "s", "A")])
+    cache._store(("c", "s", "C"), 3)
+
+    assert len(cache) == 2
+    assert ("b", "s", "B") not in cache.ids
+    assert list(cache.ids) == [("a", "s", "A"), ("c", "s", "C")]
@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Session
+
+from models.tables.dead_letter_table import DeadLetters
+from models.tables.raw_table import RawAllergies
+from processing.dead_letters import DeadLetterQueue
+
+
+@compiles(JSONB, "sqlite")
+def compile_jsonb(type_, compiler, **kw):
+    return "JSON"
+
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite://")
+    RawAllergies.__table__.create(engine)
+    DeadLetters.__table__.create(engine)
+    with Session(engine) as session:
+        session.add_all([
+            RawAllergies(id=i, data={'id': f"a{i}"}, ack=False, created_at=datetime(2024, 1, i))
+            for i in range(1, 4)
+        ])
+        session.commit()
+        yield session
+
+
+def raw_ids(session):
+    return [row_id for row_id, in session.execute(select(RawAllergies.id).order_by(RawAllergies.id))]
+
+
+def test_rows_are_quarantined_after_max_attempts(session):
+    dead_letters = DeadLetterQueue("allergies", RawAllergies, max_attempts=2, retry_seconds=60)
+    assert dead_letters.record(session, {1: "missing code", 2: "missing code"}) == 0
+    assert raw_ids(session) == [1, 2, 3]
+
+    assert dead_letters.record(session, {1: "invalid date"}) == 1
+    assert raw_ids(session) == [2, 3]
+    letter = session.get(DeadLetters, ("allergies", 1))
+    assert (letter.attempts, letter.reason, letter.data) == (2, "invalid date", {'id': "a1"})
+    assert letter.next_retry_at - letter.quarantined_at == timedelta(seconds=60)
+    assert session.get(DeadLetters, ("allergies", 2)).quarantined_at is None
+
+
+def test_replay_moves_due_rows_back_with_their_id(session):
+    dead_letters = DeadLetterQueue("allergies", RawAllergies, max_attempts=1, retry_seconds=0)
+    dead_letters.record(session, {1: "missing code", 3: "missing code"})
+    assert raw_ids(session) == [2]
+
+    assert dead_letters.replay(session, limit=1) == [1]
+    assert raw_ids(session) == [1, 2]
+    replayed = session.get(RawAllergies, 1)
+    assert (replayed.data, replayed.ack, replayed.created_at) == ({'id': "a1"}, False, datetime(2024, 1, 1))
+    letter = session.get(DeadLetters, ("allergies", 1))
+    assert (letter.attempts, letter.data, letter.quarantined_at) == (1, None, None)
+
+    # A replayed row failing again is quarantined at once
+    assert dead_letters.record(session, {1: "missing code"}) == 1
+    assert session.get(DeadLetters, ("allergies", 1), populate_existing=True).attempts == 2
+    assert raw_ids(session) == [2]
+
+
+def test_replay_waits_for_the_next_retry_time(session):
+    dead_letters = DeadLetterQueue("allergies", RawAllergies, max_attempts=1, retry_seconds=3600)
+    dead_letters.record(session, {1: "missing code"})
+    assert dead_letters.replay(session) == []
+    assert dead_letters.replay(session, due_only=False) == [1]
+    assert raw_ids(session) == [1, 2, 3]
+
+
+def test_retry_delay_doubles_past_max_attempts():
+    dead_letters = DeadLetterQueue("allergies", RawAllergies, max_attempts=3, retry_seconds=60)
+    now = datetime(2024, 1, 1)
+    assert [dead_letters.next_retry(attempts, now) - now for attempts in (3, 4, 5)] == [
+        timedelta(seconds=60), timedelta(seconds=120), timedelta(seconds=240)
+    ]
@@ -0,0 +1,56 @@
+import json
+import os
+
+import pytest
+
+from ingestion.decoding import JSON_BACKENDS, LineDecoder, repair_allergy_line, repair_patient_line
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+
+
+def legacy_decode(line: str, resource: str):
+    if resource == "Patient":
+        line = line.replace(":,",":null,")
+    else:
+        line = line.replace('":,"','":null,"').replace('":}', '":null}')
+    return line, json.loads(line)
+
+
+def decode_or_error(decode, line):
+    try:
+        return decode(line)
+    except ValueError:
+        return "malformed"
+
+
+@pytest.mark.parametrize("backend", sorted(JSON_BACKENDS))
+@pytest.mark.parametrize("resource, repair", [("Patient", repair_patient_line), ("AllergyIntolerance", repair_allergy_line)])
+def test_decoders_match_legacy_repair_on_samples(backend, resource, repair):
+    decoder = LineDecoder(repair, backend)
+    with open(os.path.join(DATA_DIR, f"{resource}.ndjson")) as f:
+        for line in f:
+            line = line.strip()
+            assert decode_or_error(decoder.decode, line) == decode_or_error(lambda l: legacy_decode(l, resource), line)
+
+
+@pytest.mark.parametrize("backend", sorted(JSON_BACKENDS))
+@pytest.mark.parametrize("line", [
+    '{"a":,"b":}',
+    '{"a":,":}',
+    '{"a":1e400,"b":NaN}',
+    '{"big":123456789012345678901234567890}',
+    '{"s":"\\ud800"}',
+    '{"a":',
+])
+def test_decoders_accept_the_same_lines_as_the_stdlib(backend, line):
+    decoder = LineDecoder(repair_allergy_line, backend)
+    expected = decode_or_error(lambda l: legacy_decode(l, "AllergyIntolerance"), line)
+    result = decode_or_error(decoder.decode, line)
+    assert (result == "malformed") == (expected == "malformed")
+    if expected != "malformed":
+        assert result[0] == expected[0]
+
+
+def test_unknown_backend_is_rejected():
+    with pytest.raises(ValueError):
+        LineDecoder(repair_patient_line, "simdjson")
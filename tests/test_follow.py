@@ -0,0 +1,31 @@
+from ingestion.decoding import LineDecoder, repair_patient_line
+from ingestion.follow import DirectoryFollower, FollowedFile, FollowedSource
+
+
+def follower(tmp_path):
+    source = FollowedSource("Patient", "raw_patients", "patient", LineDecoder(repair_patient_line))
+    # The lines are only queued, nothing connects before run()
+    return DirectoryFollower(str(tmp_path), [source], connect=None), source
+
+
+def queued(follower):
+    lines = []
+    while not follower.lines.empty():
+        lines.append(follower.lines.get_nowait())
+    return lines
+
+
+def test_lines_that_are_not_utf8_are_skipped_as_malformed(tmp_path):
+    path = str(tmp_path / "Patient.ndjson")
+    first, invalid, last = b'{"id": "1"}\n', b'{"id": "\xff\xfe"}\n', b'{"id": "3"}\n'
+    with open(path, "wb") as f:
+        f.write(first + invalid + last)
+    directory, source = follower(tmp_path)
+    followed = FollowedFile(path, source, 0)
+    followed.ranges = [(0, 0, None)]
+
+    directory.read_new_lines(followed)
+    lines = queued(directory)
+    assert [line.line for line in lines] == ['{"id": "1"}', None, '{"id": "3"}']
+    assert [line.next_offset for line in lines] == [len(first), len(first + invalid), len(first + invalid + last)]
+    assert followed.ranges == [(0, len(first + invalid + last), None)]
@@ -0,0 +1,71 @@
+import json
+import logging
+
+from ingestion.decoding import repair_allergy_line
+from logs import FailureLog, JsonFormatter, RateLimitedLog
+from processing.raw_transform import transform_allergy_rows
+from test_transform import raw_rows
+
+
+def test_failures_are_counted_by_reason_with_a_few_examples():
+    failures = FailureLog(samples=2)
+    failures.extend([
+        (1, "1 validation error for RawPatient\ngender\n  Input should be a valid string"),
+        (2, "2 validation errors for RawPatient\nbirthDate"),
+        (3, "1 validation error for RawPatient\nid"),
+        (4, "created_at is missing"),
+    ])
+    assert len(failures) == 4
+    assert failures.counts == {"N validation error for RawPatient": 2, "N validation errors for RawPatient": 1,
+                               "created_at is missing": 1}
+    assert [key for key, _ in failures.examples["N validation error for RawPatient"]] == [1, 3]
+
+    batch = FailureLog(samples=2)
+    batch.add(5, "created_at is missing")
+    batch.add(6, "created_at is missing")
+    failures.merge(batch)
+    assert failures.counts["created_at is missing"] == 3
+    assert [key for key, _ in failures.examples["created_at is missing"]] == [4, 5]
+    assert failures.summary().startswith("created_at is missing x3 (e.g. 4: created_at is missing; 5: ")
+
+
+def test_repeated_messages_are_dropped_and_counted(caplog):
+    logger = logging.getLogger("test_logs.rate")
+    limited = RateLimitedLog(logger, limit=2, interval=3600)
+    with caplog.at_level(logging.WARNING, logger="test_logs.rate"):
+        for line in range(5):
+            limited.warning("patients", "Skipping malformed line %d", line)
+        limited.warning("allergies", "Skipping malformed line %d", 0)
+    assert [r.getMessage() for r in caplog.records] == [
+        "Skipping malformed line 0", "Skipping malformed line 1", "Skipping malformed line 0",
+    ]
+    assert limited.dropped("patients") == 3
+    assert limited.dropped() == 3
+
+    # A new window reports the messages dropped in the previous one
+    limited.interval = 0
+    with caplog.at_level(logging.WARNING, logger="test_logs.rate"):
+        limited.warning("patients", "Skipping malformed line %d", 5)
+    assert caplog.records[-1].getMessage() == "Skipping malformed line 5 (3 similar messages dropped)"
+
+
+def test_json_lines_hold_the_extra_fields():
+    record = logging.makeLogRecord({
+        "name": "handler", "levelname": "WARNING", "msg": "%s batch: %d rejected", "args": ("patients", 2),
+        "rejects": {"created_at is missing": 2},
+    })
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry["message"] == "patients batch: 2 rejected"
+    assert (entry["level"], entry["logger"]) == ("WARNING", "handler")
+    assert entry["rejects"] == {"created_at is missing": 2}
+
+
+def test_rows_are_only_logged_one_by_one_at_debug(caplog):
+    rows = raw_rows("AllergyIntolerance.ndjson", repair_allergy_line)
+    with caplog.at_level(logging.INFO):
+        transform_allergy_rows(rows)
+    assert caplog.records == []
+
+    with caplog.at_level(logging.DEBUG, logger="processing.raw_transform"):
+        transform_allergy_rows(rows)
+    assert sum(r.getMessage().startswith("Processing allergy") for r in caplog.records) == len(rows)
@@ -0,0 +1,108 @@
+import copy
+import json
+import urllib.request
+from datetime import datetime
+
+import pytest
+from pydantic import ValidationError
+
+from ingestion.decoding import repair_allergy_line, repair_patient_line
+from logs import FailureLog
+from metrics import MAX_REASONS, MetricsRegistry, reason_label
+from models.raw_patient import RawPatient
+from processing.raw_transform import transform_allergy_rows, transform_patient_rows
+from test_transform import raw_rows
+
+
+def test_histograms_and_counters_render_in_prometheus_format():
+    registry = MetricsRegistry()
+    for seconds in (0.002, 0.02, 0.2, 120):
+        registry.observe("handler_stage_seconds", seconds, entity="patients", stage="write")
+    registry.inc("handler_rows_total", 1500000, entity="patients", outcome="read")
+
+    text = registry.render()
+    assert '# TYPE handler_stage_seconds histogram' in text
+    assert 'handler_stage_seconds_bucket{entity="patients",stage="write",le="0.005"} 1' in text
+    assert 'handler_stage_seconds_bucket{entity="patients",stage="write",le="0.25"} 3' in text
+    assert 'handler_stage_seconds_bucket{entity="patients",stage="write",le="+Inf"} 4' in text
+    assert 'handler_stage_seconds_count{entity="patients",stage="write"} 4' in text
+    assert 'handler_rows_total{entity="patients",outcome="read"} 1500000' in text
+
+
+def test_summary_holds_quantiles():
+    registry = MetricsRegistry()
+    for _ in range(19):
+        registry.observe("db_commit_seconds", 0.003, database="refined_data")
+    registry.observe("db_commit_seconds", 7.0, database="refined_data")
+
+    summary = json.loads(json.dumps(registry.summary()))
+    commits = summary["histograms"]['db_commit_seconds{database="refined_data"}']
+    assert (commits["count"], commits["p50"], commits["p95"], commits["max"]) == (20, 0.005, 0.005, 7.0)
+
+
+def test_rejects_are_counted_by_reason_without_details():
+    assert reason_label("1 validation error for RawPatient\ngender\n  Input should be a valid string") == \
+        "N validation error for RawPatient"
+    assert reason_label("Coding schema incompatibility: code 123 is not valid") == "Coding schema incompatibility"
+
+    registry = MetricsRegistry()
+    registry.reject("allergies", "created_at is missing")
+    registry.reject("allergies", "created_at is missing")
+    for i in range(MAX_REASONS + 5):
+        registry.reject("allergies", f"reason {chr(65 + i % 26)}{chr(65 + i // 26)}")
+    counters = registry.summary()["counters"]
+    assert counters['handler_rejects_total{entity="allergies",reason="created_at is missing"}'] == 2
+    assert counters['handler_rejects_total{entity="allergies",reason="other"}'] == 6
+    assert counters['handler_rows_total{entity="allergies",outcome="rejected"}'] == MAX_REASONS + 7
+
+
+def test_metrics_are_served_over_http():
+    registry = MetricsRegistry()
+    registry.inc("reader_lines_total", 3, table="patients", outcome="stored")
+    server = registry.serve(0)
+    try:
+        host, port = server.server_address
+        with urllib.request.urlopen(f"http://{host}:{port}/metrics") as response:
+            body = response.read().decode()
+    finally:
+        registry.stop()
+    assert 'reader_lines_total{outcome="stored",table="patients"} 3' in body
+
+
+def rejected(transform, rows, *edits):
+    """
+    Labels of the rejections of ``rows`` changed by every edit, one row per edit.
+    """
+    changed = []
+    for i, edit in enumerate(edits, 1):
+        data = copy.deepcopy(rows[0]['data'])
+        edit(data)
+        changed.append({'id': i, 'data': data, 'ack': False, 'created_at': datetime.now()})
+    _, batch = transform(changed)
+    failures = FailureLog()
+    failures.extend(batch.rejected)
+    return [reason_label(reason) for _, reason in batch.rejected], failures
+
+
+def test_validation_errors_are_labelled_by_location_and_type():
+    allergies = raw_rows("AllergyIntolerance.ndjson", repair_allergy_line)
+    labels, failures = rejected(
+        transform_allergy_rows, allergies,
+        lambda data: data.pop('criticality'),
+        lambda data: data['patient'].update(reference=None),
+        lambda data: data['code']['coding'][0].pop('code'),
+    )
+    assert labels == ["criticality [missing]", "patient.reference [string_type]", "code.coding.N.code [missing]"]
+    assert len(failures.counts) == 3
+
+    patients = raw_rows("Patient.ndjson", repair_patient_line)
+    labels, _ = rejected(
+        transform_patient_rows, patients,
+        lambda data: data.pop('gender'),
+        lambda data: data['name'][0].update(family=7),
+    )
+    assert labels == ["gender [missing]", "name.N.family [string_type]"]
+
+    with pytest.raises(ValidationError) as error:
+        RawPatient.model_validate({**patients[0]['data'], 'telecom': [{'system': 'phone'}]})
+    assert reason_label(error.value) == "telecom.N.value [missing]"
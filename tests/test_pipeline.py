@@ -0,0 +1,92 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from processing.pipeline import BatchPipeline, StageStats
+
+
+def double_ids(rows):
+    if any(row['id'] < 0 for row in rows):
+        raise ValueError("negative id")
+    return 0.01, [row['id'] * 2 for row in rows]
+
+
+def batches(*ids):
+    return [[{'id': i, 'data': {}} for i in batch] for batch in ids]
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_pipeline_writes_and_acks_batches_in_order(workers):
+    written, acked = [], []
+
+    def write(batch):
+        written.append(batch)
+        return [i // 2 for i in batch]
+
+    pool = ProcessPoolExecutor(max_workers=workers) if workers else None
+    try:
+        pipeline = BatchPipeline(double_ids, write, acked.append, pool=pool, workers=workers, depth=2)
+        processed = pipeline.run(batches([1, 2], [3], [4, 5, 6]))
+    finally:
+        if pool:
+            pool.shutdown()
+
+    assert processed == 6
+    assert written == [[2, 4], [6], [8, 10, 12]]
+    assert acked == [[1, 2], [3], [4, 5, 6]]
+    assert pipeline.transform_stats.batches == 3
+    assert pipeline.transform_stats.busy == pytest.approx(0.03)
+
+
+def test_failed_batches_are_not_acked():
+    acked = []
+
+    def write(batch):
+        if 6 in batch:
+            raise RuntimeError("refined database down")
+        return [i // 2 for i in batch]
+
+    pipeline = BatchPipeline(double_ids, write, acked.append)
+    assert pipeline.run(batches([1], [-1], [3], [4])) == 4
+    assert acked == [[1], [4]]
+    assert pipeline.write_stats.batches == 2
+
+
+def test_batches_without_rows_to_ack_skip_the_ack_stage():
+    acked = []
+    pipeline = BatchPipeline(double_ids, lambda batch: [], acked.append)
+    pipeline.run(batches([1], [2]))
+    assert acked == []
+    assert "2 batches written" in pipeline.report("Allergies")
+
+
+def test_stage_utilization_accounts_for_slots():
+    stats = StageStats("transform", slots=4)
+    stats.add(2.0)
+    assert stats.utilization(1.0) == 0.5
+    assert stats.utilization(0.0) == 0.0
+
+
+def test_every_batch_read_is_done_once():
+    acked, done = [], []
+
+    def write(batch):
+        if 6 in batch:
+            raise RuntimeError("refined database down")
+        return [i // 2 for i in batch if i != 8]
+
+    pipeline = BatchPipeline(double_ids, write, acked.append, done=done.append)
+    pipeline.run(batches([1, 2], [-1], [3], [4, 5]))
+    assert acked == [[1, 2], [5]]
+    assert sorted(done) == [[-1], [1, 2], [3], [4, 5]]
+
+
+def test_stage_seconds_are_observed_for_every_batch():
+    observed = []
+    pipeline = BatchPipeline(
+        double_ids, lambda batch: [i // 2 for i in batch], lambda ids: None,
+        observe=lambda stage, seconds: observed.append(stage)
+    )
+    pipeline.run(batches([1, 2], [-1], [3]))
+    # The failed transform is not observed
+    assert sorted(observed) == ["ack", "ack", "fetch", "fetch", "fetch", "transform", "transform", "write", "write"]
@@ -0,0 +1,41 @@
+from repository.prepared import PreparedStatement, allow_prepared_statements
+
+
+class Connection:
+    pass
+
+
+class Cursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.executed = []
+
+    def execute(self, sql, params=None):
+        self.executed.append((sql, params))
+
+
+def test_statement_is_prepared_once_per_connection():
+    statement = PreparedStatement("fetch_test", "SELECT id FROM test WHERE id > %s ORDER BY id LIMIT %s;")
+    connection = Connection()
+    allow_prepared_statements(connection)
+    cur = Cursor(connection)
+    statement.execute(cur, [0, 10])
+    statement.execute(cur, [10, 10])
+
+    assert cur.executed == [
+        ("PREPARE fetch_test AS SELECT id FROM test WHERE id > $1 ORDER BY id LIMIT $2", None),
+        ("EXECUTE fetch_test (%s, %s)", [0, 10]),
+        ("EXECUTE fetch_test (%s, %s)", [10, 10]),
+    ]
+
+    other = Cursor(Connection())
+    allow_prepared_statements(other.connection)
+    statement.execute(other, [0, 10])
+    assert other.executed[0][0].startswith("PREPARE fetch_test")
+
+
+def test_statement_is_sent_as_is_on_other_connections():
+    statement = PreparedStatement("fetch_test", "SELECT id FROM test WHERE id > %s;")
+    cur = Cursor(Connection())
+    statement.execute(cur, [5])
+    assert cur.executed == [("SELECT id FROM test WHERE id > %s;", [5])]
@@ -0,0 +1,188 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Session
+
+from models.tables.progress_table import HandlerProgress
+from models.tables.raw_table import RawAllergies
+from processing.progress import ProgressTracker
+
+
+@compiles(JSONB, "sqlite")
+def compile_jsonb(type_, compiler, **kw):
+    return "JSON"
+
+
+def read(progress, *batches):
+    for ids in batches:
+        progress._read([{'id': i} for i in ids])
+
+
+def test_high_water_mark_moves_over_batches_in_read_order():
+    progress = ProgressTracker("allergies")
+    read(progress, [1, 2, 3], [4, 5], [6])
+
+    # The second batch is over first: the mark waits for the first one
+    progress.ack([4, 5])
+    assert progress.done([4, 5]) is False
+    assert progress.high_water_mark == 0
+
+    progress.ack([1, 3])
+    assert progress.done([1, 2, 3]) is True
+    assert progress.high_water_mark == 5
+    assert progress.exceptions == {2}
+
+
+def test_failed_batches_become_exceptions():
+    progress = ProgressTracker("allergies")
+    read(progress, [1, 2], [3, 4])
+    progress.done([1, 2])
+    progress.ack([3, 4])
+    progress.done([3, 4])
+    assert (progress.high_water_mark, progress.exceptions) == (4, {1, 2})
+
+    # Retried and refined this time
+    read(progress, [1, 2])
+    progress.ack([1, 2])
+    assert progress.done([1, 2]) is True
+    assert (progress.high_water_mark, progress.exceptions) == (4, set())
+
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite://")
+    RawAllergies.__table__.create(engine)
+    HandlerProgress.__table__.create(engine)
+    with Session(engine) as session:
+        session.add_all([
+            RawAllergies(id=i, data={}, ack=i != 3 and i != 5, created_at=datetime.now()) for i in range(1, 7)
+        ])
+        session.commit()
+        yield session
+
+
+def test_progress_starts_before_the_first_unacked_row(session):
+    progress = ProgressTracker("allergies")
+    progress.load(session, RawAllergies)
+    assert (progress.high_water_mark, progress.exceptions) == (2, set())
+
+
+def test_progress_is_saved_in_one_row(session):
+    progress = ProgressTracker("allergies")
+    progress.load(session, RawAllergies)
+    read(progress, [3, 4, 5, 6])
+    progress.ack([3, 4, 6])
+    progress.done([3, 4, 5, 6])
+    progress.save(session)
+    progress.add_exceptions([7])
+    progress.save(session)
+
+    loaded = ProgressTracker("allergies")
+    loaded.load(session, RawAllergies)
+    # Exceptions after the mark are read again with the new rows
+    assert (loaded.high_water_mark, loaded.exceptions) == (6, {5})
+    assert session.query(HandlerProgress).count() == 1
+
+
+class RawConnection:
+    """
+    A raw table read by ``iter_batches_after``, ``writing`` telling whether another
+    session holds a write lock on it. ``commits`` are rows inserted before the next reads.
+    """
+
+    def __init__(self, ids, writing: bool, commits=()) -> None:
+        self.ids = sorted(ids)
+        self.writing = writing
+        self.commits = list(commits)
+        self.reads = 0
+
+    def cursor(self, cursor_factory=None):
+        return RawCursor(self)
+
+
+class RawCursor:
+    def __init__(self, connection: RawConnection) -> None:
+        self.connection = connection
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql: str, params) -> None:
+        conn = self.connection
+        if conn.reads and conn.commits:
+            conn.ids = sorted(conn.ids + [conn.commits.pop(0)])
+        conn.reads += 1
+        after_id, limit = params
+        self.rows = [
+            {'id': i, 'data': {}, 'ack': False, 'created_at': None, 'content_hash': '', 'writers_active': conn.writing}
+            for i in conn.ids if i > after_id
+        ][:limit]
+
+    def fetchall(self):
+        return self.rows
+
+
+def refine(progress, conn, batch_size=10):
+    read = []
+    for rows in progress.batches(conn, "allergies", batch_size):
+        ids = [row['id'] for row in rows]
+        progress.ack(ids)
+        progress.done(ids)
+        read.append(ids)
+    return read
+
+
+def test_a_permanent_gap_under_an_active_writer_is_skipped_after_the_timeout():
+    # Id 4 was rolled back while the reader keeps writing to the table
+    conn = RawConnection([1, 2, 3, 5, 6], writing=True)
+    progress = ProgressTracker("allergies", gap_timeout=600)
+    assert refine(progress, conn) == [[1, 2, 3]]
+    assert progress.high_water_mark == 3 and set(progress.gaps) == {4}
+    assert progress.gaps_changed()
+
+    # Still within the timeout: the next run waits on the gap again
+    assert refine(progress, conn) == []
+
+    progress.gaps[4] -= timedelta(seconds=600)
+    conn.ids.append(7)
+    assert refine(progress, conn) == [[5, 6, 7]]
+    assert progress.high_water_mark == 7
+
+
+def test_gaps_are_never_skipped_without_a_timeout():
+    conn = RawConnection([1, 2, 3, 5, 6], writing=True)
+    progress = ProgressTracker("allergies")
+    assert refine(progress, conn) == [[1, 2, 3]]
+    assert refine(progress, conn) == []
+    assert progress.gaps == {}
+
+
+def test_a_gap_without_writers_is_read_again_before_being_skipped():
+    progress = ProgressTracker("allergies", gap_timeout=600)
+    assert refine(progress, RawConnection([1, 2, 3, 5, 6], writing=False)) == [[1, 2, 3], [5, 6]]
+
+    # The writer of id 10 committed between the snapshot of the read and its lock check
+    progress = ProgressTracker("allergies", gap_timeout=600)
+    progress.high_water_mark = 8
+    assert refine(progress, RawConnection([9, 11], writing=False, commits=[10])) == [[9], [10, 11]]
+
+
+def test_gaps_are_saved_with_the_progress(session):
+    progress = ProgressTracker("allergies", gap_timeout=600)
+    progress.load(session, RawAllergies)
+    seen = datetime(2024, 1, 1, 12)
+    progress.gaps = {1: seen, 4: seen}
+    progress.save(session)
+    assert not progress.gaps_changed()
+
+    loaded = ProgressTracker("allergies", gap_timeout=600)
+    loaded.load(session, RawAllergies)
+    # The gaps under the high-water mark are dropped
+    assert loaded.gaps == {4: seen}
@@ -0,0 +1,41 @@
+import pytest
+
+from ingestion.sharding import plan_shards
+from ingestion.sources import iter_lines
+
+
+@pytest.fixture
+def ndjson_file(tmp_path):
+    lines = [f'{{"id":"{i}","padding":"{"x" * (i % 7)}"}}\n' for i in range(200)]
+    path = tmp_path / "sample.ndjson"
+    path.write_text("".join(lines))
+    return str(path), lines
+
+
+@pytest.mark.parametrize("shards", [1, 2, 3, 7, 50, 500])
+def test_shards_cover_every_line_once(ndjson_file, shards):
+    path, lines = ndjson_file
+    plan = plan_shards(path, shards, min_shard_bytes=1)
+    assert plan[0][0] == 0
+    for (_, end), (start, _) in zip(plan, plan[1:]):
+        assert end == start
+    read = [str(raw, 'utf-8') for start, end in plan for _, raw in iter_lines(path, start, end)]
+    assert read == lines
+
+
+def test_small_files_are_not_split(ndjson_file):
+    path, _ = ndjson_file
+    assert len(plan_shards(path, 8)) == 1
+
+
+def test_empty_file_has_no_shards(tmp_path):
+    path = tmp_path / "empty.ndjson"
+    path.write_text("")
+    assert plan_shards(str(path), 4) == []
+
+
+def test_last_line_without_newline_is_read(tmp_path):
+    path = tmp_path / "no_newline.ndjson"
+    path.write_text('{"a":1}\n{"b":2}')
+    plan = plan_shards(str(path), 2, min_shard_bytes=1)
+    assert [bytes(raw) for start, end in plan for _, raw in iter_lines(str(path), start, end)] == [b'{"a":1}\n', b'{"b":2}']
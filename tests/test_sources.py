@@ -0,0 +1,46 @@
+import bz2
+import gzip
+import lzma
+import os
+
+import pytest
+
+from ingestion.sources import detect_compression, iter_lines
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+OPENERS = {"gzip": gzip.open, "bz2": bz2.open, "xz": lzma.open}
+
+
+@pytest.fixture
+def sample():
+    with open(os.path.join(DATA_DIR, "AllergyIntolerance.ndjson"), "rb") as f:
+        return f.read()
+
+
+def read(path, start=0, end=None):
+    return [(offset, bytes(raw)) for offset, raw in iter_lines(path, start, end)]
+
+
+@pytest.mark.parametrize("compression", sorted(OPENERS))
+def test_compressed_files_yield_the_uncompressed_lines(tmp_path, sample, compression):
+    plain = tmp_path / "plain.ndjson"
+    plain.write_bytes(sample)
+    compressed = tmp_path / "compressed.ndjson"
+    with OPENERS[compression](compressed, "wb") as f:
+        f.write(sample)
+
+    assert detect_compression(str(plain)) is None
+    assert detect_compression(str(compressed)) == compression
+    lines = read(str(plain))
+    assert read(str(compressed)) == lines
+    assert b"".join(raw for _, raw in lines) == sample
+
+    # Resuming from an offset gives the same lines in both cases
+    offset = lines[len(lines) // 2][0]
+    assert read(str(compressed), offset) == read(str(plain), offset) == lines[len(lines) // 2:]
+
+
+def test_empty_file_has_no_lines(tmp_path):
+    path = tmp_path / "empty.ndjson"
+    path.write_bytes(b"")
+    assert read(str(path)) == []
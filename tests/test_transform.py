@@ -0,0 +1,60 @@
+import copy
+import json
+import os
+from datetime import datetime
+
+from ingestion.decoding import repair_allergy_line, repair_patient_line
+from models import validators
+from models.address import Address
+from processing.raw_transform import transform_allergy_rows, transform_patient_rows
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+
+
+def raw_rows(name, repair):
+    rows = []
+    with open(os.path.join(DATA_DIR, name)) as f:
+        for line in f:
+            try:
+                data = json.loads(repair(line.strip()))
+            except ValueError:
+                continue
+            rows.append({'id': len(rows) + 1, 'data': data, 'ack': False, 'created_at': datetime.now()})
+    return rows
+
+
+def test_allergy_rows_are_refined_in_one_pass():
+    rows = raw_rows("AllergyIntolerance.ndjson", repair_allergy_line)
+    rows.append({'id': len(rows) + 1, 'data': rows[0]['data'], 'ack': False, 'created_at': None})
+    _, batch = transform_allergy_rows(rows)
+
+    prepared = batch.prepared
+    assert len(prepared.events) == 33
+    assert len(prepared.failed_allergy_event) == 5
+    assert prepared.failed_allergy_code == []
+    # The row without created_at is rejected before its payload is validated
+    assert len(rows) not in [row_id for row_id, _ in batch.row_ids]
+    assert batch.rejected == [(len(rows), "created_at is missing")]
+    assert {key for _, key in prepared.events} <= set(prepared.code_keys)
+
+
+def test_patient_rows_are_refined_in_one_pass():
+    rows = raw_rows("Patient.ndjson", repair_patient_line)
+    malformed = copy.deepcopy(rows[0]['data'])
+    malformed['id'] = "not-a-uuid"
+    rows.append({'id': len(rows) + 1, 'data': malformed, 'ack': False, 'created_at': datetime.now()})
+    _, batch = transform_patient_rows(rows)
+
+    prepared = batch.prepared
+    assert len(prepared.patients) == 10
+    assert [patient_id for patient_id, _ in prepared.failed_patients] == ["not-a-uuid"]
+    # Tuples follow the column order of the refined tables
+    assert all(address[0] in {p[0] for p in prepared.patients} for address in prepared.addresses)
+
+
+def test_optional_fields_are_resolved_once():
+    validators.optional_fields.cache_clear()
+    for _ in range(3):
+        Address(patient_uuid="9f4c4c4e-8a5b-4f2c-9d5e-1f0b2a3c4d5e", line=["1 Main St"], city="Boston", state="MA",
+                postal_code="", country="US")
+    assert validators.optional_fields.cache_info().misses == 1